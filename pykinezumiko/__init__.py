@@ -1,27 +1,79 @@
+import contextlib
 import inspect
+import itertools
 import os
+import pickle
+import shelve
+import sys
+import threading
 import time
+import traceback
 from collections import defaultdict
-from collections.abc import Container, Generator
+from collections.abc import Container, Generator, Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
-from functools import wraps
-from typing import Any, Callable, TypeVar, overload
+from functools import partial, wraps
+from typing import Any, Callable, ClassVar, Self, TypeVar, overload
 
-import httpx
 import regex
 
-from . import conf, humanity
+from . import codec, conf, humanity
+from .caching import SingleFlight, TTLCache
+from .codec import Media as Media
+from .outbox import Outbox
+from .scheduler import Scheduler
+from .scheduler import scheduled as scheduled
+from .timerwheel import TimerWheel
+from .transport import HTTPTransport, Transport
 
 CallableT = TypeVar("CallableT", bound=Callable)
 
 
 class Bot:
-    def __init__(self):
-        self._name_cache: dict[int | tuple[int, int], str] = {}
+    timeouts: ClassVar[dict[str, float]] = {
+        "upload_private_file": 300.0,
+        "upload_group_file": 300.0,
+        "get_friend_list": 30.0,
+        "get_group_list": 30.0,
+        "get_group_member_list": 30.0,
+    }
+    """各端点的请求超时秒数。未列出的端点使用传输层的默认超时。"""
+
+    def __init__(
+        self, transport: Transport | str = "http://127.0.0.1:5700", outbox: Outbox | None = None
+    ) -> None:
+        """
+        :param transport: 与OneBot实现之间的连接方式。字符串表示通过HTTP连接到该地址。
+        :param outbox: send方法使用的发送队列。
+        """
+        self.transport = HTTPTransport(transport) if isinstance(transport, str) else transport
+        """call方法使用的传输层。"""
+        self.outbox = outbox or Outbox()
+        """send方法使用的发送队列。"""
+        self.pool = ThreadPoolExecutor(16, thread_name_prefix="call_many", initializer=self._enter_pool)
+        """call_many方法同时发送请求使用的线程池。"""
+        self._pool_thread = threading.local()
+        """在pool的线程中，active属性为真。"""
+        self._revalidation = ThreadPoolExecutor(1, thread_name_prefix="revalidate_names")
+        """在后台重新获取过时名称的线程。
+
+        重新获取要经由call_many等待pool中的请求，若也在pool中进行，占满pool的线程就会互相等待而死锁。
+        """
+
+        self._name_cache = TTLCache[int | tuple[int, int], str](maxsize=10000, ttl=3600.0)
         """在name方法内部使用的名称缓存。若想在对话中包含某人的名称，请使用name方法。
 
         从context到好友名或群聊名的映射，以及从(context, sender)到群名片的映射。
+        条目一小时后过期，以便跟上群名片的变化。活跃用户的条目还会随消息事件中的发送者信息随时更新。
         """
+        self._name_negative_ttl = 600.0
+        """查无此人（不是好友）的结果在名称缓存中的有效期。
+
+        这样的名称是空字符串，同样会被缓存，以免每次都为同一个陌生人重新下载整个好友列表。
+        有效期较短，是为了在加为好友后能较快地获取到名称。
+        """
+        self._flights = SingleFlight[dict]()
+        """合并同时进行的相同只读请求。多个线程同时查询不在缓存中的名称时，只会发出一次请求。"""
 
     def call(self, endpoint: str, data: dict = {}, **kwargs) -> dict:
         """向OneBot实现发送请求，并返回响应数据。
@@ -37,81 +89,103 @@ class Bot:
             gocqhttp("get_login_info")["nickname"]
         """
         kwargs.update(data)
-        data = httpx.post(f"http://127.0.0.1:5700/{endpoint}", json=kwargs).json()
+        data = self.transport.request(endpoint, kwargs, self.timeouts.get(endpoint))
         if data["status"] == "failed":
             raise RuntimeError(
                 f"RPC {endpoint} {humanity.format_object(data)} 失败：{humanity.format_object(data)}"
             )
         return data["data"] if "data" in data else {}
 
-    def send(self, context: int, text: str) -> None:
+    def call_many(
+        self, calls: Iterable[tuple[str, dict]], concurrency: int = 8, coalesce: bool = False
+    ) -> list[dict | Exception]:
+        """同时发送多个请求，按顺序返回各自的响应数据。
+
+        使用例：
+
+            bot.call_many(("get_group_info", {"group_id": group}) for group in groups)
+
+        :param calls: (端点, 参数)构成的序列。
+        :param concurrency: 最多同时进行的请求数。
+        :param coalesce: 与其他线程中正在进行的相同请求合并，共享同一个响应。只能用于只读的请求。
+        :returns: 与calls一一对应的响应数据。个别请求失败时，对应位置是异常对象，不影响其他请求。
+        """
+        calls = list(calls)
+        call = self._call_coalesced if coalesce else self.call
+        results: list[dict | Exception] = [{}] * len(calls)
+        if getattr(self._pool_thread, "active", False):
+            # 在pool的线程中等待pool中的其他任务可能会死锁，于是就地逐个发送。
+            for i, (endpoint, data) in enumerate(calls):
+                try:
+                    results[i] = call(endpoint, data)
+                except Exception as e:  # noqa: BLE001
+                    results[i] = e
+            return results
+        pending: dict[Future, int] = {}
+        queue = iter(enumerate(calls))
+        for i, (endpoint, data) in itertools.islice(queue, concurrency):
+            pending[self.pool.submit(call, endpoint, data)] = i
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                try:
+                    results[i] = future.result()
+                except Exception as e:  # noqa: BLE001
+                    results[i] = e
+                for i, (endpoint, data) in itertools.islice(queue, 1):
+                    pending[self.pool.submit(call, endpoint, data)] = i
+        return results
+
+    def _enter_pool(self) -> None:
+        self._pool_thread.active = True
+
+    def _call_coalesced(self, endpoint: str, data: dict) -> dict:
+        return self._flights.do((endpoint, *sorted(data.items())), lambda: self.call(endpoint, data))
+
+    def close(self) -> None:
+        """等待发送队列清空，然后关闭与OneBot实现之间的连接。"""
+        if not self.outbox.join(10.0):
+            print("发送队列未能及时清空，放弃剩余消息")
+        self.transport.close()
+
+    def send(self, context: int, text: codec.Message) -> Future:
         """发送消息。
 
+        消息只是被放入发送队列，本方法会立即返回。同一会话中的消息保证按调用顺序发出。
+
         :param context: 发送目标，正数表示好友，负数表示群。
-        :param message: 要发送的消息内容，富文本用木鼠子码表示。
+        :param text: 要发送的消息内容，富文本用木鼠子码表示。
+            内存中的图片和语音可以用codec.Media与字符串拼成列表一同发送，参照codec.Message。
+        :returns: 消息发出后得到结果的Future。一般无需理会。
+        """
+        segments, action = self._encode(context, text)
+        if action is None:
+            action = partial(
+                self.call,
+                "send_msg",
+                {"user_id" if context >= 0 else "group_id": abs(context), "message": segments},
+            )
+        return self.outbox.submit(context, action)
+
+    def _encode(
+        self, context: int, text: codec.Message
+    ) -> tuple[list[dict[str, Any]], Callable[[], object] | None]:
+        """转换木鼠子码字符串或其他消息到消息段列表。
+
+        :returns: (消息段列表, 特殊动作)。上传文件等无法用消息段表示的消息以特殊动作给出。
         """
         if not text:
             raise ValueError("试图发送空消息")
-        # 转换木鼠子码字符串到消息段列表。
-        segments: list[dict[str, str | dict[str, object]]] = []
-        for match in regex.finditer(r"[^\a]+|\a<([^<>]*)>", text):
-            if args := match.group(1):
-                args = args.split(" ")
-            match args:
-                case None:
-                    segments.append({"type": "text", "data": {"text": match.group()}})
-                case ["Emoticon", x]:
-                    segments.append({"type": "face", "data": {"id": x}})
-                case ["Mention", str(x)]:
-                    segments.append({"type": "at", "data": {"qq": x}})
-                case ["Sticker", x, y, z]:
-                    segments = [
-                        {
-                            "type": "mface",
-                            "data": {
-                                "summary": text[match.end() :],
-                                "key": x,
-                                "emoji_id": y,
-                                "emoji_package_id": int(z),
-                            },
-                        }
-                    ]
-                    break
-                case ["Sticker", "RPS"] | ["Sticker", "RPS", _]:
-                    segments = [{"type": "rps", "data": {}}]
-                case ["Sticker", "Dice"] | ["Sticker", "Dice", _]:
-                    segments = [{"type": "dice", "data": {}}]
-                case ["Image", url]:
-                    segments.append({"type": "image", "data": {"url": url}})
-                case ["Audio", path]:
-                    segments = [{"type": "record", "data": {"path": path}}]
-                    break
-                case ["Video", url]:
-                    segments = [{"type": "video", "data": {"url": url}}]
-                    break
-                case ["File", filename]:
-                    name = text[match.end() :] or os.path.basename(filename)
-                    if "://" not in filename:
-                        filename = os.path.realpath(filename)
-                    if context >= 0:
-                        self.call("upload_private_file", user_id=context, file=filename, name=name)
-                    else:
-                        self.call("upload_group_file", group_id=-context, file=filename, name=name)
-                    return
-                case ["Poke"]:
-                    segments = [{"type": "poke", "data": {}}]
-                    break
-                case ["Special", x]:
-                    segments = [{"type": "json", "data": {"data": text[match.end() :]}}]
-                    break
-                case ["Quote", x]:
-                    segments.append({"type": "reply", "data": {"id": x}})
-                case ["Begin quote"]:
-                    raise NotImplementedError("TODO")
-                case _:
-                    print("警告：无效的木鼠子码元素", args)
-                    segments.append({"type": "face", "data": {"id": "60"}})  # [咖啡]
-        self.call("send_msg", {"user_id" if context >= 0 else "group_id": abs(context), "message": segments})
+        segments = codec.encode(text)
+        match segments:
+            case [{"type": "file", "data": {"file": file, "name": name}}]:
+                if context >= 0:
+                    return segments, partial(
+                        self.call, "upload_private_file", user_id=context, file=file, name=name
+                    )
+                return segments, partial(self.call, "upload_group_file", group_id=-context, file=file, name=name)
+        return segments, None
 
     @overload
     def name(self, context: int, sender: int) -> str:
@@ -133,33 +207,205 @@ class Bot:
     def name(self, context, sender=None) -> str:
         if sender is not None:
             return self.name((context, sender))
-        if context in self._name_cache:
-            return self._name_cache[context]
-        if isinstance(context, int):
-            if context >= 0:
-                for response in self.call("get_friend_list"):
-                    self._name_cache[response["user_id"]] = response["nickname"]
-                name = self._name_cache.get(context, "")
+        if (name := self._name_cache.get(context)) is not None:
+            if stale := self._claim_stale_names(context):
+                self._revalidation.submit(self._revalidate_names, stale)
+            return name
+        names, errors = self._resolve_names([context])
+        if errors:
+            raise errors[context]
+        return names[context]
+
+    def names(self, contexts: Iterable[int | tuple[int, int]]) -> list[str]:
+        """一次获取多个名称，例如排行榜上所有人的名称。参数的含义与name方法相同。
+
+        未缓存的名称会同时请求。个别名称获取失败时，对应位置是空字符串。
+        """
+        contexts = list(contexts)
+        names: dict[int | tuple[int, int], str] = {}
+        stale: list[int | tuple[int, int]] = []
+        for context in dict.fromkeys(contexts):
+            if (name := self._name_cache.get(context)) is not None:
+                names[context] = name
+                stale.extend(self._claim_stale_names(context))
+        if stale:
+            self._revalidation.submit(self._revalidate_names, stale)
+        resolved, errors = self._resolve_names([context for context in contexts if context not in names])
+        for context, e in errors.items():
+            print("获取名称失败", context, humanity.format_exception(e))
+        names |= resolved
+        return [names.get(context, "") for context in contexts]
+
+    def _resolve_names(
+        self, contexts: Iterable[int | tuple[int, int]]
+    ) -> tuple[dict[int | tuple[int, int], str], dict[int | tuple[int, int], Exception]]:
+        """向OneBot实现请求名称，并存入缓存。
+
+        :returns: (获取到的名称, 获取失败的名称及其原因)。
+        """
+        contexts = list(dict.fromkeys(contexts))
+        names: dict[int | tuple[int, int], str] = {}
+        errors: dict[int | tuple[int, int], Exception] = {}
+        if not contexts:
+            return names, errors
+        # 好友名全部来自同一次get_friend_list，以None为键。
+        calls: dict[int | tuple[int, int] | None, tuple[str, dict]] = {}
+        for context in contexts:
+            match context:
+                case int() if context < 0:
+                    calls[context] = "get_group_info", {"group_id": -context}
+                case (int(group), int(user)) if group < 0:
+                    calls[context] = "get_group_member_info", {"group_id": -group, "user_id": user}
+                case _:
+                    calls[None] = "get_friend_list", {}
+        friends: dict[int, str] = {}
+        for context, response in zip(calls, self.call_many(calls.values(), coalesce=True)):
+            if isinstance(response, Exception):
+                if context is None:
+                    errors |= {c: response for c in contexts if c not in calls}
+                else:
+                    errors[context] = response
+            elif context is None:
+                for friend in response:
+                    friends[friend["user_id"]] = friend["nickname"]
+                    self._name_cache[friend["user_id"]] = friend["nickname"]
+            elif isinstance(context, int):
+                names[context] = response["group_name"]
             else:
-                response = self.call("get_group_info", group_id=-context)
-                name = response["group_name"]
-        else:
-            if context[0] >= 0:
-                name = self.name(context[1])
+                names[context] = response.get("card") or response["nickname"]
+        for context, name in names.items():
+            self._name_cache[context] = name
+        # 私聊中的(context, sender)取发送者的好友名。不是好友的话，名称为空。
+        for context in contexts:
+            if context not in calls and context not in errors:
+                name = friends.get(context if isinstance(context, int) else context[1], "")
+                names[context] = name
+                self._name_cache.set(context, name, None if name else self._name_negative_ttl)
+        return names, errors
+
+    @staticmethod
+    def _name_source(context: int | tuple[int, int]) -> str:
+        """名称由哪个端点获取。"""
+        match context:
+            case int() if context < 0:
+                return "get_group_list"
+            case (int(group), int()) if group < 0:
+                return "get_group_member_info"
+            case _:
+                return "get_friend_list"
+
+    def _claim_stale_names(self, context: int | tuple[int, int]) -> list[int | tuple[int, int]]:
+        """若名称是从快照载入的过时名称，认领要一同在后台重新获取的过时名称。
+
+        所有好友名来自同一次get_friend_list，所有群名来自同一次get_group_list，
+        因此认领其中一个时，同一来源的其他过时名称也一并认领，免得每个名称都单独请求一次。
+        """
+        if not self._name_cache.claim_stale(context):
+            return []
+        source = self._name_source(context)
+        if source == "get_group_member_info":
+            return [context]
+        return [context, *self._name_cache.claim_stale_where(lambda c: self._name_source(c) == source)]
+
+    def _revalidate_names(self, contexts: list[int | tuple[int, int]]) -> None:
+        """在后台重新获取从快照载入的过时名称。群名通过一次get_group_list获取。"""
+        groups = [context for context in contexts if self._name_source(context) == "get_group_list"]
+        others = [context for context in contexts if context not in groups]
+        if groups:
+            try:
+                names = {-group["group_id"]: group["group_name"] for group in self.call("get_group_list")}
+            except Exception as e:  # noqa: BLE001
+                print("重新验证群名失败", humanity.format_exception(e))
             else:
-                response = self.call("get_group_member_info", group_id=-context[0], user_id=context[1])
-                name = response.get("card") or response["nickname"]
-        self._name_cache[context] = name
-        return name
+                for context in groups:
+                    if context in names:
+                        self._name_cache[context] = names[context]
+                    else:
+                        # 已经不在群里了，单独请求试试。
+                        others.append(context)
+        _, errors = self._resolve_names(others)
+        for context, e in errors.items():
+            print("重新验证名称失败", context, humanity.format_exception(e))
+
+    def load_names(self, path: str = "data_names.pickle") -> None:
+        """从文件载入名称缓存的快照。
+
+        快照中的名称可能已经过时，但仍可立即使用，免得重启后的最初一段时间里大量请求名称。
+        名称第一次被用到时，会连同同一来源的其他过时名称一起在后台重新获取。
+        查无此人的空名称只保留较短的有效期，与新查询到的相同。
+        """
+        try:
+            with open(path, "rb") as f:
+                snapshot: dict[int | tuple[int, int], str] = pickle.load(f)
+            self._name_cache.load({context: name for context, name in snapshot.items() if name})
+            self._name_cache.load(
+                {context: name for context, name in snapshot.items() if not name}, self._name_negative_ttl
+            )
+        except FileNotFoundError:
+            pass
+        except Exception:  # noqa: BLE001
+            print("名称缓存文件损坏，忽略")
+            traceback.print_exc()
+
+    def save_names(self, path: str = "data_names.pickle") -> None:
+        """保存名称缓存的快照到文件。先写入临时文件再替换，以免中途退出时留下损坏的文件。"""
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(self._name_cache.snapshot(), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    def warm_names(self, context: int) -> None:
+        """通过get_group_member_list一次性缓存群中所有成员的群名片。
+
+        适合在大群中预先调用，免得每个成员第一次出现时都要单独请求一次。
+        """
+        for member in self.call("get_group_member_list", group_id=-context):
+            self._name_cache[context, member["user_id"]] = member.get("card") or member["nickname"]
 
 
-@dataclass
 class Event:
-    context: int
-    sender: int
-    text: str
-    _json: list[dict[str, Any]]
-    id: int
+    """消息等事件。
+
+    text在第一次读取时才由原始的OneBot消息段列表转换得到，没有插件读取的话就不必转换。
+    """
+
+    __slots__ = ("_json", "_offset", "_text", "context", "id", "sender")
+
+    def __init__(
+        self,
+        context: int,
+        sender: int,
+        text: str | None,
+        _json: list[dict[str, Any]],
+        id: int,
+        offset: int | None = None,
+    ) -> None:
+        """
+        :param text: 事件文本。None表示需要时由_json转换得到。
+        :param _json: OneBot消息段列表。
+        :param offset: 只取转换得到的文本中此位置之后的部分，并去除头尾空格。用于命令的参数。
+        """
+        self.context = context
+        self.sender = sender
+        self.id = id
+        self._json = _json
+        self._text = text
+        self._offset = offset
+
+    @property
+    def text(self) -> str:
+        """木鼠子码格式的事件文本，已经过humanity.scrub处理。"""
+        if self._text is None:
+            text = humanity.scrub(codec.decode(self._json))
+            self._text = text if self._offset is None else text[self._offset :].strip()
+        return self._text
+
+    def __repr__(self) -> str:
+        # 不读取text，以免仅仅为了输出就转换消息。尚未转换时输出原始的消息段列表。
+        if self._text is not None:
+            content = f"text={self._text!r}"
+        else:
+            content = f"_json={self._json!r}" + (f", offset={self._offset}" if self._offset is not None else "")
+        return f"Event(context={self.context}, sender={self.sender}, {content}, id={self.id})"
 
 
 class Plugin:
@@ -169,6 +415,7 @@ class Plugin:
     通过覆盖以“on_”开头的方法，可以监听事件。
     因为这些方法都是空的，不必在覆盖的方法中调用super。
     可以在事件处理中调用self.bot中的方法来作出行动。
+    定时要做的事情可以交给self.scheduler，或是用@pykinezumiko.scheduled装饰方法。
 
     事件包含整数型的context和sender参数。
     正数表示好友，负数表示群。
@@ -178,10 +425,13 @@ class Plugin:
 
     通常，当插件处理了事件（例如回复了消息），就要返回真值。
     为方便计，可以直接返回要回复的文字，与执行send函数无异。
+    图片可以直接返回PIL图像或pykinezumiko.Media，文字和图片混排时返回由它们构成的列表。
+    要过一会儿再回复的话，请返回Later对象，而不要在处理方法中time.sleep。
     返回None的场合，表示插件无法处理这个事件。该事件会轮替给下一个插件来处理。
     """
 
     bot: Bot
+    scheduler: Scheduler
 
     def on_message(self, event: Event) -> object:
         """当收到消息时执行此函数。
@@ -196,6 +446,10 @@ class Plugin:
         这样一来，只需要处理有格式命令的话，甚至不必编写on_message事件处理器就能做到。
         可以在on_command_×××中使用yield（参照下述对话流程功能）。
 
+        【关于触发条件】
+        只关心特定内容的消息的话，可以用@pykinezumiko.trigger装饰on_message，声明正则表达式、关键词或消息段种类。
+        不符合条件的消息不会传给这个方法。所有插件的条件会合并成一次搜索，插件再多，不相关的消息也不会拖慢。
+
         【关于对话流程】
         可以像阻塞式控制台程序一样编写事件处理程序，在需要向用户提问的交互式场合非常方便。
 
@@ -203,7 +457,9 @@ class Plugin:
             → return "你输入的是" + (yield "请输入文字")
 
         这种写法使用了无法持久化保存的Python生成器，也就是说，进程重启之后程序的执行状态就会消失。
-        此外，超过一天没有下文的对话流程会被直接删除。
+        需要跨越重启的对话流程，可以改为返回由状态和少量数据组成的Flow对象，参照Flow类。
+        此外，超过一天没有下文的对话流程会被关闭：生成器在yield处收到GeneratorExit，可以借机收拾残局。
+        可以用@pykinezumiko.flow_timeout为每个命令指定更短或更长的空闲时限。
         """
 
     def on_message_deleted(self, event: Event) -> object:
@@ -216,9 +472,120 @@ class Plugin:
         """
 
 
+class Flow:
+    """可以持久化保存的对话流程，由插件方法表示的状态和少量数据组成。
+
+    生成器式的对话流程在进程重启后就会消失，空闲时还要占着整个栈帧。
+    Flow只记录插件类名、状态方法名和data，Dispatcher可以把空闲的Flow存入文件，重启后接着进行。
+
+        def on_command_foo(self, event):
+            return Flow(self.ask_name, "你叫什么名字？", greeting="你好")
+
+        def ask_name(self, flow, text):
+            if not text:
+                return flow.goto(self.ask_name, "请再说一遍。")
+            return f"{flow.data['greeting']}，{text}。"
+
+    状态方法收到Flow和下一条消息的文本，返回值就是回复。
+    在状态方法中调用goto则对话流程继续，下一条消息交给goto指定的状态方法；否则对话流程随之结束。
+
+    Flow实现了生成器的send和close方法，Dispatcher可以像对待生成器一样对待它。
+    """
+
+    __slots__ = ("closing", "data", "owner", "plugin", "prompt", "state")
+
+    def __init__(
+        self,
+        state: Callable[[Self, str], object],
+        prompt: object = None,
+        closing: Callable[[Self], object] | None = None,
+        **data: Any,
+    ) -> None:
+        """
+        :param state: 收到下一条消息时调用的插件方法。
+        :param prompt: 启动对话流程时的回复，相当于生成器第一次yield的值。
+        :param closing: 对话流程因超时等原因被关闭时调用的插件方法，相当于生成器收到GeneratorExit。
+        :param data: 对话流程的数据。保存到文件时要用pickle序列化，所以应当只含有简单的值。
+        """
+        self.plugin: Plugin | None = state.__self__  # type: ignore
+        """状态方法所属的插件。从文件载入后由Dispatcher按owner重新找到。"""
+        self.owner = type(self.plugin).__qualname__
+        """插件类名。"""
+        self.state = state.__name__
+        """当前状态，即插件方法名。空字符串表示对话流程已经结束。"""
+        self.closing = closing.__name__ if closing else None
+        self.prompt = prompt
+        self.data = data
+
+    def __getstate__(self) -> tuple[str, str, str | None, dict[str, Any]]:
+        return self.owner, self.state, self.closing, self.data
+
+    def __setstate__(self, state: tuple[str, str, str | None, dict[str, Any]]) -> None:
+        self.owner, self.state, self.closing, self.data = state
+        self.plugin = None
+        self.prompt = None
+
+    def goto(self, state: Callable[[Self, str], object], reply: object = None) -> object:
+        """转移到下一个状态，对话流程继续。在状态方法中写return flow.goto(self.foo, 回复)。"""
+        if getattr(state, "__self__", None) is not self.plugin:
+            raise ValueError("对话流程的状态必须是同一插件的方法")
+        self.state = state.__name__
+        return reply
+
+    def send(self, text: str | None) -> object:
+        """送入下一条消息，返回回复。首次送入None，得到prompt。
+
+        :raises StopIteration: 对话流程结束，异常的value属性是最后的回复。
+        """
+        if text is None:
+            prompt, self.prompt = self.prompt, None
+            return prompt
+        state, self.state = self.state, ""
+        result = getattr(self.plugin, state)(self, text)
+        if not self.state:
+            raise StopIteration(result)
+        return result
+
+    def close(self) -> None:
+        """关闭对话流程，调用closing指定的插件方法。"""
+        closing, self.closing = self.closing, None
+        self.state = ""
+        if closing:
+            getattr(self.plugin, closing)(self)
+
+
+@dataclass
+class Later:
+    """延迟的回复。
+
+    事件处理方法返回或在对话流程中yield这个对象，Dispatcher就会在seconds秒后回复result，期间不占用任何线程。
+
+        def on_command_foo(self, event):
+            self.bot.send(event.context, "8 秒后，将被回调。")
+            return Later(8, "被回调。")
+
+    yield的场合，对话流程照常等待下一条消息，不会等到回复发出之后。
+    """
+
+    seconds: float
+    result: object = None
+    """要回复的内容。若是可调用对象，则到时间后调用它，以其返回值作为回复，可以借此延迟执行任意动作。"""
+
+
 class Dispatcher:
-    def __init__(self, bot: Bot, plugins: list[Plugin]) -> None:
+    def __init__(self, bot: Bot, plugins: list[Plugin], scheduler: Scheduler | None = None) -> None:
+        """
+        :param scheduler: 用于延迟回复等的计划任务调度器。默认新建一个。
+        """
         self.bot = bot
+        self.scheduler = scheduler or Scheduler()
+        self.defer: Callable[[tuple[int, int], Callable[[], object]], object] = lambda key, action: action()
+        """执行到期的Later的方法，参数是(context, sender)和要执行的动作。
+
+        默认直接在调度线程中执行。主程序会把动作放入处理队列，使之与同一发送者的其他事件按顺序执行。
+        """
+        self.plugins = {type(plugin).__qualname__: plugin for plugin in plugins}
+        """从插件类名到插件的映射，用于找回从文件载入的Flow所属的插件。"""
         event_handlers = defaultdict[str, list[Callable]](list)
         command_handlers = defaultdict[str, list[Callable]](list)
         for plugin in plugins:
@@ -228,16 +595,56 @@ class Dispatcher:
                 elif name.startswith("on_"):
                     event_handlers[name].append(handler)
         self.event_handlers = dict(event_handlers)
-        self.command_names = sorted(command_handlers)
+        self.triggers = {name: Triggers(handlers) for name, handlers in event_handlers.items()}
+        """各种事件的处理方法的触发条件，参照trigger装饰器。"""
+        self.commands = humanity.CommandTrie(command_handlers)
         self.command_handlers = dict(command_handlers)
-        self.flows: dict[tuple[int, int], tuple[float, Generator[object, str | None, object]]] = {}
+        self.flows: dict[tuple[int, int], tuple[float, Generator[object, str | None, object] | Flow | None]] = {}
         """尚在进行的对话流程。
 
-        从(context, sender)到(最后活动时间戳, 程序执行状态)的映射，按最后活动时间从早到晚排序。
+        从(context, sender)到(空闲时限秒数, 程序执行状态)的映射，按最后活动时间从早到晚排序。
+        程序执行状态为None表示这是存入了flow_shelf的Flow。
         """
+        self.flow_shelf: shelve.Shelf | None = None
+        """存放空闲Flow的文件，由open_flows打开。
 
-    def call_handlers(self, handlers: list[Callable], event: Event) -> object:
+        从"context sender"到(最后活动时间戳, 空闲时限秒数, Flow)的映射。没有打开的话，Flow和生成器一样留在内存中。
+        Python 3.13起shelve默认使用的dbm.sqlite3只能在打开它的线程中使用，所以对它的一切操作都经由flow_io进行。
+        """
+        self.flow_io = ThreadPoolExecutor(1, thread_name_prefix="flow_shelf")
+        """读写flow_shelf的专用线程。在持有flows_lock时提交操作，操作就按登记的顺序进行，而磁盘读写不占用锁。"""
+        self.flow_counts = defaultdict[int, int](int)
+        """各会话中尚在进行的对话流程数。"""
+        self.flow_wheel = TimerWheel[tuple[int, int]]()
+        """空闲对话流程的到期时间。正在执行的对话流程不在其中，因此不会在执行中途被关闭。"""
+        self.flows_lock = threading.Lock()
+        """保护flows、flow_counts、flow_wheel和flow_shelf。"""
+        self.recent_commands = TTLCache[tuple[int, int], bool](maxsize=1000, ttl=60.0)
+        """最近发出过命令的(context, sender)。
+
+        命令还在处理队列中排队时，它开启的对话流程尚未加入flows，
+        此时对该流程的回答也要分到command通道，以免过载时被舍弃。
+        """
+        self.flow_timeout = 86400.0
+        """没有用flow_timeout装饰器指定时，对话流程的空闲时限秒数。"""
+        self.max_flows_per_context = 50
+        """每个会话中同时进行的对话流程数上限。达到上限时，关闭该会话中空闲最久的对话流程。"""
+        self.flows_expired = 0
+        self.flows_evicted = 0
+        self.quick_operation = False
+        """是否通过上报请求的响应（快速操作）回复消息和处理申请。
+
+        启用后，消息的单条同步回复和申请的处理结果不再另行调用API，而是作为on_event的返回值交给HTTP服务器，
+        省去一次往返。其余消息照常经由发送队列发出。
+        """
+
+    def call_handlers(self, handlers: list[Callable], event: Event) -> tuple[object, Callable | None]:
+        """依次调用事件处理方法，直到有一个返回真值。
+
+        :returns: (最后一个结果, 得到该结果的方法)。
+        """
         result: object = None
+        handler = None
         for handler in handlers:
             try:
                 result = handler(event)
@@ -245,21 +652,47 @@ class Dispatcher:
                 raise humanity.UIException(str(e) or inspect.getdoc(handler)) from e
             if result:
                 break
-        return result
-
-    def on_event(self, data: dict[str, Any]) -> None:
+        return result, handler
+
+    @staticmethod
+    def key(data: dict[str, Any]) -> tuple[int, int]:
+        """从OneBot事件数据中提取(context, sender)。"""
+        sender = int(data.get("user_id", 0))
+        return -int(data["group_id"]) if "group_id" in data else sender, sender
+
+    def lane(self, data: dict[str, Any]) -> str:
+        """给事件分配处理队列中的优先级通道，参照intake.LANES。"""
+        context, sender = self.key(data)
+        if context == conf.BACKSTAGE:
+            return "backstage"
+        if context > 0:
+            return "private"
+        # 入群申请等要求作出决定的事件不能舍弃。
+        if data.get("post_type") == "request":
+            return "command"
+        if data.get("post_type") == "message":
+            with self.flows_lock:
+                if (context, sender) in self.flows:
+                    return "command"
+            if isinstance(message := data.get("message"), list) and self.match_command(message):
+                self.recent_commands[context, sender] = True
+                return "command"
+            if self.recent_commands.get((context, sender)):
+                return "command"
+        return "passive"
+
+    def on_event(self, data: dict[str, Any]) -> dict[str, Any] | None:
         """接收事件并调用对应的事件处理方法。
 
         :param data: 来自OneBot实现的上报数据。
+        :returns: 启用了快速操作时，要作为上报请求的响应返回给OneBot实现的快速操作。
         """
-        # 在每次收到消息时回收长时间无回复的对话流程。
-        self.gc_flows()
         # 为了原路反馈异常信息，在局部变量中记录消息上下文。
         context = 0
         try:
-            # 从OneBot事件数据中提取context和sender。
-            sender = int(data.get("user_id", 0))
-            context = -int(data["group_id"]) if "group_id" in data else sender
+            context, sender = self.key(data)
+            for handler in self.event_handlers.get("on_event", []):
+                handler(context, sender, data)
 
             result: object = None
             # https://napcat.napneko.icu/onebot/event
@@ -271,11 +704,13 @@ class Dispatcher:
                     # 这个类型的上报只有申请添加好友和申请加入群聊两种。
                     print("收到申请", data)
                     message = [{"type": "text", "data": {"text": text}}]
-                    event = Event(context, sender, humanity.scrub(text), message, 0)
+                    event = Event(context, sender, None, message, 0)
                     for handler in self.event_handlers["on_admission"]:
                         result = handler(event)
                         if result is not None:
                             print("申请处理结果为", result)
+                            if self.quick_operation:
+                                return {"approve": bool(result)}
                             self.bot.call(
                                 "set_friend_add_request" if request_type == "friend" else "set_group_add_request",
                                 flag=flag,
@@ -289,10 +724,8 @@ class Dispatcher:
                 case {"notice_type": "friend_recall" | "group_recall"}:
                     message = self.bot.call("get_msg", message_id=data["message_id"])
                     message = message.get("message", [])
-                    result = self.call_handlers(
-                        self.event_handlers["on_message_deleted"],
-                        Event(context, sender, str(message), message, data["message_id"]),
-                    )
+                    event = Event(context, sender, None, message, data["message_id"])
+                    result, _ = self.call_handlers(self.triggers["on_message_deleted"].select(event), event)
                 case {"notice_type": "offline_file", "file": {"name": name, "size": size, "url": url}}:
                     result = self.dispatch_message(context, sender, f"\a<File {url}#size={size}>{name}", 0)
                 case {
@@ -301,10 +734,20 @@ class Dispatcher:
                 }:
                     url = self.bot.call("get_group_file_url", group_id=-context, file_id=id, busid=busid)["url"]
                     result = self.dispatch_message(context, sender, f"\a<File {url}#size={size}>{name}", 0)
+            if context and isinstance(result, Later):
+                self.later(context, sender, result)
+                result = None
             # 结果是非空值的时候，无论是什么类型都要回复出来，除非结果只是True而已。
             # 编写插件时，因为意外返回了数值或空字符串等，结果完全不知道为什么什么也没有回复的情况太常发生，于是如此判断。
             if context and result is not None and result is not True:
-                self.bot.send(context, format(result))
+                reply = result if codec.is_message(result) else format(result)
+                if (
+                    self.quick_operation
+                    and data.get("post_type") == "message"
+                    and (operation := self.quick_reply(context, reply))
+                ):
+                    return operation
+                self.bot.send(context, reply)
         except humanity.UIException as e:
             if context:
                 self.bot.send(context, format(e))
@@ -321,6 +764,34 @@ class Dispatcher:
             # 再行抛出错误，以便打印错误堆栈到控制台。
             raise
 
+    def later(self, context: int, sender: int, later: Later) -> None:
+        """安排延迟的回复。"""
+
+        def reply() -> None:
+            try:
+                result = later.result() if callable(later.result) else later.result
+                if result is not None and result is not True:
+                    self.bot.send(context, result if codec.is_message(result) else format(result))
+            except humanity.UIException as e:
+                self.bot.send(context, format(e))
+            except Exception as e:
+                self.bot.send(context, f"执行时发生了下列异常。\n{humanity.format_exception(e)}")
+                raise
+
+        self.scheduler.after(later.seconds, lambda: self.defer((context, sender), reply), name="later")
+
+    def quick_reply(self, context: int, text: codec.Message) -> dict[str, Any] | None:
+        """尝试将回复转换为快速操作。
+
+        如果发送队列中还有该会话的消息未发出，快速操作会抢在它们前面，因此这种情况下不使用快速操作。
+        """
+        if self.bot.outbox.busy(context):
+            return None
+        segments, action = self.bot._encode(context, text)
+        if action is not None:
+            return None
+        return {"reply": segments, "auto_escape": False, "at_sender": False}
+
     def dispatch_message(self, context: int, sender: int, message: str | list[dict], message_id: int) -> object:
         """找到并调用某个on_command_×××，抑或是on_message。
 
@@ -339,115 +810,295 @@ class Dispatcher:
         """
 
         if isinstance(message, str):
-            text = message
-            message = [{"type": "text", "data": {"text": text}}]
-        else:
-            r"""转换OneBot消息段列表到木鼠子码字符串。
-
-            木鼠子码用"\a<控制序列 参数值 参数值>"表示。
-            通过使用莫名其妙的控制字符，使控制序列与常规文本冲突的可能性降到极低。
-            因为"< >"三个字符都被HTML占用，被列为URL中禁止使用的字符，因此参数是网址也没有问题。
-            当输入确实包含"\a"时就完蛋了，到那时再自求多福吧。
-
-            木鼠子码最大的好处是，将数据结构统一展平成字符串后，能在整条消息上使用正则表达式，
-            而且不太需要特别处理就能正确应对表情等元素。
-            OneBot协议定义的元素名满是中式英语，参数也不统一，因此不得不花费很多代码来转换。
-            "\a"是Python中为数不多的有单字母缩写且不属于正则表达式空白（r"\s"）的控制字符之一。
-            """
-            text = ""
-            for segment in message:
-                # https://napcat.napneko.icu/onebot/sement
-                match segment:
-                    case {"type": "text", "data": {"text": str(x)}}:
-                        text += x
-                    case {"type": "face", "data": {"id": x}}:
-                        text += f"\a<Emoticon {x}>"
-                    case {"type": "at", "data": {"qq": x}}:
-                        text += f"\a<Mention {x}>"  # 包含Mention all
-                    case {
-                        "type": "image",
-                        "data": {"summary": alt, "key": str(x), "emoji_id": str(y), "emoji_package_id": int(z)},
-                    }:
-                        text += f"\a<Sticker {x} {y} {z}>{alt}"
-                    case {"type": "rps", "data": {"result": x}}:
-                        text += f"\a<Sticker RPS {x}>"
-                    case {"type": "dice", "data": {"result": x}}:
-                        text += f"\a<Sticker Dice {x}>"
-                    case {"type": "image", "data": {"url": url, "file_size": size}}:
-                        text += f"\a<Image {url}#size={size}>"
-                    case {"type": "record", "data": {"path": path}}:
-                        text += f"\a<Audio {path}>"
-                    case {"type": "video", "data": {"url": url}}:
-                        text += f"\a<Video {url}>"
-                    case {"type": "file", "data": {"file_id": x}}:
-                        text += f"\a<File {x}>"
-                    case {"type": "poke"} as a:
-                        print("POKE还有其他属性吗？", a)
-                        text += "\a<Poke>"
-                    case {"type": "json", "data": {"data": x}}:
-                        text += f"\a<Special>{x}"
-                    case {"type": "reply", "data": {"id": x}}:
-                        text = f"\a<Quote {x}>" + text
-                    case {"type": "forward", "data": {"content": x}}:
-                        print("收到合并转发", x)
-                        text += "\a<Begin quote>"
-                    case {"type": x, "data": data}:
-                        print("警告：未知的消息元素，data字段 =", data)
-                        text += f"\a<{x}>"
-        text = humanity.scrub(text)
-
-        result = None
+            message = [{"type": "text", "data": {"text": message}}]
+        event = Event(context, sender, None, message, message_id)
+
+        key = context, sender
+        # 取出对话流程时停止计时，以免它在执行中途到期。
+        loading = None
+        with self.flows_lock:
+            if (flow := self.flows.get(key)) is not None:
+                self.flow_wheel.cancel(key)
+                if flow[1] is None and self.flow_shelf is not None:
+                    loading = self.shelf_job(self.load_flow, key)
+        if flow is not None:
+            timeout, generator = flow
+            if generator is None and loading is not None:
+                generator = loading.result()
+            if generator is None:
+                with self.flows_lock:
+                    self.remove_flow(key)
+            flow = None if generator is None else (timeout, generator)
         # 如果当前上下文中的发送者没有仍在进行的对话流程，有可能因本条消息启动新的对话流程。
-        if (context, sender) not in self.flows:
-            match humanity.parse_command(text, self.command_names):
-                case command_name, arguments:
+        if flow is None:
+            match self.match_command(message):
+                case command_name, offset:
                     handlers = self.command_handlers[command_name]
-                    event = Event(context, sender, arguments, message, message_id)
+                    command = Event(context, sender, None, message, message_id, offset)
+                    result, handler = self.call_handlers(handlers, command)
                 case None:
-                    handlers = self.event_handlers["on_message"]
-                    event = Event(context, sender, text, message, message_id)
-            result = self.call_handlers(handlers, event)
+                    result, handler = self.call_handlers(self.triggers["on_message"].select(event), event)
             # 是否启动了新的对话流程？
-            if isinstance(result, Generator):
-                self.flows[context, sender] = time.time(), result
-                text = None  # 向Generator首次send的值必须为None
-        # 当前上下文中的发送者有无仍在进行（或上面刚启动）的对话流程？
-        if (context, sender) in self.flows:
-            try:
-                _, generator = self.flows[context, sender]
-                result = generator.send(text)
-                if result:
-                    del self.flows[context, sender]  # 确保插入到最后
-                    self.flows[context, sender] = time.time(), generator
-            except StopIteration as e:
-                result = e.value
-                del self.flows[context, sender]
+            if not isinstance(result, Generator | Flow):
+                return result
+            timeout, generator = getattr(handler, "flow_timeout", self.flow_timeout), result
+            text = None
+        else:
+            timeout, generator = flow
+            text = event.text
+        # 向对话流程发送消息。向Generator首次send的值必须为None。
+        alive = False
+        try:
+            result = generator.send(text)
+            alive = True
+        except StopIteration as e:
+            result = e.value
+        finally:
+            if alive:
+                self.keep_flow(key, timeout, generator)
+            elif flow is not None:
+                with self.flows_lock:
+                    self.remove_flow(key)
         return result
 
-    def gc_flows(self) -> None:
-        """强制终止超过一天仍未结束的对话流程。"""
-        while self.flows:
-            key, (t, _) = next(iter(self.flows.items()))
-            if t < time.time() - 86400:
-                del self.flows[key]
+    def keep_flow(
+        self, key: tuple[int, int], timeout: float, generator: Generator[object, str | None, object] | Flow
+    ) -> None:
+        """登记或更新空闲下来的对话流程，并开始计时。打开了flow_shelf的话，Flow存入其中。"""
+        victim = None
+        saving = None
+        with self.flows_lock:
+            context, _ = key
+            if key in self.flows:
+                del self.flows[key]  # 确保插入到最后
             else:
-                break
+                if self.flow_counts[context] >= self.max_flows_per_context:
+                    # 只关闭空闲的对话流程，正在执行的对话流程由执行它的线程负责。
+                    oldest = next((k for k in self.flows if k[0] == context and k in self.flow_wheel), None)
+                    if oldest is not None:
+                        victim = oldest, self.remove_flow(oldest)
+                        self.flows_evicted += 1
+                self.flow_counts[context] += 1
+            self.flows[key] = timeout, generator
+            self.flow_wheel.schedule(key, timeout)
+            if isinstance(generator, Flow) and self.flow_shelf is not None:
+                saving = self.shelf_job(self.save_flow, key, timeout, generator)
+        if victim is not None:
+            print("会话中的对话流程过多，关闭", victim[0])
+            self.close_flow(victim[1])
+        # 保存期间Flow可能已被取出执行或被关闭，那样的话不能释放内存中的Flow。
+        if saving is not None and saving.result():
+            with self.flows_lock:
+                if key in self.flow_wheel and self.flows.get(key, (0.0, None))[1] is generator:
+                    self.flows[key] = timeout, None
+
+    def remove_flow(
+        self, key: tuple[int, int]
+    ) -> Generator[object, str | None, object] | Flow | Future[Flow | None] | None:
+        """删除对话流程的记录。调用方须持有flows_lock。
+
+        :returns: 对话流程的执行状态，以便关闭。存入了flow_shelf的Flow会在flow_io中取出，此时返回取出它的Future。
+        """
+        _, generator = self.flows.pop(key)
+        self.flow_wheel.cancel(key)
+        self.flow_counts[key[0]] -= 1
+        if not self.flow_counts[key[0]]:
+            del self.flow_counts[key[0]]
+        if self.flow_shelf is not None and not isinstance(generator, Generator):
+            taking = self.shelf_job(self.take_flow, key, generator is None)
+            if generator is None:
+                return taking
+        return generator
+
+    def shelf_job[T](self, function: Callable[..., T], *args: object) -> Future[T]:
+        """在flow_io中对flow_shelf执行操作，function的第一个参数是flow_shelf。调用方须持有flows_lock。"""
+        return self.flow_io.submit(function, self.flow_shelf, *args)
+
+    @staticmethod
+    def shelf_key(key: tuple[int, int]) -> str:
+        """flow_shelf中的键。"""
+        return f"{key[0]} {key[1]}"
+
+    def save_flow(self, shelf: shelve.Shelf, key: tuple[int, int], timeout: float, flow: Flow) -> bool:
+        """将Flow存入flow_shelf。在flow_io中执行。
+
+        :returns: 是否保存成功。无法保存的Flow留在内存中。
+        """
+        try:
+            shelf[self.shelf_key(key)] = time.time(), timeout, flow
+            return True
+        except Exception:  # noqa: BLE001
+            print("无法保存对话流程，留在内存中", key)
+            traceback.print_exc()
+            shelf.pop(self.shelf_key(key), None)
+            return False
+
+    def load_flow(self, shelf: shelve.Shelf, key: tuple[int, int]) -> Flow | None:
+        """从flow_shelf中载入Flow。在flow_io中执行。无法载入的Flow会被丢弃。"""
+        try:
+            _, _, flow = shelf[self.shelf_key(key)]
+            flow.plugin = self.plugins[flow.owner]
+            return flow
+        except Exception:  # noqa: BLE001
+            print("无法载入对话流程，丢弃", key)
+            traceback.print_exc()
+            shelf.pop(self.shelf_key(key), None)
+            return None
+
+    def take_flow(self, shelf: shelve.Shelf, key: tuple[int, int], load: bool) -> Flow | None:
+        """从flow_shelf中删除Flow。在flow_io中执行。
+
+        :param load: 是否先载入Flow，以便关闭。
+        """
+        flow = self.load_flow(shelf, key) if load and self.shelf_key(key) in shelf else None
+        shelf.pop(self.shelf_key(key), None)
+        return flow
+
+    def open_flows(self, path: str = "data_flows") -> None:
+        """打开存放空闲Flow的文件，并恢复其中上次运行时尚未结束的对话流程。
+
+        恢复的对话流程的空闲时限从上次活动时起算，因此在停机期间到期的对话流程会被立即关闭。
+        """
+
+        def restore() -> tuple[shelve.Shelf, list[tuple[float, tuple[int, int], float]]]:
+            # 恢复途中出错的话关闭文件，成功的话则保持打开。
+            with contextlib.ExitStack() as stack:
+                shelf = stack.enter_context(shelve.open(path))
+                restored: list[tuple[float, tuple[int, int], float]] = []
+                for name in list(shelf):
+                    try:
+                        t, timeout, flow = shelf[name]
+                        context, sender = map(int, name.split())
+                        if flow.owner not in self.plugins:
+                            raise LookupError(f"插件{flow.owner}不存在")
+                    except Exception as e:  # noqa: BLE001
+                        print("丢弃无法恢复的对话流程", name, humanity.format_exception(e))
+                        del shelf[name]
+                        continue
+                    restored.append((t, (context, sender), timeout))
+                stack.pop_all()
+            return shelf, restored
+
+        shelf, restored = self.flow_io.submit(restore).result()
+        now = time.time()
+        restored.sort()
+        with self.flows_lock:
+            self.flow_shelf = shelf
+            for t, key, timeout in restored:
+                if key not in self.flows:
+                    self.flows[key] = timeout, None
+                    self.flow_counts[key[0]] += 1
+                    self.flow_wheel.schedule(key, max(0.0, t + timeout - now))
+        print("恢复了", len(restored), "个对话流程")
+
+    def close(self) -> None:
+        """关闭存放空闲Flow的文件。尚未结束的Flow留在其中，下次open_flows时恢复。"""
+        closing = None
+        with self.flows_lock:
+            if self.flow_shelf is not None:
+                closing = self.shelf_job(shelve.Shelf.close)
+                self.flow_shelf = None
+        # 之前提交的操作都会先于关闭完成。
+        if closing is not None:
+            closing.result()
+
+    @staticmethod
+    def close_flow(generator: Generator[object, str | None, object] | Flow | Future[Flow | None] | None) -> None:
+        """关闭对话流程，使其在yield处收到GeneratorExit。对话流程在收拾残局时出错不影响其他对话流程。"""
+        try:
+            if isinstance(generator, Future):
+                generator = generator.result()
+            if generator is None:
+                return
+            generator.close()
+        except Exception:  # noqa: BLE001
+            print("关闭对话流程时出错")
+            traceback.print_exc()
+
+    def match_command(self, message: list[dict[str, Any]]) -> tuple[str, int] | None:
+        """判断消息是否是命令。
+
+        命令名必定在消息开头的文本中，所以只转换开头连续的文本消息段，而不必转换整条消息。
+        会被移到开头的消息段（如回复）使转换得到的文本不以命令符开头，这样的消息不是命令。
+
+        :returns: (命令名, 参数在转换得到的完整文本中的位置)。
+        """
+        if any(segment.get("type") in codec.prefixes for segment in message):
+            return None
+        head = "".join(
+            segment["data"]["text"]
+            for segment in itertools.takewhile(lambda segment: segment.get("type") == "text", message)
+        )
+        return humanity.match_command(humanity.scrub(head), self.commands)
+
+    def expire_flows(self) -> None:
+        """关闭空闲超时的对话流程。应当每隔flow_wheel.resolution秒在后台调用一次，不必在处理事件时调用。"""
+        with self.flows_lock:
+            expired = [self.remove_flow(key) for key in self.flow_wheel.advance()]
+            self.flows_expired += len(expired)
+        for generator in expired:
+            self.close_flow(generator)
+
+    def flow_stats(self) -> dict[str, int]:
+        """对话流程的数目和大致占用的内存。
+
+        内存只计入生成器及其栈帧中的局部变量（或Flow及其数据）本身的大小，不计入它们引用的其他对象，
+        所以只是粗略的估计。存入了flow_shelf的Flow不占用内存。
+        """
+        with self.flows_lock:
+            generators = [generator for _, generator in self.flows.values() if generator is not None]
+            stats = {
+                "flows": len(self.flows),
+                "shelved": len(self.flows) - len(generators),
+                "contexts": len(self.flow_counts),
+                "max_per_context": self.max_flows_per_context,
+                "expired": self.flows_expired,
+                "evicted": self.flows_evicted,
+            }
+        memory = 0
+        for generator in generators:
+            memory += sys.getsizeof(generator)
+            if isinstance(generator, Flow):
+                memory += sys.getsizeof(generator.data) + sum(map(sys.getsizeof, generator.data.values()))
+            else:
+                memory += sum(map(sys.getsizeof, inspect.getgeneratorlocals(generator).values()))
+        return stats | {"memory": memory}
 
 
 class NameCacheUpdater(Plugin):
     """与Plugin基类联合工作的必备插件。"""
 
+    prefetch = False
+    """是否在一段时间内第一次收到某个群的消息时，在后台缓存该群全体成员的群名片。"""
+
+    def __init__(self) -> None:
+        self.prefetched = TTLCache[int, bool](maxsize=1000, ttl=3600.0)
+        """最近预先缓存过成员名称的群。"""
+
     def on_event(self, context: int, sender: int, data: dict[str, Any]) -> bool:
         # 如果有详细的发送者信息，更新名称缓存。
         if "sender" in data:
             nickname = data["sender"].get("nickname", "")
             self.bot._name_cache[sender] = self.bot._name_cache[sender, sender] = nickname
             self.bot._name_cache[context, sender] = data["sender"].get("card") or nickname
+        if self.prefetch and context < 0 and self.prefetched.get(context) is None:
+            self.prefetched[context] = True
+            self.bot.pool.submit(self.warm, context)
         return False
 
+    def warm(self, context: int) -> None:
+        try:
+            self.bot.warm_names(context)
+        except Exception:  # noqa: BLE001
+            print("预先缓存群成员名称失败", context)
+            traceback.print_exc()
+
 
 class Logger(Plugin):
-    """调试用，在控制台中输出消息的内部表示。"""
+    """调试用，在控制台中输出消息的内部表示。
+
+    Event的repr不会读取text，因此这里不会迫使每条消息都转换为木鼠子码。
+    """
 
     def on_message(self, event: Event):
         print(repr(event))
@@ -509,3 +1160,90 @@ def privileged(
         return decorated
 
     return decorator
+
+
+def flow_timeout(seconds: float) -> Callable[[CallableT], CallableT]:
+    """使用此装饰器指定命令启动的对话流程的空闲时限。
+
+    对话流程超过这么多秒没有收到下一条消息的话，就会被关闭，生成器在yield处收到GeneratorExit。
+
+        @pykinezumiko.flow_timeout(600)
+        def on_command_foo(self, event):
+            try:
+                name = yield "你叫什么名字？"
+            except GeneratorExit:
+                self.bot.send(event.context, "不说算了。")
+                raise
+    """
+
+    def decorator(f: CallableT) -> CallableT:
+        f.flow_timeout = seconds  # type: ignore
+        return f
+
+    return decorator
+
+
+@dataclass
+class Trigger:
+    """事件处理方法的触发条件，由trigger装饰器添加到方法的triggers属性上。"""
+
+    pattern: regex.Pattern | None
+    """匹配事件文本的正则表达式，不含全局标志。关键词都已转义并合并进来。"""
+    segments: frozenset[str]
+    """OneBot消息段种类。"""
+
+    def matches(self, text: str, segments: Container[str]) -> bool:
+        return bool(self.pattern and self.pattern.search(text)) or any(s in segments for s in self.segments)
+
+
+def trigger(
+    *patterns: str,
+    keywords: Iterable[str] = (),
+    segments: Iterable[str] = (),
+) -> Callable[[CallableT], CallableT]:
+    r"""使用此装饰器声明on_message等事件处理方法的触发条件，只在事件符合任一条件时调用该方法。
+
+    Dispatcher会把所有条件合并成一个正则表达式，因此不论有多少插件，对多数不相关的消息只需搜索一次。
+    没有用此装饰器的方法对所有事件都会被调用。
+
+        @pykinezumiko.trigger(r"BV1\w{9}", keywords=["b23.tv"], segments=["image"])
+        def on_message(self, event):
+            ...
+
+    :param patterns: 在事件文本中搜索的正则表达式。不能使用全局的内联标志，但可以使用(?i:…)这样的局部标志。
+    :param keywords: 在事件文本中搜索的字符串。
+    :param segments: 消息中含有这些种类的OneBot消息段时触发，例如"image"。
+    """
+    alternatives = [*patterns, *map(regex.escape, keywords)]
+    condition = Trigger(
+        regex.compile("|".join(f"(?:{p})" for p in alternatives)) if alternatives else None,
+        frozenset(segments),
+    )
+
+    def decorator(f: CallableT) -> CallableT:
+        f.trigger = condition  # type: ignore
+        return f
+
+    return decorator
+
+
+class Triggers:
+    """同一种事件的所有处理方法的触发条件，合并成一个正则表达式和一个消息段种类集合以便快速筛选。"""
+
+    def __init__(self, handlers: list[Callable]) -> None:
+        self.handlers = handlers
+        self.triggers: list[Trigger | None] = [getattr(handler, "trigger", None) for handler in handlers]
+        self.untriggered = [h for h, t in zip(handlers, self.triggers) if t is None]
+        """没有触发条件的处理方法。事件不符合任何触发条件时，只调用这些方法。"""
+        patterns = [t.pattern.pattern for t in self.triggers if t and t.pattern]
+        self.pattern = regex.compile("|".join(patterns)) if patterns else None
+        self.segments = frozenset().union(*(t.segments for t in self.triggers if t))
+
+    def select(self, event: Event) -> list[Callable]:
+        """按原有顺序给出要对该事件调用的处理方法。"""
+        if len(self.untriggered) == len(self.handlers):
+            return self.handlers
+        segments = {segment.get("type") for segment in event._json} if self.segments else set()
+        if not (self.pattern and self.pattern.search(event.text)) and self.segments.isdisjoint(segments):
+            return self.untriggered
+        return [h for h, t in zip(self.handlers, self.triggers) if t is None or t.matches(event.text, segments)]
@@ -11,26 +11,66 @@ import os
 import pkgutil
 import sys
 import traceback
+from collections.abc import Callable
+from concurrent.futures import Future
+from functools import partial
+from typing import Any
 
 import uvicorn
 from starlette.applications import Starlette
 from starlette.endpoints import HTTPEndpoint
 from starlette.requests import Request
 from starlette.responses import JSONResponse, PlainTextResponse, Response
-from starlette.routing import Route
+from starlette.routing import Route, WebSocketRoute
 
-from . import Bot, Dispatcher, Plugin, conf
+from . import Bot, Dispatcher, Plugin, Scheduler, conf, typesetting
 from . import plugins as plugins_module
+from .intake import Intake, Overloaded
+from .transport import (
+    ForwardWebSocketTransport,
+    HTTPTransport,
+    ReverseWebSocketTransport,
+    Transport,
+    WebSocketTransport,
+)
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--cwd", type=str, default=".", help="保存运行数据的工作目录")
 parser.add_argument("--announce", type=str, default="", help="启动后向管理群发送通知")
+parser.add_argument(
+    "--transport",
+    choices=["http", "ws", "ws-reverse"],
+    default="http",
+    help="与OneBot实现的连接方式：HTTP、正向WebSocket、反向WebSocket",
+)
+parser.add_argument("--onebot", type=str, default="", help="OneBot实现的地址，默认为127.0.0.1:5700")
+parser.add_argument("--onebot-uds", type=str, default="", help="经由此Unix域套接字连接OneBot实现的HTTP API")
+parser.add_argument("--uds", type=str, default="", help="在此Unix域套接字而非5701端口上接收上报")
+parser.add_argument("--quick-operation", action="store_true", help="通过上报请求的响应回复消息")
+parser.add_argument("--workers", type=int, default=8, help="同时处理事件的线程数")
+parser.add_argument("--capacity", type=int, default=1000, help="处理队列中最多排队的事件数")
+parser.add_argument(
+    "--overload",
+    choices=["skip", "drop-oldest", "reject"],
+    default="skip",
+    help="处理队列满时：不再扫描普通群聊消息、舍弃最早的普通群聊消息、拒绝所有事件",
+)
 args = parser.parse_args()
 os.makedirs(args.cwd, exist_ok=True)
 os.chdir(args.cwd)
 print("工作目录 =", os.getcwd())
 
-bot = Bot()
+transport: Transport
+match args.transport:
+    case "http":
+        transport = HTTPTransport(args.onebot or "http://127.0.0.1:5700", args.onebot_uds or None)
+    case "ws":
+        transport = ForwardWebSocketTransport(args.onebot or "ws://127.0.0.1:5700")
+    case _:
+        transport = ReverseWebSocketTransport()
+bot = Bot(transport)
+bot.load_names()
+scheduler = Scheduler()
 
 for p in sorted(m.name for m in pkgutil.iter_modules(plugins_module.__path__)):
     print(f"加载插件模块 {p}")
@@ -50,16 +90,20 @@ def leaf_subclasses(cls: type) -> list[type]:
 
 plugins: list[Plugin] = []
 Plugin.bot = bot
+Plugin.scheduler = scheduler
 for p in leaf_subclasses(Plugin):
     print(f"加载插件类 {p.__name__}")
     try:
         p = p()
         p.bot = bot
+        p.scheduler = scheduler
+        scheduler.register(p)
         plugins.append(p)
     except Exception:
         print("实例化插件类时发生错误，继续……")
         traceback.print_exc()
 del Plugin.bot
+del Plugin.scheduler
 
 # 上述过程中易碎的细节：
 # • 插件模块相互独立，从而按导入顺序加载。
@@ -68,7 +112,47 @@ del Plugin.bot
 # • Python 3.9起，文档明确指出__subclasses__按子类定义先后顺序返回子类列表。
 # • leaf_subclasses函数返回列表从而保持顺序。
 
-dispatcher = Dispatcher(bot, plugins)
+dispatcher = Dispatcher(bot, plugins, scheduler)
+dispatcher.quick_operation = args.quick_operation
+dispatcher.open_flows()
+scheduler.every(dispatcher.flow_wheel.resolution, dispatcher.expire_flows, name="expire flows")
+scheduler.every(600.0, bot.save_names, name="save names")
+
+
+intake = Intake(args.workers, capacity=args.capacity, policy=args.overload)
+# 到期的延迟回复也放入处理队列，与同一发送者的其他事件按顺序处理。
+dispatcher.defer = lambda key, action: intake.submit(key, action, "private" if key[0] > 0 else "command")
+
+
+def submit_event(action: Callable[[dict[str, Any]], object], data: dict[str, Any]) -> Future:
+    """将事件放入处理队列。同一会话中同一发送者的事件按收到的顺序逐个处理。"""
+    try:
+        key = Dispatcher.key(data)
+        lane = dispatcher.lane(data)
+    except Exception:  # noqa: BLE001
+        # 无法识别的事件也交给Dispatcher，由它报告错误。
+        key, lane = None, "passive"
+    return intake.submit(key, partial(action, data), lane)
+
+
+def handle_event(data: dict[str, Any]) -> None:
+    """处理经由WebSocket收到的事件。WebSocket没有响应可用，快速操作通过API执行。"""
+    try:
+        if operation := dispatcher.on_event(data):
+            bot.call(".handle_quick_operation", context=data, operation=operation)
+    except Exception:  # noqa: BLE001
+        traceback.print_exc()
+
+
+def receive_event(data: dict[str, Any]) -> None:
+    try:
+        submit_event(handle_event, data)
+    except Overloaded as e:
+        print(e, "，丢弃事件", sep="")
+
+
+if isinstance(transport, WebSocketTransport):
+    transport.on_event = receive_event
 
 
 class Root(HTTPEndpoint):
@@ -78,6 +162,12 @@ class Root(HTTPEndpoint):
                 "消息处理端": "已启动",
                 "pid": os.getpid(),
                 "argv": sys.argv,
+                "处理队列": intake.stats(),
+                "对话流程": dispatcher.flow_stats(),
+                "计划任务": scheduler.stats(),
+                "发送队列": bot.outbox.stats(),
+                "名称缓存": bot._name_cache.stats() | {"shared": bot._flights.shared},
+                "图片缓存": typesetting.render_cache.stats(),
                 "request_headers": dict(request.headers),
             }
         )
@@ -88,8 +178,12 @@ class Root(HTTPEndpoint):
         # 作为后来居上的语言功能，Python中的异步复杂度远远高于JavaScript这样原本就只有异步的语言。
         # 随着GIL限制解除，线程的优势愈发显著，我甚至相信异步Python将来会被废弃。
         # 为了用上更现代的新框架的同时维持业务代码的编写体验不变，我选择把异步病毒隔离。
-        await asyncio.to_thread(dispatcher.on_event, await request.json())
-        return PlainTextResponse("")
+        try:
+            future = submit_event(dispatcher.on_event, await request.json())
+        except Overloaded as e:
+            return PlainTextResponse(str(e), 503)
+        operation = await asyncio.wrap_future(future)
+        return JSONResponse(operation) if operation else PlainTextResponse("")
 
 
 @contextlib.asynccontextmanager
@@ -97,6 +191,14 @@ async def lifespan(app: Starlette):
     if args.announce:
         bot.send(conf.BACKSTAGE, args.announce)
     yield
+    scheduler.close()
+    # 以下步骤会阻塞，要在其他线程中执行。反向WebSocket传输层在事件循环中发送消息，阻塞事件循环的话，
+    # 待发送的消息就都只能等到超时。
+    if not await asyncio.to_thread(intake.join, 10.0):
+        print("处理队列未能及时清空")
+    await asyncio.to_thread(bot.close)
+    await asyncio.to_thread(bot.save_names)
+    await asyncio.to_thread(dispatcher.close)
 
 
 uvicorn.Server(
@@ -104,10 +206,16 @@ uvicorn.Server(
         Starlette(
             routes=[
                 Route("/", Root),
+                *(
+                    [WebSocketRoute("/", transport.serve)]
+                    if isinstance(transport, ReverseWebSocketTransport)
+                    else []
+                ),
             ],
             lifespan=lifespan,
         ),
         port=5701,
+        uds=args.uds or None,
         log_level="info",
     )
 ).run()
@@ -0,0 +1,475 @@
+"""性能测试。
+
+默认不执行。要查看结果，请运行uv run pytest -m benchmark -s。
+"""
+
+import http.server
+import json
+import math
+import os
+import socketserver
+import tempfile
+import threading
+import timeit
+import tracemalloc
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass
+from itertools import pairwise
+from typing import Any
+
+import pytest
+import regex
+from PIL import Image, ImageDraw
+
+from . import Dispatcher, Event, Flow, Plugin, codec, conf, typesetting
+from .humanity import CommandTrie, normalize, parse_command, scrub
+from .transport import HTTPTransport
+
+pytestmark = pytest.mark.benchmark()
+
+
+def bench(f: Callable[[], object], number: int = 100) -> float:
+    """返回f每次调用所需的秒数，取若干轮中最快的一轮。"""
+    return min(timeit.repeat(f, number=number, repeat=5)) / number
+
+
+def report(name: str, seconds: float) -> None:
+    print(f"{name:<32} {seconds * 1e6:12.1f} µs")
+
+
+def allocated(f: Callable[[], object], number: int = 100) -> float:
+    """返回f的每个返回值平均占用的字节数。测量期间保留所有返回值，以便计入它们引用的新分配的对象。"""
+    results = []
+    tracemalloc.start()
+    try:
+        for _ in range(number):
+            results.append(f())
+        return tracemalloc.get_traced_memory()[1] / number
+    finally:
+        tracemalloc.stop()
+
+
+class FakeOneBot(http.server.BaseHTTPRequestHandler):
+    """对任何请求都回答成功的假OneBot实现。"""
+
+    protocol_version = "HTTP/1.1"
+    # 缓冲写入，使响应头与响应体一同发出，以免TCP的Nagle算法与延迟确认相互等待。
+    wbufsize = 65536
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"status": "ok", "retcode": 0, "data": {}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def test_传输层延迟():
+    with (
+        http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeOneBot) as tcp,
+        tempfile.TemporaryDirectory() as directory,
+        UnixHTTPServer(os.path.join(directory, "onebot.sock"), FakeOneBot) as uds,
+    ):
+        for server in (tcp, uds):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = tcp.server_address[:2]
+        transports = {
+            "TCP": HTTPTransport(f"http://{host}:{port}"),
+            "Unix域套接字": HTTPTransport(
+                uds=os.path.join(directory, "onebot.sock"), base_url="http://localhost"
+            ),
+        }
+        try:
+            for name, transport in transports.items():
+                assert transport.request("get_status", {})["status"] == "ok"
+                report(
+                    f"HTTPTransport.request（{name}）",
+                    bench(lambda transport=transport: transport.request("get_status", {})),
+                )
+        finally:
+            for transport in transports.values():
+                transport.close()
+            tcp.shutdown()
+            uds.shutdown()
+
+
+def legacy_encode(text: str) -> list[dict[str, Any]]:
+    """codec模块出现前Bot.send中的转换代码，去掉了文件上传。"""
+    segments: list[dict[str, Any]] = []
+    for match in regex.finditer(r"[^\a]+|\a<([^<>]*)>", text):
+        if args := match.group(1):
+            args = args.split(" ")
+        match args:
+            case None:
+                segments.append({"type": "text", "data": {"text": match.group()}})
+            case ["Emoticon", x]:
+                segments.append({"type": "face", "data": {"id": x}})
+            case ["Mention", str(x)]:
+                segments.append({"type": "at", "data": {"qq": x}})
+            case ["Image", url]:
+                segments.append({"type": "image", "data": {"url": url}})
+            case ["Quote", x]:
+                segments.append({"type": "reply", "data": {"id": x}})
+            case _:
+                segments.append({"type": "face", "data": {"id": "60"}})
+    return segments
+
+
+def legacy_decode(message: list[dict[str, Any]]) -> str:
+    """codec模块出现前Dispatcher.dispatch_message中的转换代码，只保留了常见的消息段。"""
+    text = ""
+    for segment in message:
+        match segment:
+            case {"type": "text", "data": {"text": str(x)}}:
+                text += x
+            case {"type": "face", "data": {"id": x}}:
+                text += f"\a<Emoticon {x}>"
+            case {"type": "at", "data": {"qq": x}}:
+                text += f"\a<Mention {x}>"
+            case {"type": "image", "data": {"url": url, "file_size": size}}:
+                text += f"\a<Image {url}#size={size}>"
+            case {"type": "reply", "data": {"id": x}}:
+                text = f"\a<Quote {x}>" + text
+            case {"type": x}:
+                text += f"\a<{x}>"
+    return text
+
+
+@pytest.mark.parametrize("n", [10, 1000, 10000])
+def test_木鼠子码转换(n: int):
+    text = "\a<Quote 1>" + "".join(f"第{i}行\a<Emoticon {i % 300}>\a<Mention {i}>\n" for i in range(n))
+    segments = codec.encode(text)
+    assert segments == legacy_encode(text)
+    assert codec.decode(segments) == legacy_decode(segments) == text
+    number = max(1, 10000 // n)
+    report(f"encode（旧，{n}段）", bench(lambda: legacy_encode(text), number))
+    report(f"encode（新，{n}段）", bench(lambda: codec.encode(text), number))
+    report(f"decode（旧，{n}段）", bench(lambda: legacy_decode(segments), number))
+    report(f"decode（新，{n}段）", bench(lambda: codec.decode(segments), number))
+
+
+def legacy_parse_command(text: str, sorted_normalized_command_names: Sequence[str]) -> tuple[str, str] | None:
+    """CommandTrie出现前的parse_command。"""
+    match = regex.match(r"[.。!！]", text)
+    if not match:
+        return None
+    text = text[match.end() :]
+    command = normalize(text)
+    index = bisect_right(sorted_normalized_command_names, command) - 1
+    if index < 0:
+        return None
+    command_name = sorted_normalized_command_names[index]
+    if not command.startswith(command_name):
+        return None
+    index = bisect_left(range(len(text)), command_name, key=lambda i: normalize(text[:i]))
+    if index:
+        grapheme = regex.match(r"\X", text, pos=index - 1)
+        assert grapheme
+        index = grapheme.end()
+    if normalize(text[:index]) != command_name:
+        return None
+    return command_name, text[index:].strip()
+
+
+@pytest.mark.parametrize("n", [100, 1000, 10000])
+def test_命令解析(n: int):
+    names = sorted(normalize(name) for name in ["clock", "debug s", "debug to", "debug json", "reload", "roll"])
+    trie = CommandTrie(names)
+    text = ".debug to 114514 " + "木鼠子" * (n // 3)
+    assert parse_command(text, trie) == legacy_parse_command(text, names)
+    number = max(1, 1000 // n)
+    report(f"parse_command（旧，{len(text)}字）", bench(lambda: legacy_parse_command(text, names), number))
+    report(f"parse_command（新，{len(text)}字）", bench(lambda: parse_command(text, trie), number))
+
+
+@dataclass
+class LegacyEvent:
+    context: int
+    sender: int
+    text: str
+    _json: list[dict[str, Any]]
+    id: int
+
+
+@pytest.mark.parametrize("n", [10, 100, 1000])
+def test_惰性事件(n: int):
+    dispatcher = Dispatcher(None, [])  # type: ignore
+    dispatcher.commands = CommandTrie(["clock", "debugs", "roll"])
+    message = [
+        segment
+        for i in range(n)
+        for segment in ({"type": "text", "data": {"text": f"第{i}行"}}, {"type": "face", "data": {"id": "1"}})
+    ]
+
+    def legacy() -> LegacyEvent:
+        """Event变为惰性之前，dispatch_message在调用插件前所做的事情。"""
+        text = scrub(codec.decode(message))
+        match parse_command(text, dispatcher.commands):
+            case _, arguments:
+                return LegacyEvent(0, 0, arguments, message, 0)
+        return LegacyEvent(0, 0, text, message, 0)
+
+    def lazy() -> Event:
+        match dispatcher.match_command(message):
+            case _, offset:
+                return Event(0, 0, None, message, 0, offset)
+        return Event(0, 0, None, message, 0)
+
+    assert lazy().text == legacy().text
+    number = max(1, 10000 // n)
+    report(f"准备事件（旧，{n}段）", bench(legacy, number))
+    report(f"准备事件（新，{n}段）", bench(lazy, number))
+    print(f"{f'内存分配（旧，{n}段）':<32} {allocated(legacy):12.0f} B")
+    print(f"{f'内存分配（新，{n}段）':<32} {allocated(lazy):12.0f} B")
+
+
+class Questionnaire(Plugin):
+    """同一个问卷，分别用生成器和Flow写成。"""
+
+    def on_command_generator(self, event: Event):
+        name = yield "你叫什么名字？"
+        age = yield "你几岁了？"
+        return f"{name}，{age}岁。"
+
+    def on_command_flow(self, event: Event):
+        return Flow(self.ask_name, "你叫什么名字？")
+
+    def ask_name(self, flow: Flow, text: str):
+        flow.data["name"] = text
+        return flow.goto(self.ask_age, "你几岁了？")
+
+    def ask_age(self, flow: Flow, text: str):
+        return f"{flow.data['name']}，{text}岁。"
+
+
+@pytest.mark.parametrize("command", ["generator", "flow"])
+def test_空闲对话流程(command: str):
+    n = 1000
+    bot = type("NullBot", (), {"send": lambda self, context, text: None})()
+    with tempfile.TemporaryDirectory() as directory:
+        dispatcher = Dispatcher(bot, [Questionnaire()])  # type: ignore
+        dispatcher.open_flows(os.path.join(directory, "flows"))
+
+        def converse(sender: int, text: str) -> None:
+            dispatcher.dispatch_message(sender, sender, [{"type": "text", "data": {"text": text}}], 0)
+
+        tracemalloc.start()
+        try:
+            for sender in range(1, n + 1):
+                converse(sender, "." + command)
+                converse(sender, "木鼠子")
+            memory = tracemalloc.get_traced_memory()[0] / n
+        finally:
+            tracemalloc.stop()
+        senders = iter(range(1, n + 1))
+        seconds = bench(lambda: converse(next(senders), "14"), n // 5)
+        dispatcher.close()
+    print(f"{f'空闲对话流程内存（{command}）':<32} {memory:12.0f} B")
+    report(f"结束对话流程（{command}）", seconds)
+
+
+def legacy_measure(text: str) -> typesetting.Glue:
+    """字宽表出现前的typesetting.measure，去掉了缓存。"""
+    font = typesetting.font
+    width = font.getlength(text)
+    space = sum(font.getlength(match.group()) for match in regex.finditer(r"\s+", text))
+    stretch = space * 0.6 + text.count("\u200b") * 2.5
+    return typesetting.Glue(width, stretch, space * 0.2)
+
+
+PARAGRAPH = (
+    "木鼠子是一个QQ机器人。它的名字来源于一种会喷火的老鼠，据说这种老鼠生活在火山里，毛皮可以织成不怕火烧的布。"
+    "Python 3.14起，可以用 t-string 编写模板字符串！"
+)
+
+
+@pytest.mark.parametrize("n", [1, 10, 100])
+def test_字宽(n: int):
+    # 与break_text一样，在汉字间插入零宽度空格后切分。
+    items = regex.split(r"([ \u200b]+)", "\u200b".join(PARAGRAPH * n))
+    legacy = [legacy_measure(item) for item in items]
+    widths, stretches, shrinks = typesetting.measure_all(items)
+    assert legacy == list(map(typesetting.Glue, widths.tolist(), stretches.tolist(), shrinks.tolist()))
+    number = max(1, 100 // n)
+    report(f"测量（旧，{len(items)}项）", bench(lambda: [legacy_measure(item) for item in items], number))
+    report(f"测量（新，{len(items)}项）", bench(lambda: typesetting.measure_all(items), number))
+
+
+def legacy_break_text(text: str, line_width: float) -> list[list[tuple[float, str]]]:
+    """Knuth-Plass算法改用活动断行点列表和扁平数组之前的typesetting.break_text。"""
+    if line_width <= 0.0:
+        raise ValueError("line_width必须为正")
+    # 在汉字前后可断行处添加零宽度空格。
+    text = "".join(
+        a + "\u200b"
+        if (typesetting.is_breakable(a) or typesetting.is_breakable(b))
+        and a not in " \t\n\r\f\v$([{£¥‘“〈《「『【〔〖〝﹙﹛﹝＄（［｛｢￡￥"
+        and b
+        not in " \t\n\r\f\v!%),.:;?]}¢°’”…‰′″›℃∶、。々〃〉》」』】〕〗〞︶︺︾﹀﹄﹚﹜﹞ぁぃぅぇぉっゃゅょゎ゛゜ゝゞァィゥェォッャュョヮヵヶ・ーヽヾ！％），．：；？］｝～｡｣､･ｧｨｩｪｫｬｭｮｯｰﾞﾟ￠"
+        else a
+        for a, b in pairwise(text + "?")
+    )
+    # 切割字符串为项目列表。
+    # 项目有不可中断的单词、可断行且断行后消失的空格、段落结束。
+    # 段落结束"\n"也是可断行。以其为行末，则该行成本为零。
+    whitespace = r"[ \t\u2000-\u200b]"
+    items: list[str] = list(filter(None, regex.split(rf"(\n|{whitespace}+)", text)))
+    if items and items[-1] != "\n":
+        items.append("\n")
+    # 优先尝试在isspace的位置断行。当在这些位置断行时，对应项目将消失。
+    isspace = [item == "\n" or bool(regex.match(whitespace, item)) for item in items]
+    for i in range(len(items)):
+        # 保留段首空格。
+        if (i == 0 or items[i - 1] == "\n") and items[i] != "\n":
+            isspace[i] = False
+    # cumsum[i] = 前i个项目的弹性宽度和。
+    cumsum = [typesetting.Glue()]
+    for i in zip(*(a.tolist() for a in typesetting.measure_all(items))):
+        i = typesetting.Glue(*i)
+        if i.shrunk > line_width:
+            i = typesetting.Glue(line_width - 0.5, i.stretch, i.shrink)
+        cumsum.append(cumsum[-1] + i)
+    # dp[i] = 在第i个项目处断行的(成本最小值, 达到最小值时上一个断行处的项目索引)。
+    # 通常是在空格处断行。紧急情况下（例如单词超出行宽），也会在单词前断行。
+    dp: list[tuple[float, int]] = [(math.inf, -1)] * len(items)
+    # 首个断行点就是第一个单词。
+    dp[0] = (0.0, -1)
+    i = 0
+    for k in range(1, len(items)):
+        if isspace[k]:
+            while (cumsum[k] - cumsum[i + isspace[i]]).shrunk > line_width:
+                i += 1
+            dp[k] = min(
+                (
+                    dp[j][0]
+                    + (0.0 if items[k] == "\n" else (cumsum[k] - cumsum[j + isspace[j]]).demerit(line_width)),
+                    j,
+                )
+                for j in range(i, k)
+                if math.isfinite(dp[j][0])
+            )
+            # 强制在段落结束处断行。
+            if items[k] == "\n":
+                i = k
+    # 追踪断行项目索引。
+    breaks: list[int] = []
+    i = len(items) - 1
+    while i >= 0:
+        breaks.append(i)
+        i = dp[i][1]
+    breaks.reverse()
+    # 整理用于绘制的(坐标, 单词)列表。
+    lines: list[list[tuple[float, str]]] = []
+    for i, k in pairwise(breaks):
+        i += isspace[i]
+        ratio = 0.0 if items[k] == "\n" else (cumsum[k] - cumsum[i]).ratio(line_width)
+        if math.isinf(ratio):
+            ratio = 0.0
+        lines.append([((cumsum[j] - cumsum[i]).set(ratio), items[j]) for j in range(i, k) if not isspace[j]])
+    return lines
+
+
+@pytest.mark.parametrize("n", [5, 50, 500])
+def test_断行(n: int):
+    # 每段约200字节UTF-8，每五段一个空行。
+    text = "\n".join(PARAGRAPH + "\n" * (i % 5 == 4) for i in range(n))
+    assert legacy_break_text(text, 274) == typesetting.break_text(text, 274)
+    number = max(1, 50 // n)
+    report(f"断行（旧，{len(text.encode())}字节）", bench(lambda: legacy_break_text(text, 274), number))
+    report(f"断行（新，{len(text.encode())}字节）", bench(lambda: typesetting.break_text(text, 274), number))
+
+
+def legacy_text_bitmap(
+    text="string\nlorem ipsum 114514\n1919810\n共计处理了489975条消息",
+    font=typesetting.font,
+    width=274,
+    line_height=28,
+    margin=8,
+    border=3,
+    padding_inline=12,
+    padding_block=4,
+    scale=2,
+    dash_on=4,
+    dash_off=4,
+):
+    """改用字形图集之前的typesetting.text_bitmap。"""
+    lines = typesetting.break_text(text, width)
+    height = line_height * len(lines) - 1
+    img = Image.new(
+        "RGB",
+        (
+            width + (margin + border + padding_inline) * 2,
+            height + (margin + border + padding_block) * 2,
+        ),
+        conf.THEME[3],
+    )
+    draw = ImageDraw.Draw(img)
+    draw.rectangle(
+        ((0, 0), img.size),
+        outline=conf.THEME[2],
+        width=margin,
+    )
+    draw.rectangle(
+        ((margin, margin), (img.width - margin, img.height - margin)),
+        outline=conf.THEME[1],
+        width=border,
+    )
+    for y in range(line_height - 1, height, line_height):
+        y += margin + border + padding_block
+        for x in range(0, width, dash_on + dash_off):
+            x += margin + border + padding_inline
+            img.paste(conf.THEME[2], (x, y, x + dash_on, y + 1))
+    for y, line in enumerate(lines):
+        y *= line_height
+        y += margin + border + padding_block + font.size // 2
+        for x, item in line:
+            x += margin + border + padding_inline
+            draw.text((x, y), item, fill=conf.THEME[0], font=font)
+    return img.resize((img.width * scale, img.height * scale), resample=Image.Resampling.BOX)
+
+
+@pytest.mark.parametrize("n", [1, 10, 100])
+def test_文字图片(n: int):
+    text = "\n".join([PARAGRAPH] * n)
+    # 顺便使字形图集就绪。
+    assert legacy_text_bitmap(text).tobytes() == typesetting.text_bitmap(text).tobytes()
+    number = max(1, 100 // n)
+    report(f"文字图片（旧，{n}段）", bench(lambda: legacy_text_bitmap(text), number))
+    report(f"文字图片（新，{n}段）", bench(lambda: typesetting.text_bitmap(text), number))
+
+
+def test_图片缓存():
+    text = "\n".join([PARAGRAPH] * 10)
+    with tempfile.TemporaryDirectory() as path:
+        cache = typesetting.RenderCache(path)
+        data = cache.png(text)
+        assert data == codec.encode_png(typesetting.text_bitmap(text), colors=4)
+        report("绘制并编码", bench(lambda: codec.encode_png(typesetting.text_bitmap(text), colors=4), 10))
+        report("内存缓存命中", bench(lambda: cache.png(text), 1000))
+        report("磁盘缓存命中", bench(lambda: typesetting.RenderCache(path).png(text), 100))
+
+
+@pytest.mark.parametrize("n", [1, 10, 100])
+def test_发送图片(n: int):
+    img = typesetting.text_bitmap("\n".join([PARAGRAPH] * n))
+
+    def legacy() -> str:
+        # 编码为base64字符串，嵌入木鼠子码，再由Bot.send用正则表达式解析出来，最后序列化为JSON。
+        segments = codec.encode(f"看\a<Image base64://{typesetting.pil_image_to_base64(img)}>")
+        return json.dumps({"message": segments})
+
+    def new() -> str:
+        return json.dumps({"message": codec.encode(["看", codec.Media.image(img, colors=4)])})
+
+    report(f"发送图片（旧，{n}段，{len(legacy())}字节）", bench(legacy, max(1, 20 // n)))
+    report(f"发送图片（新，{n}段，{len(new())}字节）", bench(new, max(1, 20 // n)))
@@ -0,0 +1,164 @@
+import pickle
+import threading
+import time
+from collections.abc import Callable
+from typing import Any
+
+from . import Bot, Dispatcher, NameCacheUpdater
+from .transport import Transport
+
+
+class FakeOneBot(Transport):
+    """记录请求的端点，返回固定名称的假传输层。"""
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.endpoints: list[str] = []
+        self.lock = threading.Lock()
+        self.delay = delay
+        """每个请求耗费的秒数。"""
+
+    def request(self, endpoint: str, params: dict[str, Any], timeout: float | None = None) -> dict[str, Any]:
+        with self.lock:
+            self.endpoints.append(endpoint)
+        time.sleep(self.delay)
+        match endpoint:
+            case "get_friend_list":
+                data: object = [{"user_id": 1, "nickname": "甲"}, {"user_id": 2, "nickname": "乙"}]
+            case "get_group_list":
+                data = [{"group_id": 10, "group_name": "群十"}, {"group_id": 20, "group_name": "群二十"}]
+            case "get_group_member_info":
+                data = {"card": "名片", "nickname": "昵称"}
+            case "get_group_member_list":
+                data = [
+                    {"user_id": 1, "card": "片甲", "nickname": "甲"},
+                    {"user_id": 2, "card": "", "nickname": "乙"},
+                ]
+            case _:
+                raise AssertionError(endpoint)
+        return {"status": "ok", "data": data}
+
+
+class EchoOneBot(Transport):
+    """原样返回参数的假传输层，记录同时进行的请求数。"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def request(self, endpoint: str, params: dict[str, Any], timeout: float | None = None) -> dict[str, Any]:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(params.get("delay", 0.0))
+        finally:
+            with self.lock:
+                self.running -= 1
+        if params.get("disconnect"):
+            raise ConnectionError("连接已断开")
+        if params.get("fail"):
+            return {"status": "failed", "retcode": 100}
+        return {"status": "ok", "data": params}
+
+
+def wait_until(predicate: Callable[[], bool], timeout: float = 5.0) -> None:
+    """等待条件成立。clock固定住了time.monotonic，所以用time.perf_counter计时。"""
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        assert time.perf_counter() < deadline, "等待超时"
+        time.sleep(0.01)
+
+
+def test_批量重新验证过时名称(clock, tmp_path):
+    path = str(tmp_path / "names.pickle")
+    with open(path, "wb") as f:
+        pickle.dump({1: "旧甲", 2: "旧乙", 3: "", -10: "旧群十", -20: "旧群二十", (-10, 1): "旧名片"}, f)
+    transport = FakeOneBot()
+    bot = Bot(transport)
+    bot.load_names(path)
+    assert bot.names([1, 2, -10, -20, (-10, 1)]) == ["旧甲", "旧乙", "旧群十", "旧群二十", "旧名片"]
+    # 在后台重新获取。
+    wait_until(lambda: bot.names([1, 2, -10, -20, (-10, 1)]) == ["甲", "乙", "群十", "群二十", "名片"])
+    # 每种来源只请求一次。
+    assert sorted(transport.endpoints) == ["get_friend_list", "get_group_list", "get_group_member_info"]
+
+
+def test_载入查无此人的名称(clock, tmp_path):
+    path = str(tmp_path / "names.pickle")
+    with open(path, "wb") as f:
+        pickle.dump({1: "甲", 3: ""}, f)
+    bot = Bot(FakeOneBot())
+    bot.load_names(path)
+    # 查无此人的名称以较短的有效期载入。
+    clock[0] += bot._name_negative_ttl + 1.0
+    assert bot._name_cache.get(3) is None
+    assert bot._name_cache.get(1) == "甲"
+
+
+def test_大量过时名片(clock, tmp_path):
+    # 过时名称比pool的线程还多时，重新获取也不会占满pool而死锁。
+    path = str(tmp_path / "names.pickle")
+    with open(path, "wb") as f:
+        pickle.dump({(-10, i): "旧名片" for i in range(40)}, f)
+    bot = Bot(FakeOneBot(delay=0.01))
+    bot.load_names(path)
+    assert [bot.name(-10, i) for i in range(40)] == ["旧名片"] * 40
+    wait_until(lambda: all(bot._name_cache.get((-10, i)) == "名片" for i in range(40)))
+    # 之后的请求也不受影响。
+    assert bot.name(-10, 40) == "名片"
+
+
+def test_同时发送多个请求():
+    bot = Bot(EchoOneBot())
+    # 先发出的请求后完成，结果仍按请求的顺序排列。
+    calls = [("echo", {"i": i, "delay": 0.05 - i * 0.01}) for i in range(5)]
+    assert [result["i"] for result in bot.call_many(calls)] == list(range(5))  # type: ignore
+    # 个别请求失败时，对应位置是异常对象。
+    [ok, failed, raised] = bot.call_many([("echo", {}), ("echo", {"fail": True}), ("echo", {"disconnect": True})])
+    assert ok == {}
+    assert isinstance(failed, RuntimeError)
+    assert isinstance(raised, ConnectionError)
+
+
+def test_同时进行的请求数上限():
+    transport = EchoOneBot()
+    bot = Bot(transport)
+    results = bot.call_many((("echo", {"i": i, "delay": 0.01}) for i in range(30)), concurrency=3)
+    assert [result["i"] for result in results] == list(range(30))  # type: ignore
+    assert transport.max_running == 3
+
+
+def test_在线程池中同时发送多个请求():
+    # 占满pool的线程各自调用call_many，也不会等待排在后面的任务而死锁。
+    bot = Bot(EchoOneBot())
+    calls = [("echo", {"i": i, "delay": 0.01}) for i in range(4)]
+    futures = [bot.pool.submit(bot.call_many, calls) for _ in range(40)]
+    for future in futures:
+        assert [result["i"] for result in future.result(10.0)] == list(range(4))  # type: ignore
+
+
+def test_从事件更新名称缓存():
+    transport = FakeOneBot()
+    bot = Bot(transport)
+    updater = NameCacheUpdater()
+    updater.bot = bot
+    updater.prefetch = True
+    dispatcher = Dispatcher(bot, [updater])  # type: ignore
+    event = {
+        "post_type": "message",
+        "message_type": "group",
+        "group_id": 10,
+        "user_id": 3,
+        "message_id": 1,
+        "message": [{"type": "text", "data": {"text": "嗨"}}],
+        "sender": {"nickname": "丙", "card": "小丙"},
+    }
+    dispatcher.on_event(event)
+    dispatcher.on_event(event | {"user_id": 4, "sender": {"nickname": "丁"}})
+    # 消息事件中的发送者信息直接进入缓存。
+    assert bot.names([(-10, 3), 3, (-10, 4)]) == ["小丙", "丙", "丁"]
+    # 第一次收到该群的消息时，在后台缓存全体成员的群名片。
+    wait_until(lambda: bot._name_cache.get((-10, 2)) is not None)
+    assert bot.names([(-10, 1), (-10, 2)]) == ["片甲", "乙"]
+    assert transport.endpoints == ["get_group_member_list"]
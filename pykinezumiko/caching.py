@@ -0,0 +1,265 @@
+"""缓存。"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Mapping
+from concurrent.futures import Future
+from typing import overload
+
+
+class TTLCache[K, V]:
+    """有容量上限和有效期的LRU缓存。线程安全。
+
+    条目在写入ttl秒后过期。条目数超过maxsize时，淘汰最久未使用的条目。
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict[K, tuple[float, V]]()
+        """从键到(过期时间, 值)的映射，按最近使用时间从早到晚排序。"""
+        self.stale = set[K]()
+        """从快照载入、尚未重新验证的键。这些条目照常返回，但值可能已经过时。"""
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @overload
+    def get(self, key: K) -> V | None: ...
+
+    @overload
+    def get[T](self, key: K, default: T) -> V | T: ...
+
+    def get(self, key, default=None):
+        """取出未过期的值，并计入命中率统计。"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                self.stale.discard(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        """写入值。
+
+        :param ttl: 该条目的有效期。None表示使用缓存的默认有效期。
+        """
+        with self.lock:
+            self.entries[key] = time.monotonic() + (self.ttl if ttl is None else ttl), value
+            self.entries.move_to_end(key)
+            self.stale.discard(key)
+            while len(self.entries) > self.maxsize:
+                self.stale.discard(self.entries.popitem(last=False)[0])
+                self.evictions += 1
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self.set(key, value)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.stale.clear()
+
+    def snapshot(self) -> dict[K, V]:
+        """返回所有未过期的条目，按最近使用时间从早到晚排序，以便保存到文件。"""
+        with self.lock:
+            now = time.monotonic()
+            return {key: value for key, (expires, value) in self.entries.items() if expires > now}
+
+    def load(self, entries: Mapping[K, V], ttl: float | None = None) -> None:
+        """载入快照。已有的条目不会被覆盖。
+
+        载入的条目标记为过时：取出时照常返回，由调用方决定何时重新验证。
+
+        :param ttl: 载入的条目的有效期。None表示使用缓存的默认有效期。
+        """
+        with self.lock:
+            expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+            for key, value in reversed(list(entries.items())):
+                if key not in self.entries:
+                    self.entries[key] = expires, value
+                    self.entries.move_to_end(key, last=False)
+                    self.stale.add(key)
+            while len(self.entries) > self.maxsize:
+                self.stale.discard(self.entries.popitem(last=False)[0])
+
+    def claim_stale(self, key: K) -> bool:
+        """若键是过时的，则去除其标记并返回真。同一个键只有一个调用方会得到真，由它负责重新验证。"""
+        with self.lock:
+            if key in self.stale:
+                self.stale.remove(key)
+                return True
+            return False
+
+    def claim_stale_where(self, predicate: Callable[[K], bool]) -> list[K]:
+        """一次认领所有满足条件的过时键，以便一同重新验证。"""
+        with self.lock:
+            keys = [key for key in self.stale if predicate(key)]
+            self.stale.difference_update(keys)
+            return keys
+
+    def stats(self) -> dict[str, int | float]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale": len(self.stale),
+            }
+
+
+class DiskCache:
+    """总大小有上限的磁盘LRU缓存。线程安全。
+
+    每个条目存为目录中的一个文件，文件名就是键，因此键只能由文件名中可用的字符组成，例如散列值的十六进制表示。
+    总字节数超过max_bytes时，淘汰最久未使用的条目。使用顺序记录在文件的修改时间上，重启后依然有效。
+    """
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index: OrderedDict[str, int] | None = None
+        """从键到文件大小的映射，按最近使用时间从早到晚排序。None表示尚未扫描目录。"""
+        self.total = 0
+        """所有条目的字节数之和。"""
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def scan(self) -> OrderedDict[str, int]:
+        """第一次访问时扫描目录，建立索引。调用方须持有锁。"""
+        if self.index is None:
+            try:
+                # 跳过写入中途退出时留下的临时文件。
+                entries = [
+                    entry
+                    for entry in os.scandir(self.path)
+                    if entry.is_file() and not entry.name.endswith(".tmp")
+                ]
+            except FileNotFoundError:
+                entries = []
+            stats = sorted(((entry.name, entry.stat()) for entry in entries), key=lambda x: x[1].st_mtime)
+            self.index = OrderedDict((name, stat.st_size) for name, stat in stats)
+            self.total = sum(self.index.values())
+            self.evict()
+        return self.index
+
+    def evict(self) -> None:
+        """淘汰条目，直到总字节数不超过上限。调用方须持有锁。"""
+        assert self.index is not None
+        while self.total > self.max_bytes:
+            key, size = self.index.popitem(last=False)
+            self.total -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.path, key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            index = self.scan()
+            if key in index:
+                filename = os.path.join(self.path, key)
+                try:
+                    with open(filename, "rb") as f:
+                        value = f.read()
+                    os.utime(filename)
+                except FileNotFoundError:
+                    # 文件被外部删除了。
+                    self.total -= index.pop(key)
+                else:
+                    index.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: bytes) -> None:
+        """写入值。比上限还大的值不会被写入。"""
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            index = self.scan()
+            os.makedirs(self.path, exist_ok=True)
+            filename = os.path.join(self.path, key)
+            # 先写入临时文件再改名，以免中途退出时留下不完整的文件。
+            with open(filename + ".tmp", "wb") as f:
+                f.write(value)
+            os.replace(filename + ".tmp", filename)
+            self.total += len(value) - index.pop(key, 0)
+            index[key] = len(value)
+            self.evict()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.scan())
+
+    def stats(self) -> dict[str, int | float]:
+        with self.lock:
+            index = self.scan()
+            total = self.hits + self.misses
+            return {
+                "size": len(index),
+                "bytes": self.total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class SingleFlight[V]:
+    """合并同时进行的相同请求。
+
+    某个键上的请求尚未完成时，再以该键请求的线程会等待并共享同一个结果（或异常），不会重复请求。
+    请求完成后，该键就被遗忘，下一次请求会重新进行。要记住结果的话，请配合缓存使用。
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flights: dict[Hashable, Future[V]] = {}
+        """从键到进行中的请求的结果的映射。"""
+        self.shared = 0
+        """因为共享了进行中的请求而省下的请求数。"""
+
+    def do(self, key: Hashable, f: Callable[[], V]) -> V:
+        with self.lock:
+            if (future := self.flights.get(key)) is not None:
+                leader = False
+                self.shared += 1
+            else:
+                leader = True
+                future = self.flights[key] = Future[V]()
+        if leader:
+            try:
+                future.set_result(f())
+            except BaseException as e:
+                # 异常交给所有等待者，领头的调用方也一样抛出。
+                future.set_exception(e)
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+        return future.result()
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from .caching import DiskCache, SingleFlight, TTLCache
+
+
+def test_有效期(clock):
+    cache = TTLCache[str, int](maxsize=10, ttl=60.0)
+    cache["a"] = 1
+    cache.set("b", 2, ttl=10.0)
+    clock[0] += 30.0
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    clock[0] += 30.0
+    assert cache.get("a", 0) == 0
+    assert len(cache) == 0
+    assert cache.stats()["expirations"] == 2
+
+
+def test_淘汰最久未使用的条目(clock):
+    cache = TTLCache[int, int](maxsize=3, ttl=60.0)
+    for i in range(3):
+        cache[i] = i
+    assert cache.get(0) == 0
+    cache[3] = 3
+    assert cache.get(1) is None
+    assert [cache.get(i) for i in (0, 2, 3)] == [0, 2, 3]
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 4
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.8
+
+
+def test_快照(clock):
+    cache = TTLCache[int, str](maxsize=3, ttl=60.0)
+    cache[1] = "a"
+    cache.set(2, "b", ttl=10.0)
+    cache[3] = "c"
+    clock[0] += 30.0
+    snapshot = cache.snapshot()
+    assert snapshot == {1: "a", 3: "c"}
+
+    restored = TTLCache[int, str](maxsize=3, ttl=60.0)
+    restored[4] = "d"
+    restored.load(snapshot | {4: "過時"})
+    # 已有的条目不被覆盖，载入的条目比已有的条目更早被淘汰。
+    assert restored.get(4) == "d"
+    assert restored.get(1) == "a"
+    assert restored.claim_stale(1)
+    assert not restored.claim_stale(1)
+    assert not restored.claim_stale(4)
+    restored[3] = "新"
+    assert not restored.claim_stale(3)
+    assert restored.stats()["stale"] == 0
+
+
+def test_磁盘缓存(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache"), max_bytes=10)
+    assert cache.get("a") is None
+    cache.set("a", b"aaaa")
+    cache.set("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    cache.set("c", b"cccc")
+    assert cache.get("b") is None
+    cache.set("d", b"d" * 11)
+    assert sorted(os.listdir(tmp_path / "cache")) == ["a", "c"]
+    stats = cache.stats()
+    assert stats["bytes"] == 8
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+    # 重启后按文件的修改时间恢复使用顺序。
+    os.utime(tmp_path / "cache" / "a", (1000.0, 1000.0))
+    os.utime(tmp_path / "cache" / "c", (2000.0, 2000.0))
+    (tmp_path / "cache" / "e.tmp").write_bytes(b"e")
+    restored = DiskCache(str(tmp_path / "cache"), max_bytes=10)
+    restored.set("e", b"eee")
+    assert restored.get("a") is None
+    assert restored.get("c") == b"cccc"
+    assert len(restored) == 2
+
+
+def test_合并同时进行的请求():
+    flights = SingleFlight[int]()
+    release = threading.Event()
+    calls = 0
+
+    def slow() -> int:
+        nonlocal calls
+        calls += 1
+        release.wait(5.0)
+        return 42
+
+    with ThreadPoolExecutor(8) as pool:
+        futures = [pool.submit(flights.do, "key", slow) for _ in range(8)]
+        while flights.shared < 7:
+            time.sleep(0.01)
+        release.set()
+        assert [future.result(5.0) for future in futures] == [42] * 8
+    assert calls == 1
+    # 完成后的请求不再共享，而是重新进行。
+    assert flights.do("key", slow) == 42
+    assert calls == 2
+
+
+def test_合并的请求共享异常():
+    flights = SingleFlight[int]()
+    with pytest.raises(ZeroDivisionError):
+        flights.do("key", lambda: 1 // 0)
+    assert not flights.flights
@@ -0,0 +1,362 @@
+r"""木鼠子码与OneBot消息段列表之间的转换。
+
+木鼠子码用"\a<控制序列 参数值 参数值>"表示。
+通过使用莫名其妙的控制字符，使控制序列与常规文本冲突的可能性降到极低。
+因为"< >"三个字符都被HTML占用，被列为URL中禁止使用的字符，因此参数是网址也没有问题。
+当输入确实包含"\a"时就完蛋了，到那时再自求多福吧。
+
+木鼠子码最大的好处是，将数据结构统一展平成字符串后，能在整条消息上使用正则表达式，
+而且不太需要特别处理就能正确应对表情等元素。
+OneBot协议定义的元素名满是中式英语，参数也不统一，因此不得不花费很多代码来转换。
+"\a"是Python中为数不多的有单字母缩写且不属于正则表达式空白（r"\s"）的控制字符之一。
+
+每种控制序列和每种消息段的转换方法登记在encoders和decoders表中。插件可以用encoder和decoder装饰器登记新的种类。
+
+内存中的图片和语音不必写成文件再用木鼠子码引用，可以用Media直接与字符串拼成消息。
+"""
+
+import base64
+import io
+import os
+import re
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+from typing import Any, Self, TypeGuard
+
+from PIL import Image
+
+Segment = dict[str, Any]
+"""OneBot消息段，形如{"type": 种类, "data": {参数名: 参数值}}。"""
+
+
+def encode_png(img: Image.Image, compress_level: int = 6, colors: int | None = None) -> bytes:
+    """把PIL图像编码为PNG。
+
+    :param compress_level: zlib压缩级别，0～9。
+    :param colors: 先把图像减少到至多这么多种颜色，存为调色板图像。None表示不减色。
+    """
+    if colors is not None and img.mode != "P":
+        if img.mode == "RGB" and (exact := img.getcolors(colors)):
+            # 颜色本来就不多时，直接以这些颜色为调色板，既无损也比中位切分法快得多。
+            palette = Image.new("P", (1, 1))
+            palette.putpalette([c for _, rgb in exact for c in rgb])  # type: ignore
+            img = img.quantize(palette=palette, dither=Image.Dither.NONE)
+        else:
+            img = img.quantize(colors)
+    with io.BytesIO() as f:
+        img.save(f, format="PNG", compress_level=compress_level)
+        return f.getvalue()
+
+
+@dataclass(eq=False)
+class Media:
+    """内存中的图片或语音。
+
+    与木鼠子码字符串一同传给encode和Bot.send，转换为消息段时才以base64编码一次，直接放进要发送的JSON中。
+    字节串和PIL图像也可以直接传入，视作图片。
+    """
+
+    type: str
+    """消息段种类，"image"或"record"。"""
+    data: bytes | Image.Image
+    """文件内容，或者待编码为PNG的PIL图像。"""
+    compress_level: int = 6
+    """PIL图像编码为PNG时的压缩级别，参照encode_png。"""
+    colors: int | None = None
+    """PIL图像编码为PNG前减少到的颜色数，参照encode_png。
+
+    typesetting.text_bitmap绘制的图片只有四种颜色，减色后文件大小只有原先的几分之一。
+    """
+
+    @classmethod
+    def image(cls, data: bytes | Image.Image, compress_level: int = 6, colors: int | None = None) -> Self:
+        return cls("image", data, compress_level, colors)
+
+    @classmethod
+    def audio(cls, data: bytes) -> Self:
+        return cls("record", data)
+
+    @property
+    def standalone(self) -> bool:
+        """与木鼠子码中的\\a<Audio>相同，语音只能单独发送。"""
+        return self.type == "record"
+
+    def segment(self) -> Segment:
+        data = (
+            self.data if isinstance(self.data, bytes) else encode_png(self.data, self.compress_level, self.colors)
+        )
+        return {"type": self.type, "data": {"file": "base64://" + base64.b64encode(data).decode()}}
+
+
+Part = str | Media | bytes | Image.Image
+"""消息的组成部分：木鼠子码字符串、Media，以及视作图片的字节串和PIL图像。"""
+
+Message = Part | list[Part] | tuple[Part, ...]
+"""要发送的消息，可以是单个部分，也可以是依次拼接的若干部分。"""
+
+
+def is_message(x: object) -> TypeGuard[Message]:
+    """判断对象是否可以不经格式化，直接作为消息发送。
+
+    单纯的字符串除外。列表也要含有字符串以外的部分才算，只由字符串构成的列表（包括空列表）是普通的数据，
+    照常格式化，以免其中的字符串被当作木鼠子码解析。
+    """
+    if isinstance(x, list | tuple):
+        return all(isinstance(part, Part) for part in x) and any(not isinstance(part, str) for part in x)
+    return isinstance(x, Media | bytes | Image.Image)
+
+
+@dataclass
+class Encoder:
+    encode: Callable[[list[str], str], Segment]
+    """从控制序列的参数和之后的全部文本得到消息段的函数。参数不正确时抛出ValueError。"""
+    standalone: bool
+    """这种消息段是否只能单独发送。
+
+    单独发送的消息段会取代之前的所有消息段，之后的文本也不再转换，而是交给encode函数处理（例如作为标题）。
+    """
+
+
+encoders: dict[str, Encoder] = {}
+"""从控制序列名到木鼠子码→消息段转换方法的映射。"""
+
+decoders: dict[str, Callable[[dict[str, Any]], str | None]] = {}
+"""从消息段种类到消息段→木鼠子码转换函数的映射。函数收到消息段的data字段，返回None表示无法识别。"""
+
+prefixes: set[str] = set()
+"""转换为木鼠子码后要移到开头的消息段种类。"""
+
+
+def encoder(name: str, standalone: bool = False):
+    """登记木鼠子码控制序列的转换函数的装饰器。"""
+
+    def decorator(f: Callable[[list[str], str], Segment]) -> Callable[[list[str], str], Segment]:
+        encoders[name] = Encoder(f, standalone)
+        return f
+
+    return decorator
+
+
+def decoder(type: str, prefix: bool = False):
+    """登记OneBot消息段的转换函数的装饰器。
+
+    :param prefix: 转换结果是否移到开头，如回复。
+    """
+
+    def decorator(f: Callable[[dict[str, Any]], str | None]) -> Callable[[dict[str, Any]], str | None]:
+        decoders[type] = f
+        if prefix:
+            prefixes.add(type)
+        return f
+
+    return decorator
+
+
+ELEMENT = re.compile(r"\a<([^<>]*)>")
+"""木鼠子码控制序列。标准库的re比regex快，而这里用不到regex的功能。"""
+
+
+def encode(message: Message) -> list[Segment]:
+    """转换木鼠子码字符串，或者由字符串和Media等构成的消息，到消息段列表。"""
+    segments: list[Segment] = []
+    for part in message if isinstance(message, list | tuple) else (message,):
+        if not isinstance(part, str):
+            if not isinstance(part, Media):
+                part = Media.image(part)
+            if part.standalone:
+                return [part.segment()]
+            segments.append(part.segment())
+            continue
+        start = 0
+        for match in ELEMENT.finditer(part):
+            if match.start() > start:
+                segments.append({"type": "text", "data": {"text": part[start : match.start()]}})
+            start = match.end()
+            name, *args = match.group(1).split(" ")
+            try:
+                if (e := encoders.get(name)) is None:
+                    raise ValueError(name)
+                if e.standalone:
+                    return [e.encode(args, part[match.end() :])]
+                segments.append(e.encode(args, ""))
+            except ValueError:
+                print("警告：无效的木鼠子码元素", name, args)
+                segments.append({"type": "face", "data": {"id": "60"}})  # [咖啡]
+        if start < len(part):
+            segments.append({"type": "text", "data": {"text": part[start:]}})
+    return segments
+
+
+def decode(segments: Iterable[Segment]) -> str:
+    """转换消息段列表到木鼠子码字符串。"""
+    head: list[str] = []
+    body: list[str] = []
+    for segment in segments:
+        type = segment.get("type", "")
+        data = segment.get("data", {})
+        try:
+            x = decoders[type](data)
+        except LookupError:
+            x = None
+        if x is None:
+            print("警告：未知的消息元素，data字段 =", data)
+            x = f"\a<{type}>"
+        (head if type in prefixes else body).append(x)
+    return "".join(head + body)
+
+
+# https://napcat.napneko.icu/onebot/sement
+
+
+@decoder("text")
+def _(data: dict[str, Any]) -> str:
+    return data["text"]
+
+
+@encoder("Emoticon")
+def _(args: list[str], tail: str) -> Segment:
+    [x] = args
+    return {"type": "face", "data": {"id": x}}
+
+
+@decoder("face")
+def _(data: dict[str, Any]) -> str:
+    return f"\a<Emoticon {data['id']}>"
+
+
+@encoder("Mention")
+def _(args: list[str], tail: str) -> Segment:
+    [x] = args
+    return {"type": "at", "data": {"qq": x}}
+
+
+@decoder("at")
+def _(data: dict[str, Any]) -> str:
+    return f"\a<Mention {data['qq']}>"  # 包含Mention all
+
+
+@encoder("Sticker", standalone=True)
+def _(args: list[str], tail: str) -> Segment:
+    match args:
+        case ["RPS"] | ["RPS", _]:
+            return {"type": "rps", "data": {}}
+        case ["Dice"] | ["Dice", _]:
+            return {"type": "dice", "data": {}}
+        case [x, y, z]:
+            return {
+                "type": "mface",
+                "data": {"summary": tail, "key": x, "emoji_id": y, "emoji_package_id": int(z)},
+            }
+    raise ValueError(f"无效的Sticker参数：{args}")
+
+
+@decoder("mface")
+def _(data: dict[str, Any]) -> str | None:
+    match data:
+        case {"summary": alt, "key": str(x), "emoji_id": str(y), "emoji_package_id": int(z)}:
+            return f"\a<Sticker {x} {y} {z}>{alt}"
+
+
+@decoder("rps")
+def _(data: dict[str, Any]) -> str:
+    return f"\a<Sticker RPS {data['result']}>" if "result" in data else "\a<Sticker RPS>"
+
+
+@decoder("dice")
+def _(data: dict[str, Any]) -> str:
+    return f"\a<Sticker Dice {data['result']}>" if "result" in data else "\a<Sticker Dice>"
+
+
+@encoder("Image")
+def _(args: list[str], tail: str) -> Segment:
+    [url] = args
+    return {"type": "image", "data": {"url": url}}
+
+
+@decoder("image")
+def _(data: dict[str, Any]) -> str | None:
+    # 商城表情以图片的形式上报。缺少字段而无法识别为表情时，仍当作普通图片。
+    if "emoji_id" in data and (sticker := decoders["mface"](data)) is not None:
+        return sticker
+    match data:
+        case {"url": url, "file_size": size}:
+            return f"\a<Image {url}#size={size}>"
+        case {"url": url}:
+            return f"\a<Image {url}>"
+
+
+@encoder("Audio", standalone=True)
+def _(args: list[str], tail: str) -> Segment:
+    [path] = args
+    return {"type": "record", "data": {"path": path}}
+
+
+@decoder("record")
+def _(data: dict[str, Any]) -> str:
+    return f"\a<Audio {data['path']}>"
+
+
+@encoder("Video", standalone=True)
+def _(args: list[str], tail: str) -> Segment:
+    [url] = args
+    return {"type": "video", "data": {"url": url}}
+
+
+@decoder("video")
+def _(data: dict[str, Any]) -> str:
+    return f"\a<Video {data['url']}>"
+
+
+@encoder("File", standalone=True)
+def _(args: list[str], tail: str) -> Segment:
+    """文件无法与其他消息一同发送，而要另行上传。Bot.send会将这个消息段转换为上传请求。"""
+    [filename] = args
+    name = tail or os.path.basename(filename)
+    if "://" not in filename:
+        filename = os.path.realpath(filename)
+    return {"type": "file", "data": {"file": filename, "name": name}}
+
+
+@decoder("file")
+def _(data: dict[str, Any]) -> str:
+    return f"\a<File {data['file_id']}>" if "file_id" in data else f"\a<File {data['file']}>{data['name']}"
+
+
+@encoder("Poke", standalone=True)
+def _(args: list[str], tail: str) -> Segment:
+    return {"type": "poke", "data": {}}
+
+
+@decoder("poke")
+def _(data: dict[str, Any]) -> str:
+    if data:
+        print("POKE还有其他属性吗？", data)
+    return "\a<Poke>"
+
+
+@encoder("Special", standalone=True)
+def _(args: list[str], tail: str) -> Segment:
+    return {"type": "json", "data": {"data": tail}}
+
+
+@decoder("json")
+def _(data: dict[str, Any]) -> str:
+    return f"\a<Special>{data['data']}"
+
+
+@encoder("Quote")
+def _(args: list[str], tail: str) -> Segment:
+    [x] = args
+    return {"type": "reply", "data": {"id": x}}
+
+
+@decoder("reply", prefix=True)
+def _(data: dict[str, Any]) -> str:
+    return f"\a<Quote {data['id']}>"
+
+
+@decoder("forward")
+def _(data: dict[str, Any]) -> str:
+    # 合并转发的内容无法用木鼠子码表示，也就无法原样发送，因此没有对应的encoder。
+    print("收到合并转发", data.get("content"))
+    return "\a<Begin quote>"
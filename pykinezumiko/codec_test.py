@@ -0,0 +1,91 @@
+import base64
+import io
+import os
+
+from hypothesis import given
+from hypothesis import strategies as st
+from PIL import Image
+
+from .codec import Media, decode, encode, encode_png
+
+# 控制序列的参数中不能有空格和尖括号。
+arguments = st.text(st.characters(exclude_characters="\a <>", exclude_categories=["Cs"]), min_size=1)
+elements = st.one_of(
+    st.builds("\a<Emoticon {}>".format, arguments),
+    st.builds("\a<Mention {}>".format, arguments),
+    st.builds("\a<Image {}>".format, arguments),
+)
+texts = st.text(st.characters(exclude_characters="\a", exclude_categories=["Cs"]), min_size=1)
+
+
+@st.composite
+def kinezumiko_codes(draw: st.DrawFn) -> str:
+    """生成木鼠子码。相邻的文本会合并为同一个消息段，因此文本与元素交替出现。"""
+    parts = draw(st.lists(st.tuples(elements, st.one_of(st.just(""), texts))))
+    head = draw(st.one_of(st.just(""), texts))
+    quote = draw(st.one_of(st.just(""), st.builds("\a<Quote {}>".format, arguments)))
+    return quote + head + "".join(element + text for element, text in parts)
+
+
+@given(kinezumiko_codes())
+def test_往返(text: str):
+    segments = encode(text)
+    assert decode(segments) == text
+    assert encode(decode(segments)) == segments
+
+
+@given(kinezumiko_codes(), texts)
+def test_单独发送的消息段(head: str, tail: str):
+    assert encode(head + "\a<Special>" + tail) == [{"type": "json", "data": {"data": tail}}]
+    assert encode(head + "\a<Audio a.mp3>" + tail) == [{"type": "record", "data": {"path": "a.mp3"}}]
+    assert encode(head + "\a<File a.txt>") == [
+        {"type": "file", "data": {"file": os.path.realpath("a.txt"), "name": "a.txt"}}
+    ]
+
+
+def test_解码():
+    assert (
+        decode(
+            [
+                {"type": "text", "data": {"text": "看"}},
+                {"type": "image", "data": {"url": "https://example.com/a.png", "file_size": "114"}},
+                {"type": "reply", "data": {"id": "514"}},
+                {"type": "mystery", "data": {}},
+                # 缺少summary的商城表情。
+                {"type": "image", "data": {"url": "b.gif", "emoji_id": "1", "emoji_package_id": 2}},
+            ]
+        )
+        == "\a<Quote 514>看\a<Image https://example.com/a.png#size=114>\a<mystery>\a<Image b.gif>"
+    )
+
+
+def test_无效的元素():
+    assert encode("\a<Emoticon>\a<Nonexistent 1>\a<Begin quote>") == [{"type": "face", "data": {"id": "60"}}] * 3
+
+
+def decode_image(segment: dict) -> Image.Image:
+    assert segment["type"] == "image"
+    prefix, data = segment["data"]["file"].split("://")
+    assert prefix == "base64"
+    return Image.open(io.BytesIO(base64.b64decode(data)))
+
+
+def test_内存中的媒体():
+    img = Image.new("RGB", (64, 64), "#fff3e0")
+    img.putpixel((1, 2), (0, 0, 0))
+    caption, face, image, tail = encode(["看\a<Emoticon 1>", img, "！"])
+    assert caption == {"type": "text", "data": {"text": "看"}}
+    assert face["type"] == "face"
+    assert decode_image(image).tobytes() == img.tobytes()
+    assert tail == {"type": "text", "data": {"text": "！"}}
+    assert encode([b"PNG"]) == [{"type": "image", "data": {"file": "base64://UE5H"}}]
+    # 减色后像素不变。
+    [segment] = encode(Media.image(img, compress_level=9, colors=4))
+    quantized = decode_image(segment)
+    assert quantized.mode == "P"
+    assert quantized.convert("RGB").tobytes() == img.tobytes()
+    assert len(encode_png(img, colors=2)) < len(encode_png(img))
+    # 语音与\a<Audio>一样只能单独发送。
+    assert encode(["听", Media.audio(b"\0"), "不会发送"]) == [
+        {"type": "record", "data": {"file": "base64://AA=="}}
+    ]
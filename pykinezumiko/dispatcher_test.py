@@ -0,0 +1,393 @@
+import shelve
+import threading
+import time
+from typing import Any
+
+from PIL import Image
+
+from . import Bot, Dispatcher, Event, Flow, Later, Plugin, flow_timeout, trigger
+from .transport import Transport
+
+
+class FakeBot:
+    """只记录发出的消息的假Bot。"""
+
+    def __init__(self) -> None:
+        self.sent: list[tuple[int, object]] = []
+
+    def send(self, context: int, text: object) -> None:
+        self.sent.append((context, text))
+
+
+def message(text: str, *segments: dict[str, Any], sender: int = 114514) -> dict[str, Any]:
+    return {
+        "post_type": "message",
+        "message_type": "private",
+        "user_id": sender,
+        "message_id": 1,
+        "message": [{"type": "text", "data": {"text": text}}, *segments],
+    }
+
+
+class Triggered(Plugin):
+    def __init__(self) -> None:
+        self.calls: list[str] = []
+
+    @trigger(r"BV1\w{9}", keywords=["b23.tv"])
+    def on_message(self, event: Event):
+        self.calls.append(event.text)
+
+
+class Images(Plugin):
+    def __init__(self) -> None:
+        self.calls: list[str] = []
+
+    @trigger(segments=["image"])
+    def on_message(self, event: Event):
+        self.calls.append(event.text)
+
+
+class Untriggered(Plugin):
+    def __init__(self) -> None:
+        self.calls: list[str] = []
+
+    def on_message(self, event: Event):
+        self.calls.append(event.text)
+
+
+def test_触发条件():
+    plugins = [Triggered(), Images(), Untriggered()]
+    dispatcher = Dispatcher(FakeBot(), plugins)  # type: ignore
+    image = {"type": "image", "data": {"url": "https://example.com/a.png"}}
+    for data in (
+        message("你好"),
+        message("看看BV1GJ411x7h7"),
+        message("https://b23.tv/abc"),
+        message("看图", image),
+    ):
+        dispatcher.on_event(data)
+    triggered, images, untriggered = (plugin.calls for plugin in plugins)
+    assert triggered == ["看看BV1GJ411x7h7", "https://b23.tv/abc"]
+    assert len(images) == 1 and images[0].startswith("看图")
+    assert len(untriggered) == 4
+
+
+class Commands(Plugin):
+    def __init__(self) -> None:
+        self.events: list[Event] = []
+
+    def on_message(self, event: Event):
+        self.events.append(event)
+
+    def on_command_echo(self, event: Event):
+        return event.text
+
+    def on_command_ask(self, event: Event):
+        answer = yield "你叫什么名字？"
+        return f"你好，{answer}。"
+
+    def on_command_chart(self, event: Event):
+        return ["图表：", Image.new("RGB", (2, 2))]
+
+    def on_command_list(self, event: Event):
+        return [1, 2]
+
+    def on_command_empty(self, event: Event):
+        return []
+
+    def on_command_words(self, event: Event):
+        return ["a", "\a<Face 1>"]
+
+
+def test_命令与对话流程():
+    bot = FakeBot()
+    plugin = Commands()
+    dispatcher = Dispatcher(bot, [plugin])  # type: ignore
+    dispatcher.on_event(message("．echo"))
+    # 没有插件读取的事件文本不会被转换，输出repr也不会。
+    assert "_json=" in repr(plugin.events[0])
+    assert plugin.events[0]._text is None
+    dispatcher.on_event(message("!ECHO  hello "))
+    dispatcher.on_event(message(".ask"))
+    dispatcher.on_event(message("木鼠子"))
+    assert bot.sent == [
+        (114514, "hello"),
+        (114514, "你叫什么名字？"),
+        (114514, "你好，木鼠子。"),
+    ]
+    assert len(plugin.events) == 1
+
+
+def test_优先级通道():
+    dispatcher = Dispatcher(FakeBot(), [Commands()])  # type: ignore
+    group = {"message_type": "group", "group_id": 1919810}
+    assert dispatcher.lane(message("闲聊") | group) == "passive"
+    assert dispatcher.lane(message(".ask") | group) == "command"
+    # 命令还在排队时，对它开启的对话流程的回答也不能舍弃。
+    assert dispatcher.lane(message("木鼠子") | group) == "command"
+    assert dispatcher.lane(message("闲聊", sender=2) | group) == "passive"
+    request = {"post_type": "request", "request_type": "group", "group_id": 1919810, "user_id": 2}
+    assert dispatcher.lane(request) == "command"
+
+
+def test_回复图片():
+    bot = FakeBot()
+    dispatcher = Dispatcher(bot, [Commands()])  # type: ignore
+    dispatcher.on_event(message(".chart"))
+    dispatcher.on_event(message(".list"))
+    dispatcher.on_event(message(".empty"))
+    dispatcher.on_event(message(".words"))
+    # 可以作为消息发送的结果原样交给Bot.send，其他结果（包括空列表和字符串列表）仍然格式化为字符串。
+    [(_, chart), (_, numbers), (_, empty), (_, words)] = bot.sent
+    assert isinstance(chart, list) and chart[0] == "图表：" and isinstance(chart[1], Image.Image)
+    assert numbers == "[1, 2]"
+    assert empty == "[]"
+    assert words == "['a', '\\x07<Face 1>']"
+
+
+class Questions(Plugin):
+    def __init__(self) -> None:
+        self.closed: list[int] = []
+
+    @flow_timeout(60)
+    def on_command_ask(self, event: Event):
+        try:
+            answer = yield "你叫什么名字？"
+        except GeneratorExit:
+            self.closed.append(event.sender)
+            raise
+        return f"你好，{answer}。"
+
+
+def test_对话流程超时(clock):
+    bot = FakeBot()
+    plugin = Questions()
+    dispatcher = Dispatcher(bot, [plugin])  # type: ignore
+    dispatcher.on_event(message(".ask", sender=1))
+    clock[0] += 30.0
+    dispatcher.on_event(message(".ask", sender=2))
+    clock[0] += 40.0
+    dispatcher.expire_flows()
+    assert plugin.closed == [1]
+    dispatcher.on_event(message("木鼠子", sender=2))
+    clock[0] += 100.0
+    dispatcher.expire_flows()
+    assert plugin.closed == [1]
+    assert bot.sent[-1] == (2, "你好，木鼠子。")
+    assert dispatcher.flow_stats()["flows"] == 0
+    assert dispatcher.flow_stats()["expired"] == 1
+
+
+def test_对话流程数上限(clock):
+    plugin = Questions()
+    dispatcher = Dispatcher(FakeBot(), [plugin])  # type: ignore
+    dispatcher.max_flows_per_context = 2
+    for sender in range(3):
+        dispatcher.on_event(message(".ask", sender=sender) | {"message_type": "group", "group_id": 1919})
+    assert plugin.closed == [0]
+    stats = dispatcher.flow_stats()
+    assert stats["flows"] == 2
+    assert stats["evicted"] == 1
+    assert stats["memory"] > 0
+
+
+class Survey(Plugin):
+    def __init__(self) -> None:
+        self.closed: list[str] = []
+
+    @flow_timeout(60)
+    def on_command_survey(self, event: Event):
+        return Flow(self.ask_name, "你叫什么名字？", self.give_up)
+
+    def ask_name(self, flow: Flow, text: str):
+        flow.data["name"] = text
+        return flow.goto(self.ask_age, "你几岁了？")
+
+    def ask_age(self, flow: Flow, text: str):
+        if not text.isnumeric():
+            return flow.goto(self.ask_age, "请输入数字。")
+        return f"{flow.data['name']}，{text}岁。"
+
+    def give_up(self, flow: Flow):
+        self.closed.append(flow.data.get("name", ""))
+
+
+def test_可持久化的对话流程(clock, tmp_path):
+    path = str(tmp_path / "flows")
+    bot = FakeBot()
+    dispatcher = Dispatcher(bot, [Survey()])  # type: ignore
+    dispatcher.open_flows(path)
+    dispatcher.on_event(message(".survey", sender=1))
+    dispatcher.on_event(message(".survey", sender=2))
+    dispatcher.on_event(message("木鼠子", sender=1))
+    assert dispatcher.flow_stats()["shelved"] == 2
+    dispatcher.close()
+
+    # 重启后继续进行。
+    plugin = Survey()
+    dispatcher = Dispatcher(bot, [plugin])  # type: ignore
+    dispatcher.open_flows(path)
+    dispatcher.on_event(message("不告诉你", sender=1))
+    dispatcher.on_event(message("14", sender=1))
+    assert bot.sent == [
+        (1, "你叫什么名字？"),
+        (2, "你叫什么名字？"),
+        (1, "你几岁了？"),
+        (1, "请输入数字。"),
+        (1, "木鼠子，14岁。"),
+    ]
+    dispatcher.on_event(message("鼠鼠", sender=2))
+    clock[0] += 100.0
+    dispatcher.expire_flows()
+    assert plugin.closed == ["鼠鼠"]
+    assert dispatcher.flow_stats()["flows"] == 0
+    assert (shelf := dispatcher.flow_shelf) is not None
+    assert dispatcher.flow_io.submit(len, shelf).result() == 0
+    dispatcher.close()
+
+
+class ThreadBoundDict(dict):
+    """像Python 3.13起的dbm.sqlite3那样，只能在创建它的线程中使用的数据库。"""
+
+    def __init__(self) -> None:
+        self.owner = threading.get_ident()
+
+    def check(self) -> None:
+        assert threading.get_ident() == self.owner, "在别的线程中使用了数据库"
+
+    def __getitem__(self, key):
+        self.check()
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value) -> None:
+        self.check()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key) -> None:
+        self.check()
+        super().__delitem__(key)
+
+    def __contains__(self, key) -> bool:
+        self.check()
+        return super().__contains__(key)
+
+    def keys(self):
+        self.check()
+        return super().keys()
+
+
+def test_跨线程的对话流程(clock, monkeypatch):
+    monkeypatch.setattr(shelve, "open", lambda path: shelve.Shelf(ThreadBoundDict()))
+    bot = FakeBot()
+    plugin = Survey()
+    dispatcher = Dispatcher(bot, [plugin])  # type: ignore
+    dispatcher.open_flows()
+
+    def converse(*texts: str) -> None:
+        for text in texts:
+            dispatcher.on_event(message(text, sender=1))
+
+    # 在处理队列和计划任务的线程中推进、关闭对话流程。
+    worker = threading.Thread(target=converse, args=(".survey", "木鼠子"))
+    worker.start()
+    worker.join()
+    assert dispatcher.flow_stats()["shelved"] == 1
+    worker = threading.Thread(target=converse, args=("14", ".survey", "鼠鼠"))
+    worker.start()
+    worker.join()
+    clock[0] += 100.0
+    worker = threading.Thread(target=dispatcher.expire_flows)
+    worker.start()
+    worker.join()
+    dispatcher.close()
+    assert bot.sent == [
+        (1, "你叫什么名字？"),
+        (1, "你几岁了？"),
+        (1, "木鼠子，14岁。"),
+        (1, "你叫什么名字？"),
+        (1, "你几岁了？"),
+    ]
+    assert plugin.closed == ["鼠鼠"]
+
+
+class Alarm(Plugin):
+    def on_command_alarm(self, event: Event):
+        return Later(0.05, lambda: f"{event.text}时间到。")
+
+    def on_command_wait(self, event: Event):
+        yield Later(0.05, "稍等。")
+        return "好了。"
+
+
+def test_延迟回复():
+    bot = FakeBot()
+    dispatcher = Dispatcher(bot, [Alarm()])  # type: ignore
+    dispatcher.on_event(message(".alarm 泡面"))
+    dispatcher.on_event(message(".wait", sender=2))
+    assert bot.sent == []
+    dispatcher.on_event(message("嗯", sender=2))
+    assert bot.sent == [(2, "好了。")]
+    deadline = time.monotonic() + 5.0
+    while len(bot.sent) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(bot.sent[1:]) == [(2, "稍等。"), (114514, "泡面时间到。")]
+
+
+class RecordingOneBot(Transport):
+    """记录请求的假传输层。"""
+
+    def __init__(self) -> None:
+        self.requests: list[tuple[str, dict[str, Any]]] = []
+
+    def request(self, endpoint: str, params: dict[str, Any], timeout: float | None = None) -> dict[str, Any]:
+        self.requests.append((endpoint, params))
+        return {"status": "ok", "data": {}}
+
+
+class Replies(Plugin):
+    def on_command_hello(self, event: Event):
+        return "你好。"
+
+    def on_command_file(self, event: Event):
+        return "\a<File a.txt>"
+
+    def on_command_later(self, event: Event):
+        return Later(0.01, "稍后。")
+
+    def on_admission(self, event: Event):
+        return True
+
+
+def test_快速操作():
+    transport = RecordingOneBot()
+    bot = Bot(transport)
+    dispatcher = Dispatcher(bot, [Replies()])
+    dispatcher.quick_operation = True
+    # 回复和申请的处理结果作为上报请求的响应返回。
+    assert dispatcher.on_event(message(".hello")) == {
+        "reply": [{"type": "text", "data": {"text": "你好。"}}],
+        "auto_escape": False,
+        "at_sender": False,
+    }
+    request = {"post_type": "request", "request_type": "friend", "user_id": 1, "comment": "", "flag": "f"}
+    assert dispatcher.on_event(request) == {"approve": True}
+    assert transport.requests == []
+
+    # 发送队列中还有该会话的消息时，回复排在它们后面发送。
+    blocker = threading.Event()
+    bot.outbox.submit(114514, blocker.wait)
+    assert dispatcher.on_event(message(".hello")) is None
+    blocker.set()
+    # 上传文件无法用快速操作表示，延迟的回复也不在响应中。
+    assert dispatcher.on_event(message(".file")) is None
+    assert dispatcher.on_event(message(".later")) is None
+    assert bot.outbox.join(5.0)
+    deadline = time.perf_counter() + 5.0
+    while len(transport.requests) < 3:
+        assert time.perf_counter() < deadline
+        time.sleep(0.01)
+    assert [(endpoint, params.get("message")) for endpoint, params in transport.requests] == [
+        ("send_msg", [{"type": "text", "data": {"text": "你好。"}}]),
+        ("upload_private_file", None),
+        ("send_msg", [{"type": "text", "data": {"text": "稍后。"}}]),
+    ]
@@ -1,8 +1,8 @@
+import functools
 import math
 import os.path
 import unicodedata
-from bisect import bisect_left, bisect_right
-from collections.abc import Sequence
+from collections.abc import Iterable
 from typing import SupportsInt
 
 import regex
@@ -149,29 +149,72 @@ def normalize(text: str) -> str:
     return text
 
 
-def parse_command(text: str, sorted_normalized_command_names: Sequence[str]) -> tuple[str, str] | None:
-    """当输入字符串以命令符开头且其后紧随某个命令名时，给出命令名和其余文本，否则返回None。"""
+_normalize_grapheme = functools.lru_cache(maxsize=4096)(normalize)
+"""逐个字符规范化时使用。常用字符不多，缓存后省去每次规范化都要执行的多次正则表达式替换。"""
+
+
+class CommandTrie:
+    """规范形式的命令名构成的前缀树，供parse_command函数使用。"""
+
+    def __init__(self, names: Iterable[str]) -> None:
+        """
+        :param names: 命令名。必须是规范形式，参照normalize函数。
+        """
+        self.root: dict[str, dict] = {}
+        """每个节点是从下一个字符到子节点的映射。键""表示从根到此节点的路径是一个命令名。"""
+        for name in names:
+            node = self.root
+            for c in name:
+                node = node.setdefault(c, {})
+            node[""] = {}
+
+    def match(self, text: str) -> tuple[str, int] | None:
+        """找出规范形式是命令名的最长前缀。
+
+        逐个字符（扩展字位簇）规范化并沿树前进，走出树时停止，因此只需处理命令名那么长的开头部分。
+        规范化不会跨越字符边界，所以逐个字符规范化的结果拼接起来，与整体规范化的结果相同。
+
+        :returns: (命令名, 原始字符串中命令名之后的位置)。同一个命令名对应多个位置时取最前者，
+            因此命令名之后的空格和标点符号不会被切下。
+        """
+        node = self.root
+        normalized: list[str] = []
+        result = ("", 0) if "" in node else None
+        for grapheme in regex.finditer(r"\X", text):
+            piece = _normalize_grapheme(grapheme.group())
+            for c in piece:
+                if (node := node.get(c)) is None:
+                    return result
+            normalized.append(piece)
+            # 命令名与参数的边界落在字符之内的话，无法不多不少地切下命令名。复合字母可能引起此问题。
+            # 这样的命令名不会被匹配，但更短的命令名仍然可以。
+            if piece and "" in node:
+                result = "".join(normalized), grapheme.end()
+        return result
+
+
+def match_command(text: str, commands: CommandTrie) -> tuple[str, int] | None:
+    """当输入字符串以命令符开头且其后紧随某个命令名时，给出命令名和命令名之后的位置，否则返回None。
+
+    有多个命令名符合时，取最长者。
+    """
     match = regex.match(r"[.。!！]", text)
     if not match:
         return None
-    text = text[match.end() :]
-    command = normalize(text)
-    index = bisect_right(sorted_normalized_command_names, command) - 1
-    if index < 0:
-        return None
-    command_name = sorted_normalized_command_names[index]
-    if not command.startswith(command_name):
+    if (result := commands.match(text[match.end() :])) is None:
         return None
-    # 在原始字符串中二分找到命令名之后的部分。
-    index = bisect_left(range(len(text)), command_name, key=lambda i: normalize(text[:i]))
-    if index:
-        # 保证切点在字符边界（不会把单个字符切成两半）。
-        grapheme = regex.match(r"\X", text, pos=index - 1)
-        assert grapheme, f"{text!r}[{index - 1}] 处找不到字符？！"
-        index = grapheme.end()
-    if normalize(text[:index]) != command_name:
-        # 命令名与参数的边界落在字符之内，无法不多不少地切下命令名。复合字母可能引起此问题。
+    command_name, index = result
+    return command_name, match.end() + index
+
+
+def parse_command(text: str, commands: CommandTrie) -> tuple[str, str] | None:
+    """当输入字符串以命令符开头且其后紧随某个命令名时，给出命令名和其余文本，否则返回None。
+
+    有多个命令名符合时，取最长者。
+    """
+    if (result := match_command(text, commands)) is None:
         return None
+    command_name, index = result
     return command_name, text[index:].strip()
 
 
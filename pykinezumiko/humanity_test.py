@@ -6,6 +6,7 @@ from hypothesis import given
 from hypothesis import strategies as st
 
 from .humanity import (
+    CommandTrie,
     ellipsize,
     format_exception,
     format_object,
@@ -131,18 +132,23 @@ def test_normalize():
 
 
 class TestParseCommand:
-    COMMANDS = sorted(map(normalize, ["test", "radical", "F.F.I.", "foo", "foo bar", "abc"]))
+    COMMANDS = CommandTrie(map(normalize, ["test", "radical", "F.F.I.", "foo", "foo bar", "abc"]))
 
     def test_命令前缀符号必须精确匹配(self):
         assert parse_command(".test", self.COMMANDS) == ("test", "")
         assert parse_command(" .test", self.COMMANDS) is None
         assert parse_command("．ｔｅｓｔ", self.COMMANDS) is None
 
-    def test_二分边界场景(self):
+    def test_边界场景(self):
         assert parse_command(".a", self.COMMANDS) is None
         assert parse_command(".z", self.COMMANDS) is None
-        assert parse_command(".", [""]) == ("", "")
-        assert parse_command(".a", [""]) == ("", "a")
+        assert parse_command(".", CommandTrie([""])) == ("", "")
+        assert parse_command(".a", CommandTrie([""])) == ("", "a")
+
+    def test_命令名取最长者(self):
+        assert parse_command(".foo bar", self.COMMANDS) == ("foobar", "")
+        assert parse_command(".foo baz", self.COMMANDS) == ("foo", "baz")
+        assert parse_command(".foo", self.COMMANDS) == ("foo", "")
 
     def test_二分命令名时切到代理对(self):
         # 继承自JavaScript测试集，不过在Python中BMP之外的字符不会带来特别的问题。
@@ -164,6 +170,7 @@ class TestParseCommand:
 
     def test_命令名必须可精确切下(self):
         assert parse_command(".FFĲ", self.COMMANDS) is None
+        assert parse_command(".FFĲ", CommandTrie(["ff", "ffi"])) == ("ff", "Ĳ")
 
     def test_不可切断字符(self):
         assert parse_command(".FFℹ\ufe0f", self.COMMANDS) == ("ffi", "")
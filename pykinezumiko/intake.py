@@ -0,0 +1,226 @@
+"""事件处理队列。
+
+收到的事件按键（通常是(context, sender)）分组排队，由固定数目的工作线程执行。
+同一个键的事件严格按收到的顺序逐个处理，以免同一用户接连发出的消息争抢对话流程；不同键的事件则并行处理。
+某个键的事件处理得慢（例如插件在等待），只会推迟这个键之后的事件。
+
+每个事件属于一个优先级通道。空闲的工作线程按通道的权重（平滑加权轮询）挑选下一个要处理的键，
+这样大群刷屏时，管理群和私聊中的事件不必排在一大堆群消息后面，低优先级的通道也不会被完全饿死。
+键的下一个事件属于哪个通道，这个键就在哪个通道中排队。
+
+排队的事件数有上限。达到上限后，按过载策略舍弃事件：
+
+- skip：不再接收passive通道的新事件，插件也就不会扫描这些消息，但命令照常处理。
+- drop-oldest：舍弃passive通道中等待最久的事件，为新事件腾出位置。
+- reject：拒绝所有新事件，由调用方告知OneBot实现（HTTP 503）。
+
+passive通道中没有可舍弃的事件时，skip和drop-oldest策略仍然接收其他通道的新事件，因此上限只是大致的。
+"""
+
+import threading
+import time
+import traceback
+from collections import deque
+from collections.abc import Callable, Hashable
+from concurrent.futures import Future
+from typing import Any, Literal
+
+LANES = {"backstage": 8, "private": 4, "command": 2, "passive": 1}
+"""默认的优先级通道及其权重，从高到低排列。
+
+- backstage：管理群中的事件。
+- private：私聊消息和其他来自个人的事件。
+- command：群聊中的命令，以及对进行中的对话流程的回答。
+- passive：其他群聊消息和通知，插件只是被动地扫描它们。
+"""
+
+
+class Lane:
+    """优先级通道。"""
+
+    def __init__(self, weight: int) -> None:
+        self.weight = weight
+        self.current = 0
+        """平滑加权轮询的当前值。"""
+        self.ready = deque[Hashable]()
+        """下一个动作属于这个通道且可以执行的键，先到先得。"""
+        self.processed = 0
+        self.latency = 0.0
+        """从放入队列到执行完毕所经历秒数的指数移动平均。"""
+        self.max_latency = 0.0
+
+
+class Overloaded(Exception):
+    """队列已满，按reject策略拒绝了事件。"""
+
+
+class Intake:
+    """按键排序、分优先级通道的事件处理队列。"""
+
+    def __init__(
+        self,
+        workers: int = 8,
+        lanes: dict[str, int] = LANES,
+        capacity: int = 1000,
+        policy: Literal["skip", "drop-oldest", "reject"] = "skip",
+    ) -> None:
+        """
+        :param workers: 工作线程数，也就是最多同时处理的事件数。
+        :param lanes: 从通道名到权重的映射。通道都忙时，各通道处理的事件数之比大致等于权重之比。
+            必须包含名为passive的通道，其中的事件在过载时可以舍弃。
+        :param capacity: 排队（不含正在处理）的事件数上限。
+        :param policy: 过载策略。
+        """
+        self.capacity = capacity
+        self.policy = policy
+        self.depth = 0
+        """排队的事件数。"""
+        self.shed = {"skipped": 0, "dropped": 0, "rejected": 0}
+        """因过载而舍弃的事件数。"""
+        self.lanes = {name: Lane(weight) for name, weight in lanes.items()}
+        self.queues: dict[Hashable, deque[tuple[float, Lane, Callable[[], object], Future]]] = {}
+        """从键到(放入时间, 通道, 动作, 结果)队列的映射。只含有尚有动作未完成的键。
+
+        每个在queues中的键要么在其下一个动作所属通道的ready中，要么正在被某个工作线程执行，二者必居其一。
+        这保证了键内的顺序。
+        """
+        self.condition = threading.Condition()
+        self.processed = 0
+        self.failed = 0
+        self.latency = 0.0
+        """从放入队列到执行完毕所经历秒数的指数移动平均。"""
+        self.max_latency = 0.0
+        for i in range(workers):
+            threading.Thread(name=f"intake worker {i} {id(self):#x}", target=self.work, daemon=True).start()
+
+    def submit(self, key: Hashable, action: Callable[[], object], lane: str = "passive") -> Future:
+        """将动作放入指定键的队列。
+
+        :param lane: 动作所属的通道。
+        :returns: 动作执行完毕后得到结果的Future。因过载而舍弃的动作不会执行，得到的结果是None。
+        :raises Overloaded: 队列已满且过载策略为reject。
+        """
+        future = Future()
+        with self.condition:
+            if self.depth >= self.capacity:
+                match self.policy:
+                    case "reject":
+                        self.shed["rejected"] += 1
+                        raise Overloaded(f"处理队列已满（{self.depth}）")
+                    case "skip" if lane == "passive":
+                        self.shed["skipped"] += 1
+                        future.set_result(None)
+                        return future
+                    case "drop-oldest" if self.lanes["passive"].ready:
+                        self.drop()
+                    case "drop-oldest" if lane == "passive":
+                        # 没有可舍弃的旧事件时，舍弃新事件。
+                        self.shed["dropped"] += 1
+                        future.set_result(None)
+                        return future
+            self.depth += 1
+            if key not in self.queues:
+                self.queues[key] = deque()
+                self.lanes[lane].ready.append(key)
+                self.condition.notify()
+            self.queues[key].append((time.monotonic(), self.lanes[lane], action, future))
+        return future
+
+    def drop(self) -> None:
+        """舍弃passive通道中等待最久的键的下一个动作。调用方须持有锁，且passive通道中有可以执行的键。"""
+        lane = self.lanes["passive"]
+        key = lane.ready.popleft()
+        queue = self.queues[key]
+        _, _, _, future = queue.popleft()
+        self.depth -= 1
+        self.shed["dropped"] += 1
+        if future.set_running_or_notify_cancel():
+            future.set_result(None)
+        if queue:
+            queue[0][1].ready.append(key)
+        else:
+            del self.queues[key]
+            self.condition.notify_all()
+
+    def pick(self) -> Lane | None:
+        """按平滑加权轮询选出下一个要处理的通道。没有可以执行的键时返回None。"""
+        total = 0
+        best: Lane | None = None
+        for lane in self.lanes.values():
+            if lane.ready:
+                lane.current += lane.weight
+                total += lane.weight
+                if best is None or lane.current > best.current:
+                    best = lane
+        if best is not None:
+            best.current -= total
+        return best
+
+    def work(self) -> None:
+        while True:
+            with self.condition:
+                while (lane := self.pick()) is None:
+                    self.condition.wait()
+                key = lane.ready.popleft()
+                queue = self.queues[key]
+                t, lane, action, future = queue.popleft()
+                self.depth -= 1
+            ok = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(action())
+                    ok = True
+                except Exception as e:  # noqa: BLE001
+                    future.set_exception(e)
+                    print("处理事件时出错")
+                    traceback.print_exc()
+            with self.condition:
+                now = time.monotonic()
+                t = now - t
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+                self.latency += (t - self.latency) * 0.1
+                self.max_latency = max(self.max_latency, t)
+                lane.processed += 1
+                lane.latency += (t - lane.latency) * 0.1
+                lane.max_latency = max(lane.max_latency, t)
+                if queue:
+                    queue[0][1].ready.append(key)
+                    self.condition.notify()
+                else:
+                    del self.queues[key]
+                    self.condition.notify_all()
+
+    def join(self, timeout: float | None = None) -> bool:
+        """等待队列中所有动作执行完毕。
+
+        :returns: 是否在超时前执行完毕。
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queues, timeout)
+
+    def stats(self) -> dict[str, Any]:
+        """队列深度与处理延迟，用于观察积压情况。"""
+        with self.condition:
+            return {
+                "depth": self.depth,
+                "capacity": self.capacity,
+                "policy": self.policy,
+                "shed": self.shed.copy(),
+                "keys": {str(key): len(queue) for key, queue in self.queues.items() if queue},
+                "processed": self.processed,
+                "failed": self.failed,
+                "latency": self.latency,
+                "max_latency": self.max_latency,
+                "lanes": {
+                    name: {
+                        "ready": len(lane.ready),
+                        "processed": lane.processed,
+                        "latency": lane.latency,
+                        "max_latency": lane.max_latency,
+                    }
+                    for name, lane in self.lanes.items()
+                },
+            }
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+from .intake import Intake, Overloaded
+
+
+def blocked(intake: Intake) -> threading.Event:
+    """占住唯一的工作线程，直到返回的Event被设置。"""
+    started = threading.Event()
+    release = threading.Event()
+    intake.submit("blocker", lambda: started.set() or release.wait(5.0))
+    assert started.wait(5.0)
+    return release
+
+
+def test_键内保持顺序():
+    intake = Intake(workers=4)
+    log: list[tuple[int, int]] = []
+    for i in range(20):
+        for key in (1, -2, 3):
+            intake.submit(key, lambda key=key, i=i: log.append((key, i)))
+    assert intake.join(5.0)
+    for key in (1, -2, 3):
+        assert [i for k, i in log if k == key] == list(range(20))
+    assert intake.stats()["processed"] == 60
+
+
+def test_慢的键不阻塞其他键():
+    intake = Intake(workers=2)
+    release = threading.Event()
+    intake.submit((-1, 2), lambda: release.wait(5.0))
+    later = intake.submit((-1, 2), time.monotonic)
+    t = time.monotonic()
+    other = intake.submit((3, 3), time.monotonic)
+    assert other.result(5.0) - t < 0.5
+    assert not later.done()
+    assert intake.stats()["keys"] == {"(-1, 2)": 1}
+    release.set()
+    assert later.result(5.0) >= t
+
+
+def test_异常不影响后续事件():
+    intake = Intake(workers=1)
+    failure = intake.submit(1, lambda: 1 / 0)
+    success = intake.submit(1, lambda: 114514)
+    assert success.result(5.0) == 114514
+    assert isinstance(failure.exception(), ZeroDivisionError)
+    assert intake.stats()["failed"] == 1
+
+
+def test_按权重轮流处理各通道():
+    intake = Intake(workers=1, lanes={"backstage": 8, "passive": 1})
+    release = blocked(intake)
+    log: list[str] = []
+    for i in range(20):
+        for lane in ("passive", "backstage"):
+            intake.submit((lane, i), lambda lane=lane: log.append(lane), lane)
+    release.set()
+    assert intake.join(5.0)
+    # 高优先级的通道先被处理，但低优先级的通道也不会被饿死。
+    assert log[:9].count("passive") == 1
+    assert log[:18].count("passive") == 2
+    stats = intake.stats()["lanes"]
+    assert stats["backstage"]["processed"] == 20
+    assert stats["passive"]["processed"] == 21
+
+
+def test_过载时不再接收被动事件():
+    intake = Intake(workers=1, capacity=2, policy="skip")
+    release = blocked(intake)
+    log: list[int] = []
+    futures = [intake.submit(i, lambda i=i: log.append(i) or i) for i in range(3)]
+    command = intake.submit(3, lambda: log.append(3) or 3, "command")
+    release.set()
+    assert [future.result(5.0) for future in futures] == [0, 1, None]
+    assert command.result(5.0) == 3
+    assert sorted(log) == [0, 1, 3]
+    assert intake.stats()["shed"] == {"skipped": 1, "dropped": 0, "rejected": 0}
+
+
+def test_过载时舍弃最早的被动事件():
+    intake = Intake(workers=1, capacity=2, policy="drop-oldest")
+    release = blocked(intake)
+    futures = [intake.submit(i, lambda i=i: i) for i in range(4)]
+    release.set()
+    assert [future.result(5.0) for future in futures] == [None, None, 2, 3]
+    assert intake.stats()["shed"]["dropped"] == 2
+    assert intake.join(5.0)
+    assert intake.stats()["depth"] == 0
+
+
+def test_过载时拒绝():
+    intake = Intake(workers=1, capacity=1, policy="reject")
+    release = blocked(intake)
+    intake.submit(1, lambda: None, "backstage")
+    with pytest.raises(Overloaded):
+        intake.submit(2, lambda: None, "backstage")
+    release.set()
+    assert intake.stats()["shed"]["rejected"] == 1
@@ -0,0 +1,173 @@
+"""发送队列。
+
+Bot.send只将发送动作放入队列便立即返回，由后台线程依次执行。
+同一会话中的动作严格按放入顺序执行，不同会话之间则并行执行。
+限速以令牌桶实现，每个会话各有一个，另有一个全局共享。
+某个会话被限速时，只有该会话的动作会推迟，工作线程会转而处理其他会话。
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+import traceback
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future
+
+
+class TokenBucket:
+    """令牌桶限速器。
+
+    平均每秒产生rate个令牌，最多积攒burst个。每执行一个动作消耗一个令牌。
+    rate为无穷大时不限速。
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """补充令牌，然后返回距离下一个令牌可用还需等待的秒数。"""
+        if math.isinf(self.rate):
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1.0
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.burst
+
+
+class Outbox:
+    """按会话排序、限速的发送队列。"""
+
+    def __init__(
+        self,
+        workers: int = 4,
+        rate: float = 1.0,
+        burst: float = 5.0,
+        global_rate: float = 4.0,
+        global_burst: float = 20.0,
+    ) -> None:
+        """
+        :param workers: 工作线程数，也就是最多同时进行的发送动作数。
+        :param rate: 每个会话每秒平均发送的消息数。
+        :param burst: 每个会话允许连续发送的消息数。
+        :param global_rate: 所有会话合计每秒平均发送的消息数。
+        :param global_burst: 所有会话合计允许连续发送的消息数。
+        """
+        self.rate = rate
+        self.burst = burst
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self.buckets: dict[int, TokenBucket] = {}
+        """各会话的令牌桶。令牌补满且队列为空的会话的令牌桶会被丢弃。"""
+        self.queues: dict[int, deque[tuple[float, Callable[[], object], Future]]] = {}
+        """从会话到(放入时间, 动作, 结果)队列的映射。只含有尚有动作未完成的会话。"""
+        self.ready: list[tuple[float, int, int]] = []
+        """可以执行下一个动作的会话构成的最小堆，条目格式为(最早执行时间, 序号, 会话)。
+
+        每个在queues中的会话要么在这个堆中，要么正在被某个工作线程执行，二者必居其一。这保证了会话内的顺序。
+        """
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.sent = 0
+        self.failed = 0
+        self.latency = 0.0
+        """从放入队列到执行完毕所经历秒数的指数移动平均。"""
+        self.max_latency = 0.0
+        for i in range(workers):
+            threading.Thread(name=f"outbox worker {i} {id(self):#x}", target=self.work, daemon=True).start()
+
+    def submit(self, context: int, action: Callable[[], object]) -> Future:
+        """将动作放入指定会话的队列。
+
+        :returns: 动作执行完毕后得到结果的Future。一般无需理会。
+        """
+        future = Future()
+        with self.condition:
+            if context not in self.queues:
+                self.queues[context] = deque()
+                heapq.heappush(self.ready, (time.monotonic(), next(self.counter), context))
+                self.condition.notify()
+            self.queues[context].append((time.monotonic(), action, future))
+        return future
+
+    def work(self) -> None:
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if self.ready and self.ready[0][0] <= now:
+                        _, _, context = heapq.heappop(self.ready)
+                        bucket = self.buckets.get(context)
+                        if bucket is None:
+                            bucket = self.buckets[context] = TokenBucket(self.rate, self.burst)
+                        if delay := max(bucket.delay(now), self.bucket.delay(now)):
+                            heapq.heappush(self.ready, (now + delay, next(self.counter), context))
+                            continue
+                        bucket.take()
+                        self.bucket.take()
+                        queue = self.queues[context]
+                        t, action, future = queue.popleft()
+                        break
+                    self.condition.wait(self.ready[0][0] - now if self.ready else None)
+            ok = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(action())
+                    ok = True
+                except Exception as e:  # noqa: BLE001
+                    future.set_exception(e)
+                    print("发送队列中的动作出错")
+                    traceback.print_exc()
+            with self.condition:
+                now = time.monotonic()
+                t = now - t
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self.latency += (t - self.latency) * 0.1
+                self.max_latency = max(self.max_latency, t)
+                if queue:
+                    heapq.heappush(self.ready, (now, next(self.counter), context))
+                else:
+                    del self.queues[context]
+                    # 顺便丢弃已经补满的空闲令牌桶，免得积累起来。
+                    for c, b in list(self.buckets.items()):
+                        if c not in self.queues and not b.delay(now) and b.full:
+                            del self.buckets[c]
+                self.condition.notify_all()
+
+    def busy(self, context: int) -> bool:
+        """指定会话是否还有动作未执行完毕。"""
+        with self.condition:
+            return context in self.queues
+
+    def join(self, timeout: float | None = None) -> bool:
+        """等待队列中所有动作执行完毕。
+
+        :returns: 是否在超时前执行完毕。
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queues, timeout)
+
+    def stats(self) -> dict[str, object]:
+        """队列深度与发送延迟，用于观察积压情况。"""
+        with self.condition:
+            return {
+                "depth": sum(len(queue) for queue in self.queues.values()),
+                "contexts": {context: len(queue) for context, queue in self.queues.items() if queue},
+                "sent": self.sent,
+                "failed": self.failed,
+                "latency": self.latency,
+                "max_latency": self.max_latency,
+            }
@@ -0,0 +1,57 @@
+import math
+import threading
+import time
+
+from .outbox import Outbox, TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(2.0, 3.0)
+    now = bucket.last
+    for _ in range(3):
+        assert bucket.delay(now) == 0.0
+        bucket.take()
+    assert bucket.delay(now) == 0.5
+    assert bucket.delay(now + 0.25) == 0.25
+    assert bucket.delay(now + 0.5) == 0.0
+    assert TokenBucket(math.inf, 0.0).delay(now) == 0.0
+
+
+def test_会话内保持顺序():
+    outbox = Outbox(workers=4, rate=math.inf, global_rate=math.inf)
+    log: list[tuple[int, int]] = []
+    for i in range(20):
+        for context in (1, -2, 3):
+            outbox.submit(context, lambda context=context, i=i: log.append((context, i)))
+    assert outbox.join(5.0)
+    for context in (1, -2, 3):
+        assert [i for c, i in log if c == context] == list(range(20))
+    assert outbox.stats()["sent"] == 60
+
+
+def test_会话间并行():
+    outbox = Outbox(workers=2, rate=math.inf, global_rate=math.inf)
+    barrier = threading.Barrier(2, timeout=5.0)
+    a = outbox.submit(1, barrier.wait)
+    b = outbox.submit(2, barrier.wait)
+    assert a.result(5.0) in (0, 1)
+    assert b.result(5.0) in (0, 1)
+
+
+def test_限速不阻塞其他会话():
+    outbox = Outbox(workers=1, rate=1.0, burst=1.0, global_rate=math.inf)
+    t = time.monotonic()
+    outbox.submit(1, lambda: None)
+    slow = outbox.submit(1, time.monotonic)
+    fast = outbox.submit(2, time.monotonic)
+    assert fast.result(5.0) - t < 0.5
+    assert slow.result(5.0) - t >= 0.9
+
+
+def test_异常不影响后续动作():
+    outbox = Outbox(workers=1, rate=math.inf, global_rate=math.inf)
+    failure = outbox.submit(1, lambda: 1 / 0)
+    success = outbox.submit(1, lambda: 114514)
+    assert success.result(5.0) == 114514
+    assert isinstance(failure.exception(), ZeroDivisionError)
+    assert outbox.stats()["failed"] == 1
@@ -32,9 +32,9 @@ def encav(avid: int) -> str:
 
 
 class AV_BV(pykinezumiko.Plugin):
+    @pykinezumiko.trigger(r"bilibili\.com\/video\/BV|BV1..4.1.7..|\bb23\.tv\b")
     def on_message(self, event: pykinezumiko.Event):
-        if re.search(r"bilibili\.com\/video\/BV|BV1..4.1.7..|\bb23\.tv\b", event.text):
-            return self.av_bv(event.text)
+        return self.av_bv(event.text)
 
     def av_bv(self, text: str):
         bv = {bv: decbv(bv) for bv in re.findall(r"BV1\w\w4\w1\w7\w\w", text, re.ASCII)}
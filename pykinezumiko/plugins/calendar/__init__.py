@@ -1,11 +1,8 @@
 import datetime
 import importlib.resources
-import threading
-import time
-import traceback
 from bisect import bisect
 
-from pykinezumiko import Event, Plugin, conf
+from pykinezumiko import Event, Plugin, conf, scheduled
 
 CHINESE_CALENDAR_DATA = importlib.resources.files().joinpath("chinese.txt").read_text().splitlines()
 JIEQI_DATA = importlib.resources.files().joinpath("jieqi.txt").read_bytes().splitlines()
@@ -61,7 +58,12 @@ class Calendar(Plugin):
         self.path = "data_calendar.txt"
         """记载最后一次定时发送日历的时间的文件路径。"""
 
-        threading.Thread(name=f"calendar scheduler {id(self):#x}", target=self.loop, daemon=True).start()
+        try:
+            with open(self.path, "r") as f:
+                self.last = datetime.date.fromisoformat(f.readline().strip())
+        except FileNotFoundError:
+            self.last = datetime.date(1601, 1, 1)
+            # 明朝万历二十九年，明神宗命令工部建造云端服务器
 
     @staticmethod
     def calendar(t: datetime.datetime | None = None) -> str:
@@ -84,26 +86,15 @@ class Calendar(Plugin):
         """.today（日历）"""
         return self.calendar()
 
-    def loop(self):
-        try:
-            with open(self.path, "r") as f:
-                last = datetime.date.fromisoformat(f.readline().strip())
-        except FileNotFoundError:
-            last = datetime.date(1601, 1, 1)
-            # 明朝万历二十九年，明神宗命令工部建造云端服务器
-
-        while True:
-            try:
-                t = datetime.datetime.now()
-                # 您希望使用哪一个？
-                # 我们在云上的数据和此台设备上的不同。
-                if t.date() != last and t.hour >= 4:
-                    # 鹰历日期变更
-                    last = t.date()
-                    with open(self.path, "w") as f:
-                        print(last.isoformat(), file=f)
-                    self.bot.send(conf.BACKSTAGE, self.calendar())
-            except Exception:
-                print("发送日历出错")
-                traceback.print_exc()
-            time.sleep(114)
+    # 启动时补发今天还没有发送的日历。
+    @scheduled("0 4 * * *", startup=True)
+    def post(self) -> None:
+        t = datetime.datetime.now()
+        # 您希望使用哪一个？
+        # 我们在云上的数据和此台设备上的不同。
+        if t.date() != self.last and t.hour >= 4:
+            # 鹰历日期变更
+            self.last = t.date()
+            with open(self.path, "w") as f:
+                print(self.last.isoformat(), file=f)
+            self.bot.send(conf.BACKSTAGE, self.calendar())
@@ -92,3 +92,11 @@ def test_jieqi_properties(t: datetime.date):
 )
 def test_calendar(t, snapshot):
     assert Calendar.calendar(t) == snapshot
+
+
+def test_实例化(tmp_path, monkeypatch):
+    # 插件加载以外的场合也能实例化，启动时的补发交给scheduler.register。
+    monkeypatch.chdir(tmp_path)
+    calendar = Calendar()
+    assert calendar.last == datetime.date(1601, 1, 1)
+    assert Calendar.post.scheduled.startup  # type: ignore
@@ -3,9 +3,9 @@ import pickle
 import re
 import threading
 import time
-from typing import NoReturn
+from functools import partial
 
-from pykinezumiko import Event, Plugin
+from pykinezumiko import Event, Later, Plugin, scheduled
 from pykinezumiko.humanity import CommandSyntaxError, format_timespan
 
 
@@ -15,11 +15,13 @@ class Clock(Plugin):
 
     按时间从早到晚排序。
     条目格式：(浮点触发时间戳, 上下文, 回复内容)。
+    命令在处理事件的线程中添加提醒，提醒则在计划任务线程中移除，所以读写时须持有lock。
     """
 
     def __init__(self) -> None:
         self.path = "data_clock.pickle"
         """提醒队列文件路径。"""
+        self.lock = threading.Lock()
 
         try:
             with open(self.path, "rb") as f:
@@ -31,7 +33,13 @@ class Clock(Plugin):
             assert isinstance(t, float) and isinstance(c, int) and isinstance(s, str), "提醒队列文件数据类型错误"
         self.q.sort()
 
-        threading.Thread(name=f"clock scheduler {id(self):#x}", target=self.loop, daemon=True).start()
+    @scheduled(startup=True)
+    def restore(self) -> None:
+        """重新安排上次运行时尚未到时间的提醒。"""
+        with self.lock:
+            reminders = list(self.q)
+        for reminder in reminders:
+            self.scheduler.at(reminder[0], partial(self.remind, reminder))
 
     def on_command_clock(self, event: Event):
         """.clock ⟨秒后⟩ [注释]（定时器·计划任务）
@@ -59,22 +67,28 @@ class Clock(Plugin):
             return "#{format_timespan(t)}对于木鼠子来说太长了。"
         title = event.text[: match.start()] + event.text[match.end() :].strip()
         if t > 600:
-            bisect.insort(self.q, (time.time() + t, event.context, title))
-            with open(self.path, "wb") as f:
-                pickle.dump(self.q, f)
+            reminder = time.time() + t, event.context, title
+            with self.lock:
+                bisect.insort(self.q, reminder)
+                self.save()
+            self.scheduler.at(reminder[0], partial(self.remind, reminder))
             return f"计划任务 [{title}] 于 {format_timespan(t).removesuffix(' 0 秒')}后。"
         else:
             self.bot.send(event.context, f"定时器将在 {format_timespan(t)}后响铃。")
-            time.sleep(t)
-            return "定时器时间到" + ("：\n‣ " + title if title else "。")
+            return Later(t, "定时器时间到" + ("：\n‣ " + title if title else "。"))
 
-    def loop(self) -> NoReturn:
-        while True:
-            # 如果提醒队列非空且第一个提醒到时间了就提醒用户
-            while self.q and self.q[0][0] < time.time():
-                _, target, title = self.q.pop(0)
-                with open(self.path, "wb") as f:
-                    pickle.dump(self.q, f)
-                self.bot.send(target, f"现在有下列计划任务。\n‣ {title}")
-                time.sleep(1)
-            time.sleep(60)
+    def save(self) -> None:
+        """保存提醒队列。调用方须持有lock。"""
+        with open(self.path, "wb") as f:
+            pickle.dump(self.q, f)
+
+    def remind(self, reminder: tuple[float, int, str]) -> None:
+        """到时间了就提醒用户。"""
+        _, target, title = reminder
+        with self.lock:
+            # 同一提醒可能被安排了两次（启动时恰好有人添加了提醒），只提醒一次。
+            if reminder not in self.q:
+                return
+            self.q.remove(reminder)
+            self.save()
+        self.bot.send(target, f"现在有下列计划任务。\n‣ {title}")
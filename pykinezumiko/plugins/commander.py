@@ -34,7 +34,8 @@ class Commander(pykinezumiko.Plugin):
         )
         subprocess.run(["git", "pull", "--no-rebase", "--no-edit"], check=True)
         subprocess.run(["git", "push"], check=True)
-        # 尝试启动新的版本。
+        # 尝试启动新的版本。新进程启动时会载入名称缓存的快照，先保存一份最新的。
+        self.bot.save_names()
         print("启动")
         process = subprocess.Popen([sys.executable, "-m", "pykinezumiko", "通过.reload启动"])
         try:
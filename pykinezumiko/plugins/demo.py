@@ -1,19 +1,29 @@
-import pathlib
 import random
 import re
-import time
 from collections.abc import Generator
 from typing import override
 
-from pykinezumiko import Event, Plugin, documented, humanity
+from pykinezumiko import (
+    Event,
+    Flow,
+    Later,
+    Media,
+    Plugin,
+    documented,
+    flow_timeout,
+    humanity,
+    trigger,
+    typesetting,
+)
 
 
 class Demonstration(Plugin):
     """演示各种功能的插件。"""
 
     @override
+    @trigger(r"\^\Z", keywords=["More?"])
     def on_message(self, event: Event):
-        # 可以使用任意字符串判据。（废话。）
+        # 可以用trigger装饰器粗略筛选，再使用任意字符串判据。（废话。）
         if not event.text.startswith("^") and event.text.endswith("^") or event.text == "More?":
             return "More?"
 
@@ -32,10 +42,10 @@ class Demonstration(Plugin):
     def on_command_debug_t(self, event: Event):
         self.bot.send(event.context, "8 秒后，将被回调。")
         # 在这8秒内，其他命令能否响应？
-        time.sleep(8)
-        return "被回调。"
+        return Later(8, "被回调。")
 
     @documented()
+    @flow_timeout(600)
     def on_command_猜数字(self, event: Event) -> Generator[str, str, None | bool | str]:
         # 注意观察下列代码与控制台程序有多么相像。
         def number_guessing_in_console() -> None:
@@ -58,24 +68,33 @@ class Demonstration(Plugin):
         # 这和应用程序与用户界面框架的主从关系近几十年来的反转有关。
         # 实际上，在现代操作系统中，input函数内部的系统调用以类似yield的方式实现。
         x = random.randint(1, 100)
-        guess = yield "我从 1～100 中随机选了一个整数。猜对了也没有奖励，猜错了也没有惩罚。"
-        while guess.isnumeric():
-            guess = int(guess)
-            if guess < x:
-                guess = yield "太小了。"
-            elif guess > x:
-                guess = yield "太大了。"
-            else:
-                return "猜对了！"
+        try:
+            guess = yield "我从 1～100 中随机选了一个整数。猜对了也没有奖励，猜错了也没有惩罚。"
+            while guess.isnumeric():
+                guess = int(guess)
+                if guess < x:
+                    guess = yield "太小了。"
+                elif guess > x:
+                    guess = yield "太大了。"
+                else:
+                    return "猜对了！"
+        except GeneratorExit:
+            # 十分钟没有回答的话，对话流程会被关闭。
+            self.bot.send(event.context, f"太久没有回答，游戏结束。正确答案是 {x}。")
+            raise
         return f"游戏结束。正确答案是 {x}。"
 
     def on_command_debug_next(self, event: Event):
         n = max(1, int(event.text or "1"))
         if n > 9:
             return "注意，即使 .debug cls 也无法清除待回显的状态。请再考虑一下。"
-        text = yield f"将回显接下来的 {n} 条消息。"
-        for _ in range(n - 1):
-            text = yield text
+        # 与其他对话流程不同，这里没有使用生成器，而是返回Flow，因此重启后仍会继续回显。
+        return Flow(self.echo_next, f"将回显接下来的 {n} 条消息。", n=n)
+
+    def echo_next(self, flow: Flow, text: str):
+        flow.data["n"] -= 1
+        if flow.data["n"]:
+            return flow.goto(self.echo_next, text)
         return text
 
     def on_command_debug_repr(self, event: Event):
@@ -89,9 +108,8 @@ class Demonstration(Plugin):
         return f"\a<Emoticon {id}> = {id}"
 
     def on_command_debug_img(self, event: Event):
-        raise NotImplementedError()
-        uri = pathlib.Path("pykinezumiko/resources/sample.png").resolve().as_uri()
-        return f"查看下列图片：\a<Image {uri}>"
+        # 图片不必先保存为文件，可以和文字拼成列表直接返回。
+        return ["查看下列图片：", Media.image(typesetting.render_cache.png(event.text or "木鼠子"))]
 
 
 class DebugJSON(Plugin):
@@ -56,6 +56,7 @@ class SauceNAO(pykinezumiko.Plugin):
     既然img2img非常火，那么就叫img4img吧，取search for之for之意。
     """
 
+    @pykinezumiko.flow_timeout(300)
     def on_command_img(self, event: pykinezumiko.Event):
         x = event.text
         for i in range(2):
@@ -0,0 +1,276 @@
+"""计划任务。
+
+所有计划任务共用一个线程。任务按触发时间放在最小堆中，线程只在最早的任务到时间时醒来，不必定期轮询。
+时间都是time.time()时间戳，以便与日历时间和cron表达式对应。
+
+任务的动作在调度线程中执行，应当很快完成，否则会推迟其他任务。
+耗时的动作请交给其他线程，例如Bot.pool。
+"""
+
+import datetime
+import heapq
+import inspect
+import itertools
+import random
+import threading
+import time
+import traceback
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import TypeVar
+
+CallableT = TypeVar("CallableT", bound=Callable)
+
+
+class Cron:
+    """cron表达式，形如"分 时 日 月 星期"。
+
+    每个字段可以是*、数字、范围a-b、步长*/n或a-b/n，以及用逗号分隔的若干个这样的项。星期中0和7都表示星期日。
+    同时限定了日和星期时，两者满足其一即可，与通常的cron相同。
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    """各字段的取值范围。"""
+
+    def __init__(self, expression: str) -> None:
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron表达式须有5个字段：{expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parse(field, low, high) for field, (low, high) in zip(fields, self.FIELDS)
+        )
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        self.any_day = fields[2].startswith("*")
+        self.any_weekday = fields[4].startswith("*")
+
+    @staticmethod
+    def parse(field: str, low: int, high: int) -> frozenset[int]:
+        values: set[int] = set()
+        for item in field.split(","):
+            span, slash, step = item.partition("/")
+            if span == "*":
+                start, stop = low, high
+            else:
+                start, dash, stop = span.partition("-")
+                start = int(start)
+                stop = int(stop) if dash else high if slash else start
+            if not low <= start <= stop <= high or slash and int(step) <= 0:
+                raise ValueError(f"无效的cron字段：{field}")
+            values.update(range(start, stop + 1, int(step) if slash else 1))
+        return frozenset(values)
+
+    def matches_day(self, t: datetime.datetime) -> bool:
+        day = t.day in self.days
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next(self, after: float) -> float:
+        """返回after之后（不含）最早的触发时间戳。"""
+        t = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+        t += datetime.timedelta(minutes=1)
+        # 闰日与星期的组合至多28年循环一次。
+        limit = t.year + 28
+        while t.year <= limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t.timestamp()
+        raise ValueError(f"cron表达式永远不会触发：{self.expression}")
+
+
+@dataclass(eq=False)
+class Job:
+    """计划任务。由Scheduler的方法创建，可以用Scheduler.cancel取消。"""
+
+    action: Callable[[], object]
+    when: float
+    """下一次预定的触发时间戳，不含随机推迟。"""
+    repeat: Callable[[float], float] | None = None
+    """从本次预定的触发时间得到下一次预定的触发时间的函数。None表示只执行一次。"""
+    jitter: float = 0.0
+    """每次触发时随机推迟至多这么多秒，以免许多任务挤在同一时刻。"""
+    name: str = ""
+    cancelled: bool = False
+
+
+@dataclass
+class Schedule:
+    """由scheduled装饰器添加到方法的scheduled属性上的触发时间。"""
+
+    cron: Cron | None
+    every: float | None
+    jitter: float
+    startup: bool = False
+    """登记时是否立即执行一次。"""
+
+
+class Scheduler:
+    """以最小堆实现的计划任务调度器。线程安全。"""
+
+    def __init__(self) -> None:
+        self.heap: list[tuple[float, int, Job]] = []
+        """(触发时间戳, 序号, 任务)的最小堆。
+
+        序号使同时触发的任务按加入的顺序执行。已取消的任务留在堆中，到时间时才被丢弃。
+        """
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.ran = 0
+        self.failed = 0
+        self.lateness = 0.0
+        """实际执行时间晚于触发时间的秒数的指数移动平均。"""
+        self.max_lateness = 0.0
+        threading.Thread(name=f"scheduler {id(self):#x}", target=self.run, daemon=True).start()
+
+    def schedule(self, job: Job) -> Job:
+        """按任务的when把任务放入堆中。"""
+        t = job.when + random.uniform(0.0, job.jitter) if job.jitter else job.when
+        with self.condition:
+            heapq.heappush(self.heap, (t, next(self.counter), job))
+            if self.heap[0][2] is job:
+                self.condition.notify()
+        return job
+
+    def at(
+        self, when: float | datetime.datetime, action: Callable[[], object], jitter: float = 0.0, name: str = ""
+    ) -> Job:
+        """在指定的时间戳或时刻执行一次。"""
+        if isinstance(when, datetime.datetime):
+            when = when.timestamp()
+        return self.schedule(Job(action, when, jitter=jitter, name=name))
+
+    def after(self, delay: float, action: Callable[[], object], jitter: float = 0.0, name: str = "") -> Job:
+        """在delay秒后执行一次。"""
+        return self.schedule(Job(action, time.time() + delay, jitter=jitter, name=name))
+
+    def every(self, interval: float, action: Callable[[], object], jitter: float = 0.0, name: str = "") -> Job:
+        """从interval秒后起，每隔interval秒执行一次。"""
+        return self.schedule(
+            Job(action, time.time() + interval, lambda t: t + interval, jitter=jitter, name=name)
+        )
+
+    def cron(
+        self, expression: str | Cron, action: Callable[[], object], jitter: float = 0.0, name: str = ""
+    ) -> Job:
+        """在符合cron表达式的时刻执行。"""
+        if isinstance(expression, str):
+            expression = Cron(expression)
+        return self.schedule(Job(action, expression.next(time.time()), expression.next, jitter, name))
+
+    def cancel(self, job: Job) -> None:
+        """取消任务。正在执行的任务不受影响，但不会再重复。"""
+        job.cancelled = True
+
+    def register(self, obj: object) -> list[Job]:
+        """把对象中用scheduled装饰的方法登记为计划任务。"""
+        jobs: list[Job] = []
+        for name, method in inspect.getmembers(obj, callable):
+            if isinstance(schedule := getattr(method, "scheduled", None), Schedule):
+                label = f"{type(obj).__name__}.{name}"
+                if schedule.cron is not None:
+                    jobs.append(self.cron(schedule.cron, method, schedule.jitter, label))
+                elif schedule.every is not None:
+                    jobs.append(self.every(schedule.every, method, schedule.jitter, label))
+                if schedule.startup:
+                    jobs.append(self.after(0.0, method, name=label))
+        return jobs
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        return
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    # 定时醒来一次，以免系统时钟被调整后睡过头。
+                    self.condition.wait(min(delay, 3600.0))
+                t, _, job = heapq.heappop(self.heap)
+            if job.cancelled:
+                continue
+            now = time.time()
+            try:
+                job.action()
+                ok = True
+            except Exception:  # noqa: BLE001
+                ok = False
+                print("执行计划任务时出错", job.name or job.action)
+                traceback.print_exc()
+            with self.condition:
+                if ok:
+                    self.ran += 1
+                else:
+                    self.failed += 1
+                self.lateness += (now - t - self.lateness) * 0.1
+                self.max_lateness = max(self.max_lateness, now - t)
+            if job.repeat is not None and not job.cancelled:
+                # 错过的触发不再补上。
+                job.when = job.repeat(job.when)
+                if job.when <= time.time():
+                    job.when = job.repeat(time.time())
+                self.schedule(job)
+
+    def close(self) -> None:
+        """停止执行任务。"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self) -> dict[str, object]:
+        with self.condition:
+            return {
+                "jobs": sum(not job.cancelled for _, _, job in self.heap),
+                "next": self.heap[0][0] - time.time() if self.heap else None,
+                "ran": self.ran,
+                "failed": self.failed,
+                "lateness": self.lateness,
+                "max_lateness": self.max_lateness,
+            }
+
+
+def scheduled(cron: str | None = None, every: float | None = None, jitter: float = 0.0, startup: bool = False):
+    """使用此装饰器把插件方法登记为计划任务。方法不接受参数。
+
+        @pykinezumiko.scheduled("0 4 * * *")
+        def post_calendar(self):
+            ...
+
+        @pykinezumiko.scheduled(every=3600, jitter=60)
+        def refresh(self):
+            ...
+
+        @pykinezumiko.scheduled(startup=True)
+        def restore(self):
+            ...
+
+    :param cron: cron表达式，参照Cron类。
+    :param every: 每隔多少秒执行一次。
+    :param jitter: 每次触发时随机推迟至多这么多秒。
+    :param startup: 登记时（即插件加载后）立即执行一次，例如补做停机期间错过的任务。
+        只指定startup的话，只在登记时执行这一次。
+    """
+    if cron is not None and every is not None or cron is None and every is None and not startup:
+        raise TypeError("cron和every须指定且只能指定其一，除非只在登记时执行")
+    schedule = Schedule(Cron(cron) if cron is not None else None, every, jitter, startup)
+
+    def decorator(f: CallableT) -> CallableT:
+        f.scheduled = schedule  # type: ignore
+        return f
+
+    return decorator
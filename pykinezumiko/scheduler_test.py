@@ -0,0 +1,110 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from .scheduler import Cron, Scheduler, scheduled
+
+
+def next_time(expression: str, after: str) -> str:
+    t = Cron(expression).next(datetime.datetime.fromisoformat(after).timestamp())
+    return datetime.datetime.fromtimestamp(t).isoformat(" ", "minutes")
+
+
+def test_cron():
+    assert next_time("0 4 * * *", "2026-10-16 03:00") == "2026-10-16 04:00"
+    assert next_time("0 4 * * *", "2026-10-16 04:00") == "2026-10-17 04:00"
+    # 2026-10-16是星期五。
+    assert next_time("*/15 9-17 * * 1-5", "2026-10-16 17:50") == "2026-10-19 09:00"
+    assert next_time("30 8 1,15 * *", "2026-12-20 00:00") == "2027-01-01 08:30"
+    assert next_time("0 0 29 2 *", "2026-10-16 00:00") == "2028-02-29 00:00"
+    # 同时限定日和星期时，满足其一即可。
+    assert next_time("0 0 13 * 5", "2026-10-16 00:00") == "2026-10-23 00:00"
+    assert next_time("0 0 * * 7", "2026-10-16 00:00") == "2026-10-18 00:00"
+    for expression in ("* * * *", "60 * * * *", "* * 0 * *", "*/0 * * * *", "a * * * *"):
+        with pytest.raises(ValueError):
+            Cron(expression)
+    with pytest.raises(ValueError):
+        Cron("0 0 30 2 *").next(0.0)
+
+
+def test_执行顺序():
+    scheduler = Scheduler()
+    order: list[str] = []
+    done = threading.Event()
+    scheduler.after(0.1, lambda: (order.append("c"), done.set()))
+    scheduler.after(0.05, lambda: order.append("b"))
+    scheduler.at(time.time(), lambda: order.append("a"))
+    assert done.wait(5.0)
+    assert order == ["a", "b", "c"]
+    scheduler.close()
+
+
+def test_重复与取消():
+    scheduler = Scheduler()
+    count = 0
+    done = threading.Event()
+
+    def tick() -> None:
+        nonlocal count
+        count += 1
+        if count == 3:
+            scheduler.cancel(job)
+            done.set()
+        if count == 2:
+            raise RuntimeError("第二次出错不影响之后的执行")
+
+    job = scheduler.every(0.01, tick)
+    assert done.wait(5.0)
+    time.sleep(0.05)
+    assert count == 3
+    stats = scheduler.stats()
+    assert stats["jobs"] == 0
+    assert stats["ran"] == 2
+    assert stats["failed"] == 1
+    scheduler.close()
+
+
+def test_随机推迟():
+    scheduler = Scheduler()
+    now = time.time()
+    for _ in range(10):
+        scheduler.at(now + 100.0, lambda: None, jitter=10.0)
+    assert all(now + 100.0 <= t <= now + 110.0 for t, _, _ in scheduler.heap)
+    assert len({t for t, _, _ in scheduler.heap}) > 1
+    scheduler.close()
+
+
+class Ticker:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.started = threading.Event()
+        self.once_count = 0
+
+    @scheduled(every=0.01)
+    def tick(self) -> None:
+        self.done.set()
+
+    @scheduled("0 4 * * *", startup=True)
+    def daily(self) -> None:
+        self.started.set()
+
+    @scheduled(startup=True)
+    def once(self) -> None:
+        self.once_count += 1
+
+
+def test_登记():
+    scheduler = Scheduler()
+    ticker = Ticker()
+    jobs = scheduler.register(ticker)
+    assert sorted(job.name for job in jobs) == ["Ticker.daily", "Ticker.daily", "Ticker.once", "Ticker.tick"]
+    assert ticker.done.wait(5.0)
+    assert ticker.started.wait(5.0)
+    assert ticker.once_count == 1
+    scheduler.close()
+    with pytest.raises(TypeError):
+        scheduled("0 4 * * *", every=60)
+    with pytest.raises(TypeError):
+        scheduled()
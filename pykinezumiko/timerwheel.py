@@ -0,0 +1,69 @@
+"""哈希时间轮。
+
+时间被划分为长resolution秒的刻度，刻度对槽数取模得到槽。每个定时器放进其到期刻度所在的槽中。
+设置、重设和取消定时器都只需O(1)时间；推进时间轮时只检查经过的槽，而不必扫描所有定时器。
+到期时间超过一圈的定时器留在槽中，等转到它所在的那一圈时才到期。
+"""
+
+import math
+import time
+
+
+class TimerWheel[K]:
+    """以键标识定时器的哈希时间轮。不是线程安全的，由调用方加锁。
+
+    定时器不会提前到期，但可能推迟至多一个刻度，以及两次推进之间的间隔。
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 512) -> None:
+        """
+        :param resolution: 每个刻度的秒数。
+        :param slots: 槽数。到期时间在slots个刻度之内的定时器不必在推进时反复检查。
+        """
+        self.resolution = resolution
+        self.slots = [set[K]() for _ in range(slots)]
+        self.deadlines: dict[K, int] = {}
+        """从键到到期刻度的映射。"""
+        self.tick = int(time.monotonic() / resolution)
+        """下一个要检查的刻度。此前的刻度都已经处理过了。"""
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.deadlines
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def schedule(self, key: K, delay: float) -> None:
+        """设置键的定时器在delay秒后到期。已有的定时器会被重设。"""
+        self.cancel(key)
+        tick = max(math.ceil((time.monotonic() + delay) / self.resolution), self.tick)
+        self.deadlines[key] = tick
+        self.slots[tick % len(self.slots)].add(key)
+
+    def cancel(self, key: K) -> bool:
+        """取消键的定时器。
+
+        :returns: 是否有定时器被取消。
+        """
+        tick = self.deadlines.pop(key, None)
+        if tick is None:
+            return False
+        self.slots[tick % len(self.slots)].discard(key)
+        return True
+
+    def advance(self) -> list[K]:
+        """推进到当前时刻，取出所有到期的定时器。
+
+        :returns: 到期的键，按到期时间从早到晚排序。
+        """
+        now = int(time.monotonic() / self.resolution)
+        expired: list[tuple[int, K]] = []
+        # 落后超过一圈时，每个槽也只需检查一次。
+        for tick in range(self.tick, min(now + 1, self.tick + len(self.slots))):
+            slot = self.slots[tick % len(self.slots)]
+            for key in [key for key in slot if self.deadlines[key] <= now]:
+                slot.remove(key)
+                expired.append((self.deadlines.pop(key), key))
+        self.tick = max(self.tick, now + 1)
+        expired.sort(key=lambda x: x[0])
+        return [key for _, key in expired]
@@ -0,0 +1,42 @@
+from .timerwheel import TimerWheel
+
+
+def test_到期(clock):
+    wheel = TimerWheel[str](resolution=1.0, slots=8)
+    wheel.schedule("a", 5.0)
+    wheel.schedule("b", 1.5)
+    wheel.schedule("c", 3.0)
+    clock[0] += 1.0
+    assert wheel.advance() == []
+    clock[0] += 1.0
+    assert wheel.advance() == ["b"]
+    clock[0] += 1.0
+    assert wheel.advance() == ["c"]
+    clock[0] += 10.0
+    assert wheel.advance() == ["a"]
+    assert len(wheel) == 0
+
+
+def test_重设与取消(clock):
+    wheel = TimerWheel[str](resolution=1.0, slots=8)
+    wheel.schedule("a", 2.0)
+    wheel.schedule("b", 2.0)
+    clock[0] += 1.0
+    wheel.schedule("a", 2.0)
+    assert wheel.cancel("b")
+    assert not wheel.cancel("b")
+    clock[0] += 1.0
+    assert wheel.advance() == []
+    assert "a" in wheel
+    clock[0] += 1.0
+    assert wheel.advance() == ["a"]
+
+
+def test_超过一圈(clock):
+    wheel = TimerWheel[int](resolution=1.0, slots=8)
+    for i in range(30):
+        wheel.schedule(i, 30.0 - i)
+    clock[0] += 9.0
+    assert wheel.advance() == list(range(29, 20, -1))
+    clock[0] += 100.0
+    assert wheel.advance() == list(range(20, -1, -1))
@@ -0,0 +1,218 @@
+"""与OneBot实现之间的连接方式。
+
+Bot.call通过传输层调用API，传输层只负责把请求送到OneBot实现并取回响应的JSON对象，不检查响应内容。
+
+- HTTPTransport：向OneBot实现的HTTP服务器POST请求。事件另由OneBot实现POST到本程序的HTTP服务器。
+- ForwardWebSocketTransport：本程序作为客户端连接到OneBot实现的WebSocket服务器（正向WebSocket）。
+- ReverseWebSocketTransport：OneBot实现作为客户端连接到本程序的WebSocket服务器（反向WebSocket）。
+
+WebSocket连接是全双工的，API请求与事件上报共用同一条连接。
+请求带有echo字段，响应原样带回，据此可以在同一条连接上同时进行多个请求。
+
+WebSocket传输需要websockets包（可选依赖websockets）。只用HTTP的话不必安装，因此仅在用到时导入。
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+import time
+import traceback
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any
+
+import httpx
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+if TYPE_CHECKING:
+    from websockets.sync.client import ClientConnection
+
+
+class Transport(ABC):
+    """传输层的基类。"""
+
+    @abstractmethod
+    def request(self, endpoint: str, params: dict[str, Any], timeout: float | None = None) -> dict[str, Any]:
+        """调用API并返回OneBot实现的响应。
+
+        :param timeout: 超时秒数。None表示使用传输层的默认值。
+        """
+
+    def close(self) -> None:
+        """断开连接。"""
+
+
+class HTTPTransport(Transport):
+    def __init__(self, base_url: str = "http://127.0.0.1:5700", uds: str | None = None) -> None:
+        """
+        :param base_url: OneBot实现的HTTP API地址。
+        :param uds: Unix域套接字路径。给出时经由该套接字连接，base_url中的主机名和端口仅用于请求头。
+        """
+        # 给出transport时，httpx.Client会忽略自己的limits参数，所以连接池的设置要交给transport。
+        limits = httpx.Limits(max_connections=16, max_keepalive_connections=8, keepalive_expiry=60.0)
+        self.client = httpx.Client(
+            base_url=base_url,
+            transport=httpx.HTTPTransport(uds=uds, limits=limits),
+            timeout=httpx.Timeout(10.0, connect=3.0),
+        )
+        """与OneBot实现之间保持连接的HTTP客户端。
+
+        连接在调用之间复用，免去每次请求重新握手的开销。httpx.Client是线程安全的。
+        """
+
+    def request(self, endpoint: str, params: dict[str, Any], timeout: float | None = None) -> dict[str, Any]:
+        return self.client.post(
+            f"/{endpoint}",
+            json=params,
+            timeout=httpx.USE_CLIENT_DEFAULT if timeout is None else timeout,
+        ).json()
+
+    def close(self) -> None:
+        self.client.close()
+
+
+class WebSocketTransport(Transport):
+    """两种WebSocket传输的共同部分：以echo字段区分同时进行的请求，并将事件转交给on_event。"""
+
+    def __init__(self, timeout: float = 10.0) -> None:
+        """
+        :param timeout: 请求的默认超时秒数。尚未连接时，也会等待连接这么久。
+        """
+        self.timeout = timeout
+        self.connected = threading.Event()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.pending: dict[int, Future[dict[str, Any]]] = {}
+        """从echo到等待响应的Future的映射。"""
+
+    def on_event(self, data: dict[str, Any], /) -> object:
+        """收到事件时调用的函数。它在接收连接数据的线程中执行，因此不应阻塞。
+
+        在准备好处理事件之前，用赋值覆盖此方法即可。默认丢弃事件。
+        """
+        print("尚未准备好处理事件，丢弃", data)
+
+    def request(self, endpoint: str, params: dict[str, Any], timeout: float | None = None) -> dict[str, Any]:
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        if not self.connected.wait(timeout):
+            raise ConnectionError("OneBot实现未通过WebSocket连接")
+        future = Future[dict[str, Any]]()
+        with self.lock:
+            echo = next(self.counter)
+            self.pending[echo] = future
+        try:
+            self.transmit(json.dumps({"action": endpoint, "params": params, "echo": echo}, ensure_ascii=False))
+            return future.result(max(0.0, deadline - time.monotonic()))
+        finally:
+            with self.lock:
+                self.pending.pop(echo, None)
+
+    @abstractmethod
+    def transmit(self, message: str) -> None:
+        """发送一条WebSocket消息。"""
+
+    def receive(self, message: str | bytes) -> None:
+        """处理收到的一条WebSocket消息。"""
+        data = json.loads(message)
+        if "post_type" in data:
+            self.on_event(data)
+        elif isinstance(echo := data.get("echo"), int):
+            with self.lock:
+                future = self.pending.get(echo)
+            if future is not None and not future.done():
+                future.set_result(data)
+        else:
+            print("收到无法识别的WebSocket消息", data)
+
+    def disconnected(self) -> None:
+        """连接断开时，令所有等待中的请求失败。"""
+        self.connected.clear()
+        with self.lock:
+            pending = list(self.pending.values())
+        for future in pending:
+            if not future.done():
+                future.set_exception(ConnectionError("WebSocket连接已断开"))
+
+
+class ForwardWebSocketTransport(WebSocketTransport):
+    """正向WebSocket。由后台线程连接，断线后自动重连。"""
+
+    def __init__(self, url: str = "ws://127.0.0.1:5700", timeout: float = 10.0) -> None:
+        super().__init__(timeout)
+        self.url = url
+        self.connection: ClientConnection | None = None
+        self.send_lock = threading.Lock()
+        self.closing = False
+        threading.Thread(name=f"websocket client {id(self):#x}", target=self.run, daemon=True).start()
+
+    def run(self) -> None:
+        from websockets.sync.client import connect
+
+        while not self.closing:
+            try:
+                with connect(self.url, max_size=None, proxy=None) as self.connection:
+                    print("已连接到", self.url)
+                    self.connected.set()
+                    for message in self.connection:
+                        self.receive(message)
+            except Exception:  # noqa: BLE001
+                if not self.closing:
+                    print("WebSocket连接出错，3秒后重连")
+                    traceback.print_exc()
+            finally:
+                self.connection = None
+                self.disconnected()
+            if not self.closing:
+                time.sleep(3.0)
+
+    def transmit(self, message: str) -> None:
+        connection = self.connection
+        if connection is None:
+            raise ConnectionError("WebSocket连接已断开")
+        with self.send_lock:
+            connection.send(message)
+
+    def close(self) -> None:
+        self.closing = True
+        if connection := self.connection:
+            connection.close()
+
+
+class ReverseWebSocketTransport(WebSocketTransport):
+    """反向WebSocket。将serve方法注册为Starlette的WebSocket路由，等待OneBot实现连接。
+
+    同一时间只使用最后建立的一条连接。
+    """
+
+    def __init__(self, timeout: float = 10.0) -> None:
+        super().__init__(timeout)
+        self.websocket: WebSocket | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+    async def serve(self, websocket: WebSocket) -> None:
+        await websocket.accept()
+        print("OneBot实现已连接", websocket.client)
+        self.websocket = websocket
+        self.loop = asyncio.get_running_loop()
+        self.connected.set()
+        try:
+            while True:
+                self.receive(await websocket.receive_text())
+        except WebSocketDisconnect:
+            print("OneBot实现已断开", websocket.client)
+        finally:
+            if self.websocket is websocket:
+                self.websocket = None
+                self.disconnected()
+
+    def transmit(self, message: str) -> None:
+        websocket = self.websocket
+        if websocket is None or self.loop is None:
+            raise ConnectionError("WebSocket连接已断开")
+        asyncio.run_coroutine_threadsafe(websocket.send_text(message), self.loop).result()
+
+    def close(self) -> None:
+        if (websocket := self.websocket) and self.loop:
+            asyncio.run_coroutine_threadsafe(websocket.close(), self.loop)
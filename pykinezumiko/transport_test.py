@@ -0,0 +1,85 @@
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import WebSocketRoute
+from starlette.testclient import TestClient
+
+from .transport import ForwardWebSocketTransport, HTTPTransport, ReverseWebSocketTransport, WebSocketTransport
+
+EVENT = {"post_type": "message", "message_id": 1, "user_id": 114514, "message": []}
+
+
+@pytest.mark.parametrize("uds", [None, "/tmp/onebot.sock"])
+def test_HTTP连接池(uds: str | None):
+    # 经由Unix域套接字连接时，连接池的设置也要生效。
+    transport = HTTPTransport(uds=uds)
+    try:
+        pool = transport.client._transport._pool  # type: ignore
+        assert (pool._max_connections, pool._max_keepalive_connections, pool._keepalive_expiry) == (16, 8, 60.0)
+    finally:
+        transport.close()
+
+
+def check_multiplexing(transport: WebSocketTransport, receive, send) -> None:
+    """以假的OneBot实现身份，检查同一条连接上同时进行的请求与事件上报。"""
+    events = queue.Queue()
+    transport.on_event = events.put
+    with ThreadPoolExecutor() as pool:
+        a = pool.submit(transport.request, "get_login_info", {}, 5.0)
+        b = pool.submit(transport.request, "get_msg", {"message_id": 1}, 5.0)
+        requests = {request["action"]: request for request in (receive(), receive())}
+        assert requests["get_msg"]["params"] == {"message_id": 1}
+        # 事件穿插在响应之间，响应则以与请求相反的顺序返回。
+        send(EVENT)
+        send({"status": "ok", "retcode": 0, "data": {"message": []}, "echo": requests["get_msg"]["echo"]})
+        send(
+            {
+                "status": "ok",
+                "retcode": 0,
+                "data": {"nickname": "木鼠子"},
+                "echo": requests["get_login_info"]["echo"],
+            }
+        )
+        assert a.result(5.0)["data"] == {"nickname": "木鼠子"}
+        assert b.result(5.0)["data"] == {"message": []}
+    assert events.get(timeout=5.0) == EVENT
+
+
+def test_反向WebSocket():
+    transport = ReverseWebSocketTransport(timeout=5.0)
+    app = Starlette(routes=[WebSocketRoute("/", transport.serve)])
+    with TestClient(app) as client, client.websocket_connect("/") as websocket:
+        check_multiplexing(transport, websocket.receive_json, websocket.send_json)
+    # 断开后，请求在等待连接超时后失败。
+    with pytest.raises(ConnectionError):
+        transport.request("get_login_info", {}, 0.1)
+
+
+def test_正向WebSocket():
+    server = pytest.importorskip("websockets.sync.server")
+    connections = queue.Queue()
+    done = threading.Event()
+
+    def handler(connection):
+        connections.put(connection)
+        done.wait(10.0)
+
+    with server.serve(handler, "127.0.0.1", 0) as peer:
+        threading.Thread(target=peer.serve_forever, daemon=True).start()
+        host, port = peer.socket.getsockname()
+        transport = ForwardWebSocketTransport(f"ws://{host}:{port}", timeout=5.0)
+        try:
+            connection = connections.get(timeout=5.0)
+            check_multiplexing(
+                transport,
+                lambda: json.loads(connection.recv(5.0)),
+                lambda data: connection.send(json.dumps(data)),
+            )
+        finally:
+            done.set()
+            transport.close()
+            peer.shutdown()
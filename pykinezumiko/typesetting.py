@@ -1,21 +1,90 @@
 import base64
+import functools
+import hashlib
+import inspect
 import io
 import math
 import pkgutil
 import re
-from functools import cache
-from itertools import pairwise
-from typing import NamedTuple
+import struct
+from collections import deque
+from itertools import accumulate, pairwise
+from typing import Any, NamedTuple
 
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image, ImageColor, ImageFont
 
-from . import conf
+from . import codec, conf
+from .caching import DiskCache, SingleFlight, TTLCache
 
 # 虽然函数名叫truetype，但是下层调用的FreeType其实支持许多字体格式。
 # 反倒是用适用于Windows的文泉驿点阵正黑渲染会有错位。
+# 点阵字体没有字形替换和字偶距，因此使用基本布局，字符串的宽度恰为各字符宽度之和。
 font_data = pkgutil.get_data(__name__, "resources/wenquanyi_10pt.pcf")
 assert font_data, "找不到字体文件。"
-font = ImageFont.truetype(font_data, 13)
+font = ImageFont.truetype(io.BytesIO(font_data), 13, layout_engine=ImageFont.Layout.BASIC)
+
+
+def load_advances(data: bytes) -> np.ndarray:
+    """从PCF字体文件的度量表和编码表中读取每个BMP码位的字符宽度。
+
+    PCF是点阵字体，字符宽度都是常数，不必经由FreeType逐个查询。
+    只支持以Unicode编码的字体。
+
+    :returns: 长0x10001的数组。最后一项是字体中没有的字符（包括BMP以外的字符）的宽度。
+    """
+    if data[:4] != b"\1fcp":
+        raise ValueError("不是PCF字体文件")
+    (count,) = struct.unpack_from("<i", data, 4)
+    tables = {}
+    for i in range(count):
+        type, format, _, offset = struct.unpack_from("<4i", data, 8 + 16 * i)
+        # 表头重复一遍格式，其中的PCF_BYTE_MASK位决定表中数据的字节序。
+        tables[type] = format, ">" if format & 4 else "<", offset + 4
+
+    # PCF_METRICS
+    format, order, offset = tables[1 << 2]
+    if format & 0x100:
+        # PCF_COMPRESSED_METRICS：每个字形5个字节，都加了0x80。
+        (count,) = struct.unpack_from(order + "h", data, offset)
+        widths = np.frombuffer(data, np.uint8, count * 5, offset + 2)[2::5] - 0x80
+    else:
+        (count,) = struct.unpack_from(order + "i", data, offset)
+        widths = np.frombuffer(data, np.dtype(order + "i2"), count * 6, offset + 4)[2::6]
+
+    # PCF_BDF_ENCODINGS
+    _, order, offset = tables[1 << 5]
+    min_byte2, max_byte2, min_byte1, max_byte1, default = struct.unpack_from(order + "5h", data, offset)
+    columns = max_byte2 - min_byte2 + 1
+    rows = max_byte1 - min_byte1 + 1
+    glyphs = np.full((256, 256), 0xFFFF, np.int64)
+    glyphs[min_byte1 : max_byte1 + 1, min_byte2 : max_byte2 + 1] = np.frombuffer(
+        data, np.dtype(order + "u2"), columns * rows, offset + 10
+    ).reshape(rows, columns)
+    glyphs = glyphs.ravel()
+    # 字体中没有的字符显示为默认字符。
+    missing = widths[glyphs[default]] if glyphs[default] != 0xFFFF else widths[0]
+    advances = np.full(0x10001, missing, np.int32)
+    present = glyphs != 0xFFFF
+    advances[:0x10000][present] = widths[glyphs[present]]
+    return advances
+
+
+ADVANCES = load_advances(font_data)
+"""从码位到font中字符宽度的映射，参照load_advances。"""
+SPACES = np.zeros(0x10001, np.bool_)
+"""码位是否是空白字符，即是否匹配正则表达式中的\\s。"""
+SPACES[[c for c in range(0x10000) if chr(c).isspace()]] = True
+
+
+PALETTE = np.array([ImageColor.getrgb(color) for color in conf.THEME], np.uint8)
+"""conf.THEME中各颜色的RGB值。"""
+
+
+def code_points(text: str) -> np.ndarray:
+    """字符串中每个字符在ADVANCES和SPACES中的下标。BMP以外的字符都对应最后一项。"""
+    codes = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), np.uint32)
+    return np.minimum(codes, 0x10000)
 
 
 class Glue(NamedTuple):
@@ -48,18 +117,7 @@ class Glue(NamedTuple):
         return self.width - self.shrink
 
     def ratio(self, to: float) -> float:
-        if to > self.width:
-            try:
-                return (to - self.width) / self.stretch
-            except ZeroDivisionError:
-                return math.inf
-        elif to < self.width:
-            try:
-                return (to - self.width) / self.shrink
-            except ZeroDivisionError:
-                return -math.inf
-        else:
-            return 0.0
+        return ratio(self.width, self.stretch, self.shrink, to)
 
     def set(self, ratio: float = 0.0) -> float:
         if ratio >= 0.0:
@@ -68,16 +126,56 @@ class Glue(NamedTuple):
             return self.width + self.shrink * ratio
 
     def demerit(self, to: float) -> float:
-        return min(10000.0, (0.01 + abs(self.ratio(to)) ** 3) ** 2)
+        return demerit(self.width, self.stretch, self.shrink, to)
+
+
+def ratio(width: float, stretch: float, shrink: float, to: float) -> float:
+    """把弹性长度设置为to所需的伸缩比例。拉伸为正，挤压为负。"""
+    if to > width:
+        try:
+            return (to - width) / stretch
+        except ZeroDivisionError:
+            return math.inf
+    elif to < width:
+        try:
+            return (to - width) / shrink
+        except ZeroDivisionError:
+            return -math.inf
+    else:
+        return 0.0
+
+
+def demerit(width: float, stretch: float, shrink: float, to: float) -> float:
+    """把弹性长度设置为to的成本。"""
+    return min(10000.0, (0.01 + abs(ratio(width, stretch, shrink, to)) ** 3) ** 2)
 
 
-@cache
 def measure(text: str) -> Glue:
     """计算文字的宽度。如果有字符串包含空格，会带有伸长量和压缩量。"""
-    width = font.getlength(text)
-    space = sum(font.getlength(match.group()) for match in re.finditer(r"\s+", text))
-    stretch = space * 0.6 + text.count("\u200b") * 2.5
-    return Glue(width, stretch, space * 0.2)
+    widths, stretches, shrinks = measure_all([text])
+    return Glue(float(widths[0]), float(stretches[0]), float(shrinks[0]))
+
+
+def measure_all(texts: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """一次计算许多字符串的宽度，结果与逐个调用measure相同。
+
+    :returns: 各字符串的宽度、伸长量、压缩量构成的三个数组。
+    """
+    codes = code_points("".join(texts))
+    advances = ADVANCES[codes]
+    # 各字符串在拼接后的字符串中的起止位置。
+    lengths = np.array([len(text) for text in texts], np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+
+    def sums(values: np.ndarray) -> np.ndarray:
+        cumsum = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+        return cumsum[ends] - cumsum[starts]
+
+    width = sums(advances).astype(np.float64)
+    space = sums(advances * SPACES[codes]).astype(np.float64)
+    stretch = space * 0.6 + sums(codes == 0x200B) * 2.5
+    return width, stretch, space * 0.2
 
 
 def is_breakable(ch: str) -> bool:
@@ -123,36 +221,46 @@ def break_text(text: str, line_width: float) -> list[list[tuple[float, str]]]:
         # 保留段首空格。
         if (i == 0 or items[i - 1] == "\n") and items[i] != "\n":
             isspace[i] = False
-    # cumsum[i] = 前i个项目的弹性宽度和。
-    cumsum = [Glue()]
-    for item in items:
-        i = measure(item)
-        if i.shrunk > line_width:
-            i = Glue(line_width - 0.5, i.stretch, i.shrink)
-        cumsum.append(cumsum[-1] + i)
-    # print(*zip(items, isspace, cumsum), cumsum[-1], sep="\n")
+    # 前i个项目的弹性宽度和，按宽度、伸长量、压缩量分为三个数组。
+    widths, stretches, shrinks = measure_all(items)
+    widths = np.where(widths - shrinks > line_width, line_width - 0.5, widths)
+    width = list(accumulate(widths.tolist(), initial=0.0))
+    stretch = list(accumulate(stretches.tolist(), initial=0.0))
+    shrink = list(accumulate(shrinks.tolist(), initial=0.0))
     # dp[i] = 在第i个项目处断行的(成本最小值, 达到最小值时上一个断行处的项目索引)。
     # 通常是在空格处断行。紧急情况下（例如单词超出行宽），也会在单词前断行。
     dp: list[tuple[float, int]] = [(math.inf, -1)] * len(items)
     # 首个断行点就是第一个单词。
     dp[0] = (0.0, -1)
-    i = 0
+    # 活动断行点：成本有限，且到当前项目为止的一行还能挤得下的断行点，从前往后排列。
+    # 行越长越挤不下，所以挤不下的断行点总是在开头，移出后也不会再用到。
+    active = deque([0])
     for k in range(1, len(items)):
-        if isspace[k]:
-            while (cumsum[k] - cumsum[i + isspace[i]]).shrunk > line_width:
-                i += 1
-            dp[k] = min(
-                (
-                    dp[j][0]
-                    + (0.0 if items[k] == "\n" else (cumsum[k] - cumsum[j + isspace[j]]).demerit(line_width)),
-                    j,
-                )
-                for j in range(i, k)
-                if math.isfinite(dp[j][0])
-            )
-            # 强制在段落结束处断行。
+        if not isspace[k]:
+            continue
+        # 至少保留一个断行点。段首空格等不可断的项目使一行怎样都挤不下时，宁可排出过满的行。
+        while len(active) > 1:
+            i = active[0] + isspace[active[0]]
+            if (width[k] - width[i]) - (shrink[k] - shrink[i]) <= line_width:
+                break
+            active.popleft()
+        best = math.inf, -1
+        for j in active:
             if items[k] == "\n":
-                i = k
+                cost = dp[j][0]
+            else:
+                i = j + isspace[j]
+                cost = dp[j][0] + demerit(
+                    width[k] - width[i], stretch[k] - stretch[i], shrink[k] - shrink[i], line_width
+                )
+            # 成本相同时取较早的断行点。
+            if cost < best[0]:
+                best = cost, j
+        dp[k] = best
+        # 强制在段落结束处断行。
+        if items[k] == "\n":
+            active.clear()
+        active.append(k)
     # 追踪断行项目索引。
     breaks: list[int] = []
     i = len(items) - 1
@@ -164,13 +272,79 @@ def break_text(text: str, line_width: float) -> list[list[tuple[float, str]]]:
     lines: list[list[tuple[float, str]]] = []
     for i, k in pairwise(breaks):
         i += isspace[i]
-        ratio = 0.0 if items[k] == "\n" else (cumsum[k] - cumsum[i]).ratio(line_width)
-        if math.isinf(ratio):
-            ratio = 0.0
-        lines.append([((cumsum[j] - cumsum[i]).set(ratio), items[j]) for j in range(i, k) if not isspace[j]])
+        if items[k] == "\n":
+            r = 0.0
+        else:
+            r = ratio(width[k] - width[i], stretch[k] - stretch[i], shrink[k] - shrink[i], line_width)
+            if math.isinf(r):
+                r = 0.0
+        lines.append(
+            [
+                (
+                    width[j] - width[i] + (stretch[j] - stretch[i] if r >= 0.0 else shrink[j] - shrink[i]) * r,
+                    items[j],
+                )
+                for j in range(i, k)
+                if not isspace[j]
+            ]
+        )
     return lines
 
 
+class GlyphAtlas:
+    """点阵字体的字形图集。
+
+    每个字符在第一次用到时由FreeType栅格化一次，之后绘制文字只需把字形位图按字符宽度逐个复制到画布上。
+    只适用于点阵字体：像素非有即无，字符宽度都是整数，也没有字偶距。
+    """
+
+    def __init__(self, font: ImageFont.FreeTypeFont) -> None:
+        self.font = font
+        self.glyphs: dict[str, tuple[np.ndarray, int, int, int]] = {}
+        """从字符到(字形位图, 横向偏移, 纵向偏移, 字符宽度)的映射。"""
+
+    def glyph(self, ch: str) -> tuple[np.ndarray, int, int, int]:
+        if (glyph := self.glyphs.get(ch)) is None:
+            mask, (dx, dy) = self.font.getmask2(ch, "L")
+            bitmap = np.asarray(mask, np.uint8).reshape(mask.size[1], mask.size[0])
+            advance = self.font.getlength(ch)
+            if not np.isin(bitmap, (0, 255)).all() or not advance.is_integer():
+                raise ValueError(f"不是点阵字体：{self.font.getname()}")
+            glyph = self.glyphs[ch] = bitmap.astype(np.bool_), dx, dy, int(advance)
+        return glyph
+
+    def draw(self, ink: np.ndarray, x: float, y: int, text: str) -> None:
+        """在布尔数组ink上绘制文字，结果与ImageDraw.text((x, y), text)相同。超出数组的部分被裁掉。"""
+        # FreeType以1/64像素为单位定位，点阵字形再对齐到整像素。
+        pen = (math.floor(x * 64 + 0.5) + 32) >> 6
+        for ch in text:
+            bitmap, dx, dy, advance = self.glyph(ch)
+            left = pen + dx
+            top = y + dy
+            x0 = max(left, 0)
+            y0 = max(top, 0)
+            x1 = min(left + bitmap.shape[1], ink.shape[1])
+            y1 = min(top + bitmap.shape[0], ink.shape[0])
+            if x0 < x1 and y0 < y1:
+                ink[y0:y1, x0:x1] |= bitmap[y0 - top : y1 - top, x0 - left : x1 - left]
+            pen += advance
+
+
+glyph_atlas = functools.cache(GlyphAtlas)
+"""取得字体对应的字形图集。每种字体只创建一个图集。"""
+
+
+def outline(a: np.ndarray, x0: int, y0: int, x1: int, y1: int, width: int, value: int) -> None:
+    """在数组上画矩形框，结果与ImageDraw.rectangle(((x0, y0), (x1, y1)), outline=value, width=width)相同。
+
+    与ImageDraw相同，矩形包含右下角(x1, y1)处的像素。
+    """
+    a[y0 : y0 + width, x0 : x1 + 1] = value
+    a[y1 - width + 1 : y1 + 1, x0 : x1 + 1] = value
+    a[y0 : y1 + 1, x0 : x0 + width] = value
+    a[y0 : y1 + 1, x1 - width + 1 : x1 + 1] = value
+
+
 def text_bitmap(
     text="string\nlorem ipsum 114514\n1919810\n共计处理了489975条消息",
     font=font,
@@ -186,40 +360,89 @@ def text_bitmap(
 ):
     lines = break_text(text, width)
     height = line_height * len(lines) - 1
-    img = Image.new(
-        "RGB",
-        (
-            width + (margin + border + padding_inline) * 2,
-            height + (margin + border + padding_block) * 2,
-        ),
-        conf.THEME[3],
-    )
-    draw = ImageDraw.Draw(img)
-    draw.rectangle(
-        ((0, 0), img.size),
-        outline=conf.THEME[2],
-        width=margin,
-    )
-    draw.rectangle(
-        ((margin, margin), (img.width - margin, img.height - margin)),
-        outline=conf.THEME[1],
-        width=border,
-    )
-    for y in range(line_height - 1, height, line_height):
-        y += margin + border + padding_block
-        for x in range(0, width, dash_on + dash_off):
-            x += margin + border + padding_inline
-            img.paste(conf.THEME[2], (x, y, x + dash_on, y + 1))
+    left = margin + border + padding_inline
+    top = margin + border + padding_block
+    # 先在以conf.THEME的下标为值的数组上作画，最后再换成颜色。
+    canvas = np.full((height + top * 2, width + left * 2), 3, np.uint8)
+    outline(canvas, 0, 0, canvas.shape[1], canvas.shape[0], margin, 2)
+    outline(canvas, margin, margin, canvas.shape[1] - margin, canvas.shape[0] - margin, border, 1)
+    # 横线由长dash_on像素的短划组成，每隔line_height像素一条。
+    dashes = np.arange(left, left + width, dash_on + dash_off)[:, np.newaxis] + np.arange(dash_on)
+    dashes = dashes[dashes < canvas.shape[1]]
+    canvas[top + line_height - 1 : top + height : line_height, dashes] = 2
+    ink = np.zeros(canvas.shape, np.bool_)
+    atlas = glyph_atlas(font)
     for y, line in enumerate(lines):
-        y *= line_height
-        y += margin + border + padding_block + font.size // 2
+        y = y * line_height + top + int(font.size) // 2
         for x, item in line:
-            x += margin + border + padding_inline
-            draw.text((x, y), item, fill=conf.THEME[0], font=font)
-    return img.resize((img.width * scale, img.height * scale), resample=Image.Resampling.BOX)
+            atlas.draw(ink, x + left, y, item)
+    canvas[ink] = 0
+    # 整数倍放大只需把每个像素重复若干次。先在行内重复，再整行重复，后者只是成块复制。
+    canvas = canvas.repeat(scale, 1).repeat(scale, 0)
+    img = Image.frombytes("P", (canvas.shape[1], canvas.shape[0]), canvas.tobytes())
+    img.putpalette(PALETTE.tobytes())
+    return img.convert("RGB")
 
 
 def pil_image_to_base64(img: Image.Image) -> str:
-    with io.BytesIO() as f:
-        img.save(f, format="PNG")
-        return base64.b64encode(f.getvalue()).decode()
+    """发送图片不必经过这里，直接把图像或codec.Media传给Bot.send即可。"""
+    return base64.b64encode(codec.encode_png(img)).decode()
+
+
+class RenderCache:
+    """文字图片的缓存，以文字和排版参数的散列值为键，存储编码好的PNG。
+
+    帮助文本、日历、错误信息等重复的输出命中缓存时，既不必重新断行和绘制，也不必重新编码。
+    缓存分为两级：内存中的LRU缓存，以及工作目录中总大小有上限的磁盘缓存。
+    图片只有conf.THEME中的几种颜色，因此存为调色板图像。
+    """
+
+    VERSION = 2
+    """排版或绘制的结果改变时增加此版本号，使已有的缓存条目失效。"""
+
+    def __init__(self, path: str = "data_renders", maxsize: int = 64, max_bytes: int = 64 << 20) -> None:
+        """
+        :param path: 磁盘缓存的目录。第一次写入时才会创建。
+        :param maxsize: 内存中至多缓存的图片数。
+        :param max_bytes: 磁盘缓存的总字节数上限。
+        """
+        self.memory = TTLCache[str, bytes](maxsize, math.inf)
+        self.disk = DiskCache(path, max_bytes)
+        self.flights = SingleFlight[bytes]()
+        """合并同时进行的相同绘制。"""
+        self.renders = 0
+        """两级缓存都未命中而实际绘制的次数。"""
+
+    def key(self, text: str, **kwargs) -> str:
+        """计算缓存键。参数与text_bitmap相同，省略的参数按默认值计算。"""
+        arguments = inspect.signature(text_bitmap).bind(text, **kwargs)
+        arguments.apply_defaults()
+        parameters = {
+            name: (value.getname(), value.size) if isinstance(value, ImageFont.FreeTypeFont) else value
+            for name, value in arguments.arguments.items()
+        }
+        return hashlib.sha256(repr((self.VERSION, conf.THEME, parameters)).encode()).hexdigest()
+
+    def png(self, text: str, **kwargs) -> bytes:
+        """取得文字图片的PNG数据。参数与text_bitmap相同。"""
+        key = self.key(text, **kwargs)
+        if (data := self.memory.get(key)) is None:
+            data = self.flights.do(key, lambda: self.load(key, text, kwargs))
+            self.memory[key] = data
+        return data
+
+    def load(self, key: str, text: str, kwargs: dict[str, Any]) -> bytes:
+        """从磁盘缓存中读取，或者重新绘制。"""
+        filename = key + ".png"
+        if (data := self.disk.get(filename)) is None:
+            data = codec.encode_png(text_bitmap(text, **kwargs), colors=len(conf.THEME))
+            self.renders += 1
+            self.disk.set(filename, data)
+        return data
+
+    def stats(self) -> dict[str, Any]:
+        return {"memory": self.memory.stats(), "disk": self.disk.stats(), "renders": self.renders}
+
+
+render_cache = RenderCache()
+"""默认的文字图片缓存。"""
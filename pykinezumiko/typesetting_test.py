@@ -0,0 +1,81 @@
+import hashlib
+import io
+import re
+
+import pytest
+from hypothesis import given
+from hypothesis import strategies as st
+from PIL import Image
+
+from . import typesetting
+from .typesetting import ADVANCES, Glue, RenderCache, break_text, font, measure, text_bitmap
+
+TEXTS = {
+    "默认": "string\nlorem ipsum 114514\n1919810\n共计处理了489975条消息",
+    "英文": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et "
+    "dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex "
+    "ea commodo consequat.",
+    "中文": "木鼠子是一个QQ机器人。它的名字来源于一种会喷火的老鼠，据说这种老鼠生活在火山里，"
+    "毛皮可以织成不怕火烧的布。「火浣布」这个词，最早见于《列子》：“火浣之布，浣之必投于火。”"
+    "由于无法考证，这里不再赘述……",
+    "混排": "使用简化的TeX断行算法（Knuth-Plass 1981附录A）。没有实现自动断字。"
+    "Python 3.14起，可以用 t-string 编写模板字符串！\n\n第二段。",
+    "缩进": "  段首空格会被保留。\n  第二段 也是。\t制表符　全角空格",
+    "超长单词": "https://example.com/" + "a" * 80 + " 之后的文字",
+    "空白": " \n\n ",
+}
+
+
+@pytest.mark.parametrize("name", TEXTS)
+@pytest.mark.parametrize("width", [274, 100])
+def test_断行(name: str, width: int, snapshot):
+    assert break_text(TEXTS[name], width) == snapshot
+
+
+@pytest.mark.parametrize("name", TEXTS)
+def test_渲染(name: str, snapshot):
+    img = text_bitmap(TEXTS[name])
+    assert (img.mode, img.size, hashlib.sha256(img.tobytes()).hexdigest()) == snapshot
+
+
+def test_图片缓存(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    calls = 0
+
+    def counting_break_text(text: str, line_width: float):
+        nonlocal calls
+        calls += 1
+        return break_text(text, line_width)
+
+    monkeypatch.setattr(typesetting, "break_text", counting_break_text)
+    cache = RenderCache(str(tmp_path), maxsize=1)
+    data = cache.png(TEXTS["中文"])
+    assert Image.open(io.BytesIO(data)).convert("RGB").tobytes() == text_bitmap(TEXTS["中文"]).tobytes()
+    calls = 0
+    # 内存命中。
+    assert cache.png(TEXTS["中文"]) is data
+    # 省略的参数按默认值计算。
+    assert cache.png(TEXTS["中文"], width=274) is data
+    assert calls == 0
+    cache.png(TEXTS["中文"], width=100)
+    assert calls == 1
+    # 磁盘命中，重启后依然有效。
+    assert cache.png(TEXTS["中文"]) == data
+    assert RenderCache(str(tmp_path)).png(TEXTS["中文"]) == data
+    assert calls == 1
+    stats = cache.stats()
+    assert stats["renders"] == 2
+    assert stats["memory"]["evictions"] == 2
+    assert stats["disk"]["hits"] == 1
+
+
+def test_字宽表():
+    # 码位0和代理对无法单独测量。
+    codes = [c for c in range(1, 0x10000) if not 0xD800 <= c < 0xE000]
+    assert ADVANCES[codes].tolist() == [font.getlength(chr(c)) for c in codes]
+    assert ADVANCES[-1] == font.getlength("😀")
+
+
+@given(st.text(st.characters(exclude_characters="\0\n", exclude_categories=["Cs"])))
+def test_测量(text: str):
+    space = sum(font.getlength(match.group()) for match in re.finditer(r"\s+", text))
+    assert measure(text) == Glue(font.getlength(text), space * 0.6 + text.count("\u200b") * 2.5, space * 0.2)